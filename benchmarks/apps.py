@@ -0,0 +1,202 @@
+# -*- coding: utf-8 -*-
+"""
+    apps
+    ~~~~
+
+    Applications and datastores for the benchmarks.
+
+    Every datastore uses an in-memory (or temporary file) SQLite database, or
+    mongomock, so the numbers measure Flask-Security and the ORM - not a
+    database server.
+"""
+
+import atexit
+import os
+import shutil
+import tempfile
+import time
+
+from flask import Flask
+from flask_mail import Mail
+
+from flask_security import (
+    MongoEngineUserDatastore,
+    PeeweeUserDatastore,
+    PonyUserDatastore,
+    RoleMixin,
+    Security,
+    SQLAlchemyUserDatastore,
+    UserMixin,
+    hash_password,
+)
+
+_tmpdir = tempfile.mkdtemp(prefix="flask-security-bench")
+atexit.register(shutil.rmtree, _tmpdir, True)
+
+EMAIL = "matt@lp.com"
+PASSWORD = "password"
+
+
+def sqlalchemy_datastore(app):
+    from flask_sqlalchemy import SQLAlchemy
+    from flask_security.models import fsqla
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    db = SQLAlchemy(app)
+    fsqla.FsModels.set_db_info(db)
+
+    class Role(db.Model, fsqla.FsRoleMixin):
+        pass
+
+    class User(db.Model, fsqla.FsUserMixin):
+        pass
+
+    with app.app_context():
+        db.create_all()
+    return SQLAlchemyUserDatastore(db, User, Role)
+
+
+def mongoengine_datastore(app):
+    from flask_mongoengine import MongoEngine
+
+    db_name = "flask_security_bench_%s" % str(time.time()).replace(".", "_")
+    # The database name has to be in the URI too - otherwise mongomock uses its
+    # default database, shared by every app.
+    app.config["MONGODB_SETTINGS"] = {
+        "db": db_name,
+        "host": "mongomock://localhost/%s" % db_name,
+        "port": 27017,
+        "alias": db_name,
+    }
+    db = MongoEngine(app)
+
+    class Role(db.Document, RoleMixin):
+        name = db.StringField(required=True, unique=True, max_length=80)
+        description = db.StringField(max_length=255)
+        permissions = db.StringField(max_length=255)
+        meta = {"db_alias": db_name}
+
+    class User(db.Document, UserMixin):
+        email = db.StringField(unique=True, max_length=255)
+        username = db.StringField(max_length=255)
+        password = db.StringField(required=False, max_length=255)
+        fs_uniquifier = db.StringField(max_length=64)
+        active = db.BooleanField(default=True)
+        confirmed_at = db.DateTimeField()
+        roles = db.ListField(db.ReferenceField(Role), default=[])
+        meta = {"db_alias": db_name}
+
+    return MongoEngineUserDatastore(db, User, Role)
+
+
+def peewee_datastore(app):
+    from peewee import BooleanField, CharField, ForeignKeyField, TextField
+    from flask_peewee.db import Database
+
+    path = os.path.join(_tmpdir, "peewee-%s.db" % time.time())
+    app.config["DATABASE"] = {"name": path, "engine": "peewee.SqliteDatabase"}
+    db = Database(app)
+
+    class Role(db.Model, RoleMixin):
+        name = CharField(unique=True, max_length=80)
+        description = TextField(null=True)
+        permissions = TextField(null=True)
+
+    class User(db.Model, UserMixin):
+        email = TextField()
+        username = TextField(null=True)
+        password = TextField(null=True)
+        fs_uniquifier = TextField(null=True)
+        active = BooleanField(default=True)
+
+    class UserRoles(db.Model):
+        user = ForeignKeyField(User, backref="roles")
+        role = ForeignKeyField(Role, backref="users")
+        name = property(lambda self: self.role.name)
+        permissions = property(lambda self: self.role.permissions)
+
+        def get_permissions(self):
+            return self.role.get_permissions()
+
+    with app.app_context():
+        for Model in (Role, User, UserRoles):
+            Model.create_table()
+    return PeeweeUserDatastore(db, User, Role, UserRoles)
+
+
+def pony_datastore(app):
+    from pony.orm import Database, Optional, Required, Set
+    from pony.orm.core import SetInstance
+
+    SetInstance.append = SetInstance.add
+    db = Database()
+
+    class Role(db.Entity):
+        name = Required(str, unique=True)
+        description = Optional(str, nullable=True)
+        permissions = Optional(str, nullable=True)
+        users = Set(lambda: User)
+
+        def get_permissions(self):
+            # Not a RoleMixin - its __hash__ doesn't work with Pony entities.
+            return set(self.permissions.split(",")) if self.permissions else set()
+
+    class User(db.Entity, UserMixin):
+        email = Required(str)
+        username = Optional(str)
+        password = Optional(str, nullable=True)
+        fs_uniquifier = Optional(str, nullable=True)
+        active = Required(bool, default=True)
+        roles = Set(lambda: Role)
+
+        def has_role(self, name):
+            return name in {r.name for r in self.roles.copy()}
+
+    db.bind("sqlite", ":memory:", create_db=True)
+    db.generate_mapping(create_tables=True)
+    return PonyUserDatastore(db, User, Role)
+
+
+DATASTORES = {
+    "sqlalchemy": sqlalchemy_datastore,
+    "mongoengine": mongoengine_datastore,
+    "peewee": peewee_datastore,
+    "pony": pony_datastore,
+}
+
+
+def create_app(datastore="sqlalchemy", users=100, **config):
+    """Return an app with ``users`` users, each with an ``admin`` role.
+
+    ``config`` are ``SECURITY_`` settings without the prefix.
+    """
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "secret"
+    app.config["TESTING"] = True
+    app.config["WTF_CSRF_ENABLED"] = False
+    app.config["SECURITY_PASSWORD_SALT"] = "salty"
+    app.config["SECURITY_PASSWORD_HASH"] = "plaintext"
+    for key, value in config.items():
+        app.config["SECURITY_" + key.upper()] = value
+    Mail(app)
+
+    app.security = Security(app, datastore=DATASTORES[datastore](app))
+
+    @app.route("/")
+    def index():
+        return "Home"
+
+    with app.app_context():
+        ds = app.security.datastore
+        role = ds.create_role(name="admin", permissions="read,write")
+        password = hash_password(PASSWORD)
+        for i in range(users):
+            email = EMAIL if i == 0 else "user%d@lp.com" % i
+            ds.create_user(
+                email=email, username="user%d" % i, password=password, roles=[role]
+            )
+        ds.commit()
+        # Registers the '_' template global mail templates need.
+        app.try_trigger_before_first_request_functions()
+    return app
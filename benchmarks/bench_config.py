@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_config
+    ~~~~~~~~~~~~
+
+    Micro-benchmark of per-request configuration lookup overhead.
+
+    Compares scanning ``app.config`` on every lookup (the pre-3.3.0 behavior of
+    :func:`config_value`) against reading the compiled snapshot built by
+    :meth:`Security.init_app`.
+
+    Usage::
+
+        python benchmarks/bench_config.py [iterations]
+"""
+
+import sys
+import timeit
+
+from flask import Flask
+
+from flask_security import Security, UserDatastore
+from flask_security.utils import (
+    config_value,
+    get_config,
+    get_identity_attributes,
+    get_max_age,
+)
+
+# Roughly the lookups made by a token authenticated request with CSRF enabled.
+REQUEST_KEYS = [
+    "USE_VERIFY_PASSWORD_CACHE",
+    "CSRF_PROTECT_MECHANISMS",
+    "CSRF_PROTECT_MECHANISMS",
+    "CSRF_COOKIE",
+    "BACKWARDS_COMPAT_UNAUTHN",
+    "PASSWORD_SINGLE_HASH",
+]
+
+
+def create_app():
+    app = Flask(__name__)
+    app.config["SECRET_KEY"] = "secret"
+    # A typical app has many non-security settings that get scanned as well.
+    for i in range(100):
+        app.config["OTHER_SETTING_%d" % i] = i
+    Security(app, UserDatastore(None, None), register_blueprint=False)
+    return app
+
+
+def scan_request(app):
+    for key in REQUEST_KEYS:
+        get_config(app).get(key)
+    txt = get_config(app).get("LOGIN_WITHIN").split()
+    attrs = app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"]
+    return txt, attrs
+
+
+def compiled_request(app):
+    for key in REQUEST_KEYS:
+        config_value(key)
+    return get_max_age("LOGIN"), get_identity_attributes()
+
+
+def main(iterations=10000):
+    app = create_app()
+    with app.app_context():
+        for name, fn in [("scan", scan_request), ("compiled", compiled_request)]:
+            t = timeit.timeit(lambda: fn(app), number=iterations)
+            print("%-10s %8.2f us/request" % (name, t / iterations * 1e6))
+
+
+if __name__ == "__main__":
+    main(*[int(a) for a in sys.argv[1:2]])
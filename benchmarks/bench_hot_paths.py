@@ -0,0 +1,223 @@
+# -*- coding: utf-8 -*-
+"""
+    bench_hot_paths
+    ~~~~~~~~~~~~~~~
+
+    Benchmarks of the per-request authentication and authorization paths,
+    user lookup on each datastore, login and mail rendering.
+
+    Unless a benchmark is about hashing, passwords use the ``plaintext`` scheme
+    so that Flask-Security's own overhead isn't hidden behind bcrypt.
+"""
+
+import base64
+
+from flask import request
+
+from apps import DATASTORES, EMAIL, PASSWORD, create_app
+from harness import benchmark, parametrize
+
+from flask_security import (
+    auth_required,
+    auth_token_required,
+    login_user,
+    permissions_accepted,
+    permissions_required,
+    roles_accepted,
+    roles_required,
+)
+from flask_security.core import _default_config, _request_loader, _user_loader
+from flask_security.decorators import _check_http_auth
+from flask_security.utils import send_mail
+
+PASSWORD_HASHES = _default_config["PASSWORD_SCHEMES"]
+
+
+def _token_auth(**config):
+    app = create_app(**config)
+    with app.app_context():
+        token = app.security.datastore.find_user(email=EMAIL).get_auth_token()
+    headers = {app.security.token_authentication_header: token}
+
+    def op():
+        with app.test_request_context("/", headers=headers):
+            assert _request_loader(request) is not None
+
+    yield op
+
+
+@benchmark("token_auth")
+def token_auth():
+    return _token_auth()
+
+
+@benchmark("token_auth[verify_password_cache]")
+def token_auth_verify_cache():
+    return _token_auth(use_verify_password_cache=True)
+
+
+@benchmark("token_auth[token_auth_cache]")
+def token_auth_token_cache():
+    return _token_auth(use_token_auth_cache=True)
+
+
+@benchmark("http_auth")
+def http_auth():
+    app = create_app()
+    credentials = base64.b64encode(("%s:%s" % (EMAIL, PASSWORD)).encode("utf-8"))
+    headers = {"Authorization": "Basic " + credentials.decode("ascii")}
+
+    def op():
+        with app.test_request_context("/", headers=headers):
+            assert _check_http_auth()
+
+    yield op
+
+
+def _session_auth(**config):
+    app = create_app(**config)
+    with app.app_context():
+        user_id = str(app.security.datastore.find_user(email=EMAIL).id)
+
+    def op():
+        with app.test_request_context("/"):
+            assert _user_loader(user_id) is not None
+
+    yield op
+
+
+@benchmark("session_auth")
+def session_auth():
+    return _session_auth()
+
+
+@benchmark("session_auth[session_user_cache]")
+def session_auth_user_cache():
+    return _session_auth(use_session_user_cache=True)
+
+
+def _authorization(decorator):
+    app = create_app()
+    view = decorator(lambda: "ok")
+    with app.test_request_context("/"):
+        login_user(app.security.datastore.find_user(email=EMAIL))
+
+        def op():
+            assert view() == "ok"
+
+        yield op
+
+
+@benchmark("auth_required[session]")
+def bench_auth_required_session():
+    # A browser/SPA request: session cookie and a JSON body, no token.
+    app = create_app()
+    view = auth_required()(lambda: "ok")
+    with app.test_request_context("/", json={"name": "value"}):
+        login_user(app.security.datastore.find_user(email=EMAIL))
+
+        def op():
+            assert view() == "ok"
+
+        yield op
+
+
+@benchmark("roles_required")
+def bench_roles_required():
+    return _authorization(roles_required("admin"))
+
+
+@benchmark("roles_required[3]")
+def bench_roles_required_3():
+    return _authorization(roles_required("admin", "admin", "admin"))
+
+
+@benchmark("roles_accepted")
+def bench_roles_accepted():
+    return _authorization(roles_accepted("editor", "author", "admin"))
+
+
+@benchmark("permissions_accepted")
+def bench_permissions_accepted():
+    return _authorization(permissions_accepted("write", "delete"))
+
+
+@benchmark("permissions_required")
+def bench_permissions_required():
+    return _authorization(permissions_required("read", "write"))
+
+
+@parametrize("token_view", ["default", "lightweight_identity"])
+def token_view(mode):
+    app = create_app(
+        use_token_auth_cache=True, lightweight_identity=mode == "lightweight_identity"
+    )
+    with app.app_context():
+        token = app.security.datastore.find_user(email=EMAIL).get_auth_token()
+    headers = {app.security.token_authentication_header: token}
+    view = auth_token_required(
+        roles_required("admin")(permissions_accepted("write")(lambda: "ok"))
+    )
+
+    def op():
+        with app.test_request_context("/", headers=headers):
+            assert view() == "ok"
+
+    yield op
+
+
+@parametrize("login_view", PASSWORD_HASHES)
+def login_view(password_hash):
+    app = create_app(users=1, password_hash=password_hash)
+    client = app.test_client()
+    data = dict(email=EMAIL, password=PASSWORD)
+
+    def op():
+        assert client.post("/login", json=data).status_code == 200
+
+    yield op
+
+
+@parametrize("login_datastore", sorted(DATASTORES))
+def login_datastore(datastore):
+    app = create_app(datastore, users=1)
+    client = app.test_client()
+    data = dict(email=EMAIL, password=PASSWORD)
+
+    def op():
+        assert client.post("/login", json=data).status_code == 200
+        client.get("/logout")
+
+    yield op
+
+
+@parametrize("get_user", sorted(DATASTORES))
+def get_user(datastore):
+    app = create_app(datastore)
+    with app.app_context():
+        ds = app.security.datastore
+
+        def op():
+            assert ds.get_user(EMAIL) is not None
+
+        yield op
+
+
+@parametrize("send_mail", ["welcome", "reset_instructions"])
+def bench_send_mail(template):
+    app = create_app(users=1)
+    with app.test_request_context("/"):
+        user = app.security.datastore.find_user(email=EMAIL)
+        link = "http://localhost/link/token"
+
+        def op():
+            send_mail(
+                "Subject",
+                EMAIL,
+                template,
+                user=user,
+                confirmation_link=link,
+                reset_link=link,
+            )
+
+        yield op
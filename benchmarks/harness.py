@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+"""
+    harness
+    ~~~~~~~
+
+    A minimal benchmark registry and timer.
+
+    A benchmark is a generator function that sets things up, yields the
+    callable to time, and cleans up after the ``yield``. Register it with
+    :func:`benchmark`.
+"""
+
+import datetime
+import json
+import platform
+import sys
+import timeit
+
+BENCHMARKS = []
+
+
+def benchmark(name):
+    def decorator(fn):
+        BENCHMARKS.append((name, fn))
+        return fn
+
+    return decorator
+
+
+def parametrize(name, values):
+    """Register ``fn(value)`` as ``name[value]`` for each value."""
+
+    def decorator(fn):
+        for value in values:
+            BENCHMARKS.append(("%s[%s]" % (name, value), lambda value=value: fn(value)))
+        return fn
+
+    return decorator
+
+
+def time_op(op, min_time=0.2, repeat=5):
+    """Return (number, [seconds per call for each repeat])."""
+    timer = timeit.Timer(op)
+    number = 1
+    while True:
+        elapsed = timer.timeit(number)
+        if elapsed >= min_time or number >= 1e6:
+            break
+        # Aim a little past min_time so we only calibrate a couple of times.
+        number = max(number * 2, int(number * min_time * 1.2 / max(elapsed, 1e-9)))
+    times = [elapsed / number]
+    for _ in range(repeat - 1):
+        times.append(timer.timeit(number) / number)
+    return number, times
+
+
+def run(selected=None, min_time=0.2, repeat=5, out=sys.stdout):
+    results = {}
+    for name, fn in BENCHMARKS:
+        if selected and not any(s in name for s in selected):
+            continue
+        gen = fn()
+        op = next(gen)
+        try:
+            number, times = time_op(op, min_time=min_time, repeat=repeat)
+        finally:
+            next(gen, None)
+        times.sort()
+        results[name] = dict(
+            min=times[0], median=times[len(times) // 2], number=number, repeat=repeat
+        )
+        out.write(
+            "%-50s %12.2f us %12.2f us (x%d)\n"
+            % (name, times[0] * 1e6, results[name]["median"] * 1e6, number)
+        )
+        out.flush()
+    return results
+
+
+def metadata():
+    import flask_security
+
+    return dict(
+        python=platform.python_version(),
+        implementation=platform.python_implementation(),
+        platform=platform.platform(),
+        flask_security=flask_security.__version__,
+        timestamp=datetime.datetime.utcnow().isoformat(),
+    )
+
+
+def save(path, results):
+    with open(path, "w") as fp:
+        json.dump(dict(meta=metadata(), results=results), fp, indent=2, sort_keys=True)
+
+
+def compare(path, results, out=sys.stdout):
+    """Print each benchmark's median relative to the saved run in ``path``."""
+    with open(path) as fp:
+        baseline = json.load(fp)["results"]
+    out.write("\n%-50s %12s %12s %8s\n" % ("", "baseline", "current", "ratio"))
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        old, new = baseline[name]["median"], results[name]["median"]
+        out.write(
+            "%-50s %12.2f %12.2f %7.2fx\n" % (name, old * 1e6, new * 1e6, new / old)
+        )
@@ -0,0 +1,55 @@
+# -*- coding: utf-8 -*-
+"""
+    run
+    ~~~
+
+    Run the benchmarks and optionally save or compare the results.
+
+    Usage::
+
+        python benchmarks/run.py [-k NAME ...] [--json FILE] [--compare FILE]
+
+    For example, to check a change for regressions::
+
+        git stash
+        python benchmarks/run.py --json before.json
+        git stash pop
+        python benchmarks/run.py --compare before.json
+"""
+
+import argparse
+
+import bench_hot_paths  # noqa: F401 registers benchmarks
+from harness import compare, run, save
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[1].strip())
+    parser.add_argument(
+        "-k",
+        dest="selected",
+        action="append",
+        help="Only run benchmarks whose name contains this (may be repeated)",
+    )
+    parser.add_argument("--json", help="Save results to this file")
+    parser.add_argument("--compare", help="Compare with results saved in this file")
+    parser.add_argument(
+        "--min-time",
+        type=float,
+        default=0.2,
+        help="Minimum seconds per timing (default 0.2)",
+    )
+    parser.add_argument(
+        "--repeat", type=int, default=5, help="Timings per benchmark (default 5)"
+    )
+    args = parser.parse_args()
+
+    results = run(args.selected, min_time=args.min_time, repeat=args.repeat)
+    if args.json:
+        save(args.json, results)
+    if args.compare:
+        compare(args.compare, results)
+
+
+if __name__ == "__main__":
+    main()
@@ -49,20 +49,28 @@ from .forms import (
     TwoFactorVerifyCodeForm,
     TwoFactorVerifyPasswordForm,
 )
+from .hashing import DeferredRehasher, HashingExecutor, HashingExecutorBusy
+from .permissions import PermissionRegistry, permission_registry
+from .principal import SecurityPrincipal
+from .instrumentation import PhaseHistograms
+from .mailqueue import MailDispatcher
 from .models import fsqla
 from .signals import (
     confirm_instructions_sent,
     login_instructions_sent,
     password_changed,
     password_reset,
+    request_timed,
     reset_password_instructions_sent,
     tf_code_confirmed,
     tf_profile_changed,
     tf_security_token_sent,
     tf_disabled,
+    user_auth_changed,
     user_confirmed,
     user_registered,
 )
+from .trackable import TrackableBuffer
 from .utils import (
     FsJsonEncoder,
     SmsSenderBaseClass,
@@ -74,6 +82,7 @@ from .utils import (
     login_user,
     logout_user,
     send_mail,
+    set_request_identity,
     transform_url,
     url_for_security,
     verify_password,
@@ -107,6 +116,7 @@ __all__ = (
     "login_required",
     "login_user",
     "logout_user",
+    "set_request_identity",
     "password_reset",
     "permissions_required",
     "permissions_accepted",
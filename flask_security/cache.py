@@ -9,30 +9,649 @@
     :license: MIT, see LICENSE for more details.
 """
 
-from cachetools import TTLCache
+import abc
+from collections import OrderedDict
+from contextlib import contextmanager
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
 
-from .utils import config_value
+from cachetools import Cache, TTLCache
+
+from .permissions import permission_registry
+from .principal import SecurityPrincipal
+from .utils import config_value, encode_string, text_type
+
+
+# abc.ABC for Python 2 and 3 - a __metaclass__ attribute is ignored by 3.
+_ABC = abc.ABCMeta("_ABC", (object,), {})
+
+
+class VerifyHashCacheBackend(_ABC):
+    """Storage used by :class:`VerifyHashCache`.
+
+    Keys are strings, values are bytes. Every entry expires ``ttl`` seconds
+    after it was set.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, ttl, max_size):
+        self.ttl = ttl
+        self.maxsize = max_size
+        self._stats_lock = threading.Lock()
+        self._stats = dict(hits=0, misses=0, evictions=0)
+
+    def _count(self, name, n=1):
+        with self._stats_lock:
+            self._stats[name] += n
+
+    @abc.abstractmethod
+    def get(self, key):  # pragma: no cover
+        """Return the value stored for ``key`` or None."""
+        return None
+
+    @abc.abstractmethod
+    def set(self, key, value):  # pragma: no cover
+        """Store ``value`` for ``key``."""
+        return
+
+    @abc.abstractmethod
+    def delete(self, key):  # pragma: no cover
+        """Remove ``key`` - it isn't an error if it doesn't exist."""
+        return
+
+    @abc.abstractmethod
+    def clear(self):  # pragma: no cover
+        """Remove all entries."""
+        return
+
+    def stats(self):
+        """Return a dict with the ``hits``, ``misses`` and ``evictions`` counts
+        seen by this process."""
+        with self._stats_lock:
+            return dict(self._stats)
+
+
+class _CountingTTLCache(TTLCache):
+    """TTLCache that counts entries removed because they expired or
+    because room had to be made for a new entry."""
+
+    def __init__(self, maxsize, ttl):
+        TTLCache.__init__(self, maxsize, ttl)
+        self.evictions = 0
+
+    def _raw_size(self):
+        # Cache.currsize counts expired entries that haven't been purged yet.
+        return Cache.currsize.fget(self)
+
+    def expire(self, time=None):
+        before = self._raw_size()
+        TTLCache.expire(self, time)
+        self.evictions += before - self._raw_size()
+
+    def popitem(self):
+        item = TTLCache.popitem(self)
+        self.evictions += 1
+        return item
+
+    def clear(self):
+        # Clearing is done via popitem() - which isn't an eviction.
+        evictions = self.evictions
+        TTLCache.clear(self)
+        self.evictions = evictions
+
+
+class _Shard(object):
+    __slots__ = ("lock", "cache", "hits", "misses")
+
+    def __init__(self, maxsize, ttl):
+        self.lock = threading.Lock()
+        self.cache = _CountingTTLCache(maxsize, ttl)
+        self.hits = 0
+        self.misses = 0
+
+
+class InProcessBackend(VerifyHashCacheBackend):
+    """Cache shared by all threads of a process.
+
+    Entries are spread over ``shards`` independently locked caches so that
+    threads rarely contend with each other.
+    """
+
+    def __init__(self, ttl, max_size, shards=8):
+        super(InProcessBackend, self).__init__(ttl, max_size)
+        shards = max(1, min(shards, max_size))
+        # Spread max_size over the shards - so overall size is still bounded.
+        sizes = [max_size // shards] * shards
+        for i in range(max_size % shards):
+            sizes[i] += 1
+        self._shards = [_Shard(size, ttl) for size in sizes]
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def __len__(self):
+        count = 0
+        for shard in self._shards:
+            with shard.lock:
+                count += len(shard.cache)
+        return count
+
+    def get(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            rv = shard.cache.get(key)
+            if rv is None:
+                shard.misses += 1
+            else:
+                shard.hits += 1
+        return rv
+
+    def set(self, key, value):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.cache[key] = value
+
+    def delete(self, key):
+        shard = self._shard(key)
+        with shard.lock:
+            shard.cache.pop(key, None)
+
+    def clear(self):
+        for shard in self._shards:
+            with shard.lock:
+                shard.cache.clear()
+
+    def stats(self):
+        rv = dict(hits=0, misses=0, evictions=0)
+        for shard in self._shards:
+            with shard.lock:
+                rv["hits"] += shard.hits
+                rv["misses"] += shard.misses
+                rv["evictions"] += shard.cache.evictions
+        return rv
+
+
+# Serializes reopening shared memory caches in a forked child.
+_fork_lock = threading.Lock()
+
+
+class SharedMemoryBackend(VerifyHashCacheBackend):
+    """Cache shared by all processes on a host via a memory mapped file.
+
+    The file holds a fixed size hash table of ``max_size`` slots. Each slot
+    holds a digest of the key, an absolute expiry time and up to
+    ``value_size`` bytes. A key may live in one of ``probes`` consecutive slots;
+    when they are all in use the one closest to expiry is evicted.
+    Access is serialized with ``flock()`` so this requires a POSIX system. A
+    process forked after the backend was created (e.g. a preforking server's
+    worker) reopens the file on first use.
+
+    :param path: file to map - required. It is created (mode 0600) if it doesn't
+        exist. Every process of the application must use the same path and
+        sizes - and different applications must not.
+    """
+
+    _MAGIC = b"FSVHC001"
+    _HEADER = struct.Struct("<8sII")
+    _SLOT_HEAD = struct.Struct("<16sdH")
+    _EMPTY = b"\0" * 16
+
+    def __init__(self, ttl, max_size, path=None, value_size=16, probes=8):
+        import fcntl
+
+        super(SharedMemoryBackend, self).__init__(ttl, max_size)
+        if not path:
+            raise ValueError("SharedMemoryBackend requires a path")
+        self._fcntl = fcntl
+        self.path = path
+        self.value_size = value_size
+        self.probes = max(1, min(probes, max_size))
+        self._slot_size = self._SLOT_HEAD.size + value_size
+        self._size = self._HEADER.size + max_size * self._slot_size
+        self._pid = None
+        self._open()
+
+    def _open(self):
+        fcntl = self._fcntl
+        header = self._HEADER.pack(self._MAGIC, self.maxsize, self._slot_size)
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX)
+            try:
+                existing = os.read(fd, self._HEADER.size)
+                if not existing.strip(b"\0"):
+                    os.ftruncate(fd, self._size)
+                    os.lseek(fd, 0, os.SEEK_SET)
+                    os.write(fd, header)
+                elif existing != header:
+                    raise ValueError(
+                        "%s is in use by a cache with different settings" % self.path
+                    )
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        except Exception:
+            os.close(fd)
+            raise
+        self._map(fd)
+
+    def _map(self, fd):
+        try:
+            self._mmap = mmap.mmap(fd, self._size)
+        except Exception:
+            os.close(fd)
+            raise
+        self._fd = fd
+        # flock() doesn't exclude threads sharing the same file descriptor.
+        # (A new one in a forked child - the parent's might be held by a
+        # thread that doesn't exist in the child.)
+        self._lock = threading.Lock()
+        self._pid = os.getpid()
+
+    def _reopen_after_fork(self):
+        # flock() locks belong to the open file description, which a forked
+        # child shares with its parent - so each process opens its own.
+        with _fork_lock:
+            if self._pid == os.getpid():
+                return
+            # The child's copies - the parent's are unaffected.
+            self._mmap.close()
+            os.close(self._fd)
+            # The parent already checked (and sized) the file.
+            self._map(os.open(self.path, os.O_RDWR))
+
+    @contextmanager
+    def _locked(self, op):
+        if self._pid != os.getpid():
+            self._reopen_after_fork()
+        with self._lock:
+            self._fcntl.flock(self._fd, op)
+            try:
+                yield
+            finally:
+                self._fcntl.flock(self._fd, self._fcntl.LOCK_UN)
+
+    def _digest(self, key):
+        return hashlib.sha256(encode_string(text_type(key))).digest()[:16]
+
+    def _offsets(self, digest):
+        start = struct.unpack("<Q", digest[:8])[0] % self.maxsize
+        for i in range(self.probes):
+            slot = (start + i) % self.maxsize
+            yield self._HEADER.size + slot * self._slot_size
+
+    def _read_head(self, offset):
+        return self._SLOT_HEAD.unpack_from(self._mmap, offset)
+
+    def get(self, key):
+        digest = self._digest(key)
+        now = time.time()
+        rv = None
+        with self._locked(self._fcntl.LOCK_SH):
+            for offset in self._offsets(digest):
+                slot_digest, expires, length = self._read_head(offset)
+                if slot_digest == digest and expires > now:
+                    start = offset + self._SLOT_HEAD.size
+                    end = start + length
+                    rv = self._mmap[start:end]
+                    break
+        self._count("hits" if rv is not None else "misses")
+        return rv
+
+    def set(self, key, value):
+        value = encode_string(value)
+        if len(value) > self.value_size:
+            raise ValueError("Value larger than %d bytes" % self.value_size)
+        digest = self._digest(key)
+        now = time.time()
+        with self._locked(self._fcntl.LOCK_EX):
+            target, target_expires = None, None
+            for offset in self._offsets(digest):
+                slot_digest, expires, _length = self._read_head(offset)
+                if slot_digest == digest or slot_digest == self._EMPTY:
+                    target, target_expires = offset, None
+                    break
+                if expires <= now:
+                    target, target_expires = offset, None
+                    self._count("evictions")
+                    break
+                if target is None or expires < target_expires:
+                    target, target_expires = offset, expires
+            if target_expires is not None:
+                self._count("evictions")
+            self._SLOT_HEAD.pack_into(
+                self._mmap, target, digest, now + self.ttl, len(value)
+            )
+            start = target + self._SLOT_HEAD.size
+            end = start + len(value)
+            self._mmap[start:end] = value
+
+    def delete(self, key):
+        digest = self._digest(key)
+        with self._locked(self._fcntl.LOCK_EX):
+            for offset in self._offsets(digest):
+                if self._read_head(offset)[0] == digest:
+                    self._SLOT_HEAD.pack_into(self._mmap, offset, self._EMPTY, 0, 0)
+
+    def clear(self):
+        with self._locked(self._fcntl.LOCK_EX):
+            start = self._HEADER.size
+            self._mmap[start:] = b"\0" * (len(self._mmap) - start)
+
+    def close(self):
+        """Unmap the file. The file itself is left for other processes."""
+        self._mmap.close()
+        os.close(self._fd)
+
+
+class KeyValueBackend(VerifyHashCacheBackend):
+    """Cache kept in an external key/value store that speaks the Redis protocol.
+
+    :param client: a client object with a redis-py compatible ``get``,
+        ``set(key, value, px=milliseconds)``, ``delete`` and ``scan_iter`` -
+        for example ``redis.Redis()``.
+    :param prefix: prepended to every key so that :meth:`clear` only removes
+        entries belonging to this cache. Applications sharing a store must use
+        different prefixes.
+
+    ``max_size`` isn't enforced - configure the store's own eviction policy.
+    """
+
+    def __init__(self, ttl, max_size, client=None, prefix="fs_vhc:"):
+        super(KeyValueBackend, self).__init__(ttl, max_size)
+        if client is None:
+            raise ValueError("KeyValueBackend requires a client")
+        self.client = client
+        self.prefix = prefix
+
+    def _key(self, key):
+        return "%s%s" % (self.prefix, key)
+
+    def get(self, key):
+        rv = self.client.get(self._key(key))
+        self._count("hits" if rv is not None else "misses")
+        return rv
+
+    def set(self, key, value):
+        # Millisecond expiry - ex=int(ttl) would be 0 (rejected) below 1s.
+        self.client.set(self._key(key), value, px=max(1, int(self.ttl * 1000)))
+
+    def delete(self, key):
+        self.client.delete(self._key(key))
+
+    def clear(self):
+        for key in self.client.scan_iter(match=self.prefix + "*"):
+            self.client.delete(key)
+
+
+class VerifyHashCacheBackendFactory(object):
+    backends = {
+        "memory": InProcessBackend,
+        "shared_memory": SharedMemoryBackend,
+        "key_value": KeyValueBackend,
+    }
+
+    @classmethod
+    def createBackend(cls, name, *args, **kwargs):
+        """ Initialize a verify hash cache backend.
+
+        :param name: Name as registered in VerifyHashCacheBackendFactory:backends
+            (e.g. 'memory')
+
+        .. versionadded:: 3.3.0
+        """
+        return cls.backends[name](*args, **kwargs)
 
 
 class VerifyHashCache:
     """Cache handler to make it quick password check by bypassing
     already checked passwords against exact same couple of token/password.
-    This cache handler is more efficient on small apps that
-    run on few processes as cache is only shared between threads."""
+
+    Where entries are kept is determined by ``SECURITY_VERIFY_HASH_CACHE_BACKEND``:
+    in this process (shared by all its threads), in shared memory (shared by
+    all processes on a host) or in an external key/value store.
+
+    .. versionchanged:: 3.3.0
+        Process-wide and thread-safe rather than one cache per thread.
+        Pluggable backends. Added :meth:`stats`.
+    """
 
     def __init__(self):
         ttl = config_value("VERIFY_HASH_CACHE_TTL", default=(60 * 5))
         max_size = config_value("VERIFY_HASH_CACHE_MAX_SIZE", default=500)
-        self._cache = TTLCache(max_size, ttl)
+        name = config_value("VERIFY_HASH_CACHE_BACKEND", default="memory")
+        options = config_value("VERIFY_HASH_CACHE_BACKEND_CONFIG", default={})
+        self.ttl = ttl
+        self.maxsize = max_size
+        self._backend = VerifyHashCacheBackendFactory.createBackend(
+            name, ttl, max_size, **options
+        )
 
     def has_verify_hash_cache(self, user):
         """Check given user id is in cache."""
-        return self._cache.get(user.id)
+        if self._backend.get(text_type(user.id)) is not None:
+            return True
+        return None
 
     def set_cache(self, user):
         """When a password is checked, then result is put in cache."""
-        self._cache[user.id] = True
+        self._backend.set(text_type(user.id), b"1")
 
     def clear(self):
         """Clear cache"""
-        self._cache.clear()
+        self._backend.clear()
+
+    def stats(self):
+        """Return a dict with the ``hits``, ``misses`` and ``evictions`` counts
+        since the cache was created."""
+        return self._backend.stats()
+
+
+class TokenAuthCache(object):
+    """Cache of successful token authentications.
+
+    Maps a digest of the raw auth token to the user's
+    :class:`.SecurityPrincipal` so that repeat requests with the same token
+    need neither deserialize the token nor query the DB.
+
+    Entries live at most ``SECURITY_TOKEN_AUTH_CACHE_TTL`` seconds and never
+    past the token's own expiry. :meth:`invalidate` drops all entries for a
+    user - it is called when a user is deactivated, changes password, roles or
+    uniquifier. Note that this only affects the process it is called in -
+    other processes keep using their entries for up to the TTL.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self):
+        ttl = config_value("TOKEN_AUTH_CACHE_TTL", default=(60 * 5))
+        max_size = config_value("TOKEN_AUTH_CACHE_MAX_SIZE", default=10000)
+        max_age = config_value("TOKEN_MAX_AGE")
+        if max_age:
+            ttl = min(ttl, max_age)
+        self.ttl = ttl
+        self._backend = InProcessBackend(ttl, max_size)
+        self._lock = threading.Lock()
+        # user id -> time of last invalidation, oldest first.
+        self._invalidated = OrderedDict()
+
+    def _key(self, token):
+        return hashlib.sha256(encode_string(token)).hexdigest()
+
+    def get(self, token):
+        """Return a :class:`.SecurityPrincipal` or None."""
+        key = self._key(token)
+        entry = self._backend.get(key)
+        if entry is None:
+            return None
+        state, created, expires = entry
+        with self._lock:
+            invalidated = self._invalidated.get(state[0])
+        if (expires is not None and expires <= time.time()) or (
+            invalidated is not None and created <= invalidated
+        ):
+            self._backend.delete(key)
+            return None
+        return SecurityPrincipal(*state)
+
+    def set(self, token, user, expires=None, loaded=None):
+        """Remember that ``token`` authenticated ``user``.
+
+        :param expires: optional absolute (``time.time()``) expiry of the token
+        :param loaded: ``time.time()`` from before ``user`` was loaded. If the
+            user has been invalidated since, nothing is cached - what was
+            loaded might predate the change.
+        """
+        state = SecurityPrincipal.from_user(user).astuple()
+        created = time.time() if loaded is None else loaded
+        with self._lock:
+            invalidated = self._invalidated.get(state[0])
+            if invalidated is not None and invalidated >= created:
+                return
+            self._backend.set(self._key(token), (state, created, expires))
+
+    def invalidate(self, user_id):
+        """Forget all tokens for ``user_id``."""
+        now = time.time()
+        with self._lock:
+            self._invalidated.pop(user_id, None)
+            self._invalidated[user_id] = now
+            # Entries older than the TTL are gone anyway.
+            while self._invalidated:
+                oldest = next(iter(self._invalidated))
+                if self._invalidated[oldest] >= now - self.ttl:
+                    break
+                del self._invalidated[oldest]
+
+    def clear(self):
+        self._backend.clear()
+
+    def stats(self):
+        return self._backend.stats()
+
+
+class AuthTokenCache(object):
+    """Cache of recently issued authentication tokens.
+
+    :meth:`get_auth_token` returns the token it last minted for a user, for up
+    to ``ttl`` seconds, rather than hashing and signing a new one each time.
+    Entries are keyed by a digest of the user's id, ``fs_uniquifier`` and
+    password hash - so changing either of the latter means a new token.
+
+    A reused token expires (per ``SECURITY_TOKEN_MAX_AGE``) up to ``ttl``
+    seconds sooner than a freshly minted one would.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, ttl=60, max_size=10000, max_age=None):
+        if max_age:
+            ttl = min(ttl, max_age)
+        self.ttl = ttl
+        self._backend = InProcessBackend(ttl, max_size)
+
+    def _key(self, user):
+        return hashlib.sha256(
+            encode_string(
+                u"%s:%s:%s"
+                % (user.id, getattr(user, "fs_uniquifier", None), user.password)
+            )
+        ).hexdigest()
+
+    def get_auth_token(self, user):
+        """Return a recently minted token for ``user`` - or mint (and
+        remember) one with ``user.get_auth_token()``."""
+        key = self._key(user)
+        token = self._backend.get(key)
+        if token is None:
+            token = user.get_auth_token()
+            self._backend.set(key, token)
+        return token
+
+    def clear(self):
+        self._backend.clear()
+
+    def stats(self):
+        return self._backend.stats()
+
+
+class SessionUserCache(object):
+    """Cache of the users of cookie sessions.
+
+    Maps a user id to the user's :class:`.SecurityPrincipal`, so that session
+    requests don't need to load the user from the DB. Each entry is
+    revalidated (reloaded) after ``ttl`` seconds, and :meth:`invalidate` drops
+    it - it is called when a user is deactivated, deleted, changes password,
+    roles or uniquifier.
+
+    ``backend`` is one of the :class:`VerifyHashCache` backends. With
+    ``memory`` (the default) entries - and invalidations - are local to the
+    process. With ``key_value`` (or ``shared_memory``, whose ``value_size``
+    must then be large enough for a JSON encoded user) they are shared - also
+    by the workers a preforking server forks after ``init_app`` created the
+    cache, as ``shared_memory`` reopens its file in each process.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, ttl=60, max_size=10000, backend="memory", backend_options=None):
+        options = dict(backend_options or {})
+        if backend == "key_value":
+            options.setdefault("prefix", "fs_suc:")
+        self.ttl = ttl
+        self._backend = VerifyHashCacheBackendFactory.createBackend(
+            backend, ttl, max_size, **options
+        )
+        # Other backends store bytes.
+        self._encode = not isinstance(self._backend, InProcessBackend)
+
+    def get(self, user_id):
+        """Return a :class:`.SecurityPrincipal` or None."""
+        state = self._backend.get(text_type(user_id))
+        if state is None:
+            return None
+        if self._encode:
+            user_id, fs_uniquifier, active, roles, permissions = json.loads(
+                state.decode("utf-8")
+            )
+            # Permission masks are per process - share the names.
+            state = (
+                user_id,
+                fs_uniquifier,
+                active,
+                frozenset(roles),
+                permission_registry.mask(permissions),
+            )
+        return SecurityPrincipal(*state)
+
+    def set(self, user):
+        """Remember ``user``."""
+        state = SecurityPrincipal.from_user(user).astuple()
+        if self._encode:
+            user_id, fs_uniquifier, active, roles, mask = state
+            state = json.dumps(
+                (
+                    user_id,
+                    fs_uniquifier,
+                    active,
+                    sorted(roles),
+                    sorted(permission_registry.names(mask)),
+                ),
+                default=text_type,
+            ).encode("utf-8")
+        self._backend.set(text_type(user.id), state)
+
+    def invalidate(self, user_id):
+        """Forget ``user_id``."""
+        self._backend.delete(text_type(user_id))
+
+    def clear(self):
+        self._backend.clear()
+
+    def stats(self):
+        return self._backend.stats()
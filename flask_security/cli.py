@@ -12,14 +12,31 @@
 
 from __future__ import absolute_import, print_function
 
-from functools import wraps
+from contextlib import contextmanager
+from functools import partial, wraps
+import csv
+import itertools
+import json
+import math
+import timeit
 
 import click
 from flask import current_app
 from werkzeug.datastructures import MultiDict
 from werkzeug.local import LocalProxy
+from wtforms.validators import StopValidation
 
-from .utils import hash_password
+from .datastore import PeeweeDatastore
+from .forms import unique_user_email
+from .hashing import _context_call
+from .utils import (
+    _hash_password_args,
+    config_value,
+    get_hmac,
+    get_identity_attributes,
+    hash_password,
+    text_type,
+)
 
 try:
     from flask.cli import with_appcontext
@@ -51,6 +68,11 @@ def roles():
     """Role commands."""
 
 
+@click.group()
+def security():
+    """Security commands."""
+
+
 @users.command("create")
 @click.argument("identity")
 @click.password_option()
@@ -75,6 +97,279 @@ def users_create(identity, password, active):
         raise click.UsageError("Error creating user. %s" % form.errors)
 
 
+_TRUE_VALUES = ("1", "true", "t", "yes", "y")
+
+
+def _read_rows(fp, fmt):
+    # Yield (line number, dict) without reading the whole file.
+    if fmt == "csv":
+        reader = csv.DictReader(fp)
+        for row in reader:
+            yield reader.line_num, dict(row)
+    else:
+        for lineno, line in enumerate(fp, 1):
+            if line.strip():
+                try:
+                    yield lineno, json.loads(line)
+                except ValueError as e:
+                    yield lineno, e
+
+
+def _batch_transaction():
+    # Peewee autocommits each statement - batches need their own transaction
+    # to be rolled back.
+    datastore = _datastore._get_current_object()
+    if isinstance(datastore, PeeweeDatastore):
+        return datastore.db.database.atomic()
+    return _no_transaction()
+
+
+@contextmanager
+def _no_transaction():
+    yield
+
+
+def _process_pool(workers):
+    # None (work in this process) if workers is 0 or there is no
+    # concurrent.futures (Python 2 without the futures package).
+    if workers == 0:
+        return None
+    try:
+        from concurrent.futures import ProcessPoolExecutor
+    except ImportError:
+        click.echo("concurrent.futures is not available - not using processes.")
+        return None
+    return ProcessPoolExecutor(max_workers=workers)
+
+
+def _hash_passwords(pool, passwords):
+    if pool is None:
+        return [hash_password(p) for p in passwords]
+    args = [_hash_password_args(p) for p in passwords]
+    if not args:
+        return []
+    # Options are the same for every password.
+    fn = partial(_context_call, _security.pwd_context.to_string(), "hash", **args[0][1])
+    chunksize = max(1, len(args) // 64)
+    return list(pool.map(fn, [a[0] for a in args], chunksize=chunksize))
+
+
+class _UserImporter(object):
+    def __init__(self, rejects):
+        self.rejects = rejects
+        self.identity_attributes = get_identity_attributes()
+        self.roles = {}
+        self.seen = set()
+        self.imported = 0
+        self.rejected = 0
+
+    def reject(self, lineno, row, error):
+        self.rejected += 1
+        if self.rejects:
+            if isinstance(row, dict):
+                row = dict(row)
+                for key in ("password", "password_hash"):
+                    if row.get(key):
+                        row[key] = "****"
+            else:
+                row = None
+            self.rejects.write(
+                json.dumps(dict(line=lineno, error=str(error), row=row)) + "\n"
+            )
+
+    def find_role(self, name):
+        if name not in self.roles:
+            self.roles[name] = _datastore.find_role(name)
+        return self.roles[name]
+
+    def validate(self, kwargs, needs_hash):
+        """Return the register form's validation errors for the row's email
+        (and plaintext password). Whether the email is already taken is checked
+        per batch (see :meth:`check_existing`), not by the form."""
+        data = dict(email=kwargs["email"])
+        if needs_hash:
+            data["password"] = kwargs["password"]
+        form = _security.confirm_register_form(MultiDict(data), meta={"csrf": False})
+        errors = []
+        for name in data:
+            field = getattr(form, name, None)
+            if field is None:
+                continue
+            for validator in field.validators:
+                if validator is unique_user_email:
+                    continue
+                try:
+                    validator(form, field)
+                except StopValidation as e:
+                    if e.args and e.args[0]:
+                        errors.append(text_type(e.args[0]))
+                    break
+                except ValueError as e:
+                    errors.append(text_type(e.args[0]))
+        return errors
+
+    def prepare(self, lineno, row):
+        """Return (line, row, needs hashing, create_user() kwargs) for a row -
+        or None if the row is rejected.
+        """
+        if not isinstance(row, dict):
+            self.reject(lineno, row, row)
+            return None
+        kwargs = dict((k, v) for k, v in row.items() if v not in (None, ""))
+        if not kwargs.get("email"):
+            self.reject(lineno, row, "Missing email")
+            return None
+        if not kwargs.get("password") and not kwargs.get("password_hash"):
+            self.reject(lineno, row, "Missing password or password_hash")
+            return None
+        needs_hash = "password_hash" not in kwargs
+        if not needs_hash:
+            if not _security.pwd_context.identify(
+                kwargs["password_hash"], required=False
+            ):
+                self.reject(lineno, row, "Unrecognized password_hash")
+                return None
+            kwargs["password"] = kwargs.pop("password_hash")
+        errors = self.validate(kwargs, needs_hash)
+        if errors:
+            self.reject(lineno, row, " ".join(errors))
+            return None
+        for attr in self.identity_attributes:
+            if attr in kwargs and (attr, kwargs[attr]) in self.seen:
+                self.reject(lineno, row, "%s %s already exists" % (attr, kwargs[attr]))
+                return None
+        roles = kwargs.get("roles", [])
+        if not isinstance(roles, list):
+            roles = [r.strip() for r in roles.split(",") if r.strip()]
+        kwargs["roles"] = []
+        for name in roles:
+            role = self.find_role(name)
+            if role is None:
+                self.reject(lineno, row, "Unknown role %s" % name)
+                return None
+            kwargs["roles"].append(role)
+        if "active" in kwargs and not isinstance(kwargs["active"], bool):
+            kwargs["active"] = str(kwargs["active"]).lower() in _TRUE_VALUES
+        for attr in self.identity_attributes:
+            if attr in kwargs:
+                self.seen.add((attr, kwargs[attr]))
+        return lineno, row, needs_hash, kwargs
+
+    def check_existing(self, batch):
+        """Reject the rows of ``batch`` whose identity attributes are already
+        taken - one lookup per attribute for the whole batch."""
+        for attr in self.identity_attributes:
+            values = [entry[3][attr] for entry in batch if attr in entry[3]]
+            if not values:
+                continue
+            existing = _datastore.existing_identities(attr, values)
+            if not existing:
+                continue
+            kept = []
+            for entry in batch:
+                value = entry[3].get(attr)
+                if value is not None and value in existing:
+                    self.reject(
+                        entry[0], entry[1], "%s %s already exists" % (attr, value)
+                    )
+                else:
+                    kept.append(entry)
+            batch = kept
+        return batch
+
+    def import_batch(self, pool, batch):
+        """Hash, create (with a single :meth:`create_users`) and commit one
+        batch. If that fails the batch is rolled back and all its rows are
+        rejected."""
+        batch = self.check_existing(batch)
+        plain = [entry[3] for entry in batch if entry[2]]
+        hashed = _hash_passwords(pool, [kwargs["password"] for kwargs in plain])
+        for kwargs, password in zip(plain, hashed):
+            kwargs["password"] = password
+        try:
+            with _batch_transaction():
+                _datastore.create_users([entry[3] for entry in batch])
+                _datastore.commit()
+        except Exception as e:
+            _datastore.rollback()
+            for entry in batch:
+                self.reject(entry[0], entry[1], "Import failed: %s" % e)
+            return
+        self.imported += len(batch)
+
+
+@users.command("import")
+@click.argument("file", type=click.File("r"))
+@click.option(
+    "-f",
+    "--format",
+    "fmt",
+    type=click.Choice(["csv", "jsonl"]),
+    help="File format - by default taken from the file extension.",
+)
+@click.option(
+    "-b", "--batch-size", default=1000, show_default=True, help="Users per commit."
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=None,
+    type=int,
+    help="Password hashing processes (default: one per CPU, 0: no processes).",
+)
+@click.option(
+    "-r",
+    "--rejects",
+    type=click.File("w"),
+    help="Write rejected rows (one JSON object per line) to this file.",
+)
+@with_appcontext
+def users_import(file, fmt, batch_size, workers, rejects):
+    """Import users from a CSV or JSON lines file.
+
+    Each row needs an ``email`` and either a plaintext ``password`` (which is
+    hashed) or a ``password_hash`` the configured passlib context recognizes
+    (which is stored as-is). An optional ``roles`` holds existing role names
+    (comma separated in CSV), and ``active`` a boolean. Other columns are
+    passed to the user model.
+
+    Emails (and plaintext passwords) are checked with the register form's
+    validators. Rows that can't be imported are skipped (and written to the
+    rejects file). Each batch is committed - if that fails it is rolled back,
+    all its rows are rejected and the import continues. Datastores without
+    transactions (MongoDB) keep the users of a failed batch created before the
+    error; re-running the import with the rejects skips those.
+    """
+    if fmt is None:
+        fmt = "jsonl" if file.name.endswith((".jsonl", ".json")) else "csv"
+    pool = _process_pool(workers)
+
+    importer = _UserImporter(rejects)
+    rows = _read_rows(file, fmt)
+    try:
+        while True:
+            chunk = list(itertools.islice(rows, batch_size))
+            if not chunk:
+                break
+            batch = []
+            for lineno, row in chunk:
+                prepared = importer.prepare(lineno, row)
+                if prepared is not None:
+                    batch.append(prepared)
+            importer.import_batch(pool, batch)
+            click.echo(
+                "Imported %d users (%d rejected)"
+                % (importer.imported, importer.rejected)
+            )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    click.secho(
+        "Imported %d users, rejected %d." % (importer.imported, importer.rejected),
+        fg="green" if not importer.rejected else "yellow",
+    )
+
+
 @roles.command("create")
 @click.argument("name")
 @click.option("-d", "--description", default=None)
@@ -163,3 +458,180 @@ def users_deactivate(user):
         click.secho('User "{0}" has been deactivated.'.format(user), fg="green")
     else:
         click.secho('User "{0}" was already deactivated.'.format(user), fg="yellow")
+
+
+@users.command("normalize-identities")
+@click.option(
+    "-b", "--batch-size", default=1000, show_default=True, help="Users per commit."
+)
+@with_appcontext
+def users_normalize_identities(batch_size):
+    """Fill in the normalized identity columns of existing users.
+
+    Run this after adding ``<attr>_normalized`` columns to the user model and
+    before setting ``SECURITY_USE_NORMALIZED_IDENTITY``.
+    """
+    try:
+        count = _datastore.normalize_identities(batch_size=batch_size)
+    except NotImplementedError:
+        raise click.UsageError("Datastore does not support normalized identities.")
+    click.secho("Normalized %d users." % count, fg="green")
+
+
+_CALIBRATION_PASSWORD = "correct horse battery staple"
+
+
+def _median_hash_time(hasher, samples):
+    times = []
+    for _ in range(samples):
+        start = timeit.default_timer()
+        hasher.hash(_CALIBRATION_PASSWORD)
+        times.append(timeit.default_timer() - start)
+    times.sort()
+    return times[len(times) // 2]
+
+
+def _hash_many(scheme, options, count):
+    # Runs in a worker process - returns its own hash rate so process startup
+    # isn't counted.
+    from passlib.registry import get_crypt_handler
+
+    hasher = get_crypt_handler(scheme).using(**options)
+    start = timeit.default_timer()
+    for _ in range(count):
+        hasher.hash(_CALIBRATION_PASSWORD)
+    return count / (timeit.default_timer() - start)
+
+
+def _scaled_rounds(handler, rounds, seconds, target):
+    if handler.rounds_cost == "log2":
+        rounds += int(round(math.log(target / seconds, 2)))
+    else:
+        rounds = int(round(rounds * target / seconds))
+    rounds = max(rounds, handler.min_rounds or 1)
+    if handler.max_rounds:
+        rounds = min(rounds, handler.max_rounds)
+    return rounds
+
+
+def _double_hashed(scheme):
+    single_hash = config_value("PASSWORD_SINGLE_HASH") or {"plaintext"}
+    return not (single_hash is True or scheme in single_hash)
+
+
+@security.command("calibrate-hash")
+@click.option(
+    "-t",
+    "--target-ms",
+    default=250.0,
+    show_default=True,
+    help="Time a single password hash should take.",
+)
+@click.option(
+    "-s",
+    "--scheme",
+    "schemes",
+    multiple=True,
+    help="Scheme to calibrate (repeatable) - default: SECURITY_PASSWORD_SCHEMES.",
+)
+@click.option(
+    "-n", "--samples", default=5, show_default=True, help="Hashes timed per scheme."
+)
+@click.option(
+    "-w",
+    "--workers",
+    default=None,
+    type=int,
+    help="Parallel hashing processes for the throughput report "
+    "(default: one per CPU, 0: no report).",
+)
+@with_appcontext
+def security_calibrate_hash(target_ms, schemes, samples, workers):
+    """Time password hashing on this machine and suggest options.
+
+    For each scheme the rounds (argon2: time cost, at its configured memory
+    cost) are scaled so one hash takes about the target time, along with the
+    HMAC added when the scheme is double hashed. The throughput report runs
+    that many hashes in parallel processes - roughly how many logins per
+    second the machine can verify.
+    """
+    from passlib.registry import get_crypt_handler
+
+    target = target_ms / 1000.0
+    all_options = config_value("PASSWORD_HASH_OPTIONS", default={})
+    if workers is None:
+        import multiprocessing
+
+        workers = multiprocessing.cpu_count()
+    # No throughput report without concurrent.futures (Python 2).
+    pool = _process_pool(workers)
+
+    suggested = {}
+    try:
+        for scheme in schemes or config_value("PASSWORD_SCHEMES"):
+            try:
+                handler = get_crypt_handler(scheme)
+            except KeyError:
+                raise click.UsageError("Unknown password scheme: %s" % scheme)
+            if "rounds" not in handler.setting_kwds:
+                click.echo("%s: fixed cost - nothing to calibrate." % scheme)
+                continue
+            if hasattr(handler, "has_backend") and not handler.has_backend():
+                click.secho("%s: no backend installed - skipped." % scheme, fg="yellow")
+                continue
+
+            options = dict(all_options.get(scheme, {}))
+            rounds = options.get("rounds", handler.default_rounds)
+            seconds = _median_hash_time(
+                handler.using(**dict(options, rounds=rounds)), samples
+            )
+            options["rounds"] = _scaled_rounds(handler, rounds, seconds, target)
+            calibrated = _median_hash_time(handler.using(**options), samples)
+            suggested[scheme] = options
+
+            line = "%s: rounds=%d takes %.1f ms; rounds=%d takes %.1f ms" % (
+                scheme,
+                rounds,
+                seconds * 1000,
+                options["rounds"],
+                calibrated * 1000,
+            )
+            if "memory_cost" in handler.setting_kwds:
+                line += " (memory_cost=%d KiB)" % options.get(
+                    "memory_cost", handler.memory_cost
+                )
+            if _double_hashed(scheme) and _security.password_salt is not None:
+                number = 1000
+                hmac_seconds = (
+                    timeit.timeit(
+                        lambda: get_hmac(_CALIBRATION_PASSWORD), number=number
+                    )
+                    / number
+                )
+                line += " + %.3f ms HMAC" % (hmac_seconds * 1000)
+            click.echo(line)
+
+            if pool is not None:
+                count = max(3, int(1.0 / calibrated))
+                rates = list(
+                    pool.map(
+                        _hash_many,
+                        [scheme] * workers,
+                        [options] * workers,
+                        [count] * workers,
+                    )
+                )
+                click.echo(
+                    "    %.1f hashes/s with %d processes (%.1f per process)"
+                    % (sum(rates), workers, sum(rates) / workers)
+                )
+    finally:
+        if pool is not None:
+            pool.shutdown()
+
+    if suggested:
+        click.secho(
+            "SECURITY_PASSWORD_HASH_OPTIONS = %s"
+            % json.dumps(suggested, sort_keys=True),
+            fg="green",
+        )
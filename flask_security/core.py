@@ -12,7 +12,10 @@
     :license: MIT, see LICENSE for more details.
 """
 
+import calendar
 from datetime import datetime
+import threading
+import time
 import warnings
 import sys
 
@@ -26,7 +29,7 @@ from flask_principal import Identity, Principal, RoleNeed, UserNeed, identity_lo
 from itsdangerous import URLSafeTimedSerializer
 from passlib.context import CryptContext
 from werkzeug.datastructures import ImmutableList
-from werkzeug.local import LocalProxy, Local
+from werkzeug.local import LocalProxy
 
 from .twofactor import tf_setup
 from .decorators import default_unauthn_handler, default_unauthz_handler
@@ -47,11 +50,12 @@ from .forms import (
 from .utils import _
 from .utils import config_value as cv
 from .utils import (
+    _user_provides,
     FsJsonEncoder,
     FsPermNeed,
+    SecurityConfig,
     csrf_cookie_handler,
     default_want_json,
-    get_config,
     hash_data,
     localize_callback,
     send_mail,
@@ -61,11 +65,19 @@ from .utils import (
     verify_hash,
 )
 from .views import create_blueprint, default_render_json
-from .cache import VerifyHashCache
+from .cache import AuthTokenCache, SessionUserCache, TokenAuthCache, VerifyHashCache
+from .hashing import HMAC_SHA256, DeferredRehasher
+from .hashing import _derive_hmac_key, _hmac_sha256_handler
+from .instrumentation import PhaseHistograms, _record_phase_timings, phase
+from .mailqueue import MailDispatcher
+from .permissions import permission_registry
+from .principal import SecurityPrincipal
+from .signals import password_changed, password_reset, user_auth_changed
+from .trackable import TrackableBuffer
 
 # Convenient references
 _security = LocalProxy(lambda: current_app.extensions["security"])
-local_cache = Local()
+_cache_lock = threading.Lock()
 
 # List of authentication mechanisms supported.
 AUTHN_MECHANISMS = ("basic", "session", "token")
@@ -76,6 +88,7 @@ _default_config = {
     "BLUEPRINT_NAME": "security",
     "CLI_ROLES_NAME": "roles",
     "CLI_USERS_NAME": "users",
+    "CLI_SECURITY_NAME": "security",
     "URL_PREFIX": None,
     "SUBDOMAIN": None,
     "FLASH_MESSAGES": True,
@@ -143,6 +156,9 @@ _default_config = {
     "REGISTERABLE": False,
     "RECOVERABLE": False,
     "TRACKABLE": False,
+    "TRACKABLE_WRITE_BEHIND": False,
+    "TRACKABLE_FLUSH_INTERVAL": 5.0,
+    "TRACKABLE_FLUSH_SIZE": 1000,
     "PASSWORDLESS": False,
     "CHANGEABLE": False,
     "TWO_FACTOR": False,
@@ -183,12 +199,40 @@ _default_config = {
     "EMAIL_SUBJECT_TWO_FACTOR": _("Two-factor Login"),
     "EMAIL_SUBJECT_TWO_FACTOR_RESCUE": _("Two-factor Rescue"),
     "USER_IDENTITY_ATTRIBUTES": ["email"],
-    "HASHING_SCHEMES": ["sha256_crypt", "hex_md5"],
-    "DEPRECATED_HASHING_SCHEMES": ["hex_md5"],
+    "HASHING_SCHEMES": ["hmac_sha256", "sha256_crypt", "hex_md5"],
+    "DEPRECATED_HASHING_SCHEMES": ["sha256_crypt", "hex_md5"],
+    "HASHING_SALT": "hashing-salt",
     "DATETIME_FACTORY": datetime.utcnow,
     "USE_VERIFY_PASSWORD_CACHE": False,
     "VERIFY_HASH_CACHE_TTL": 60 * 5,
     "VERIFY_HASH_CACHE_MAX_SIZE": 500,
+    "VERIFY_HASH_CACHE_BACKEND": "memory",
+    "VERIFY_HASH_CACHE_BACKEND_CONFIG": {},
+    "USE_TOKEN_AUTH_CACHE": False,
+    "TOKEN_AUTH_CACHE_TTL": 60 * 5,
+    "TOKEN_AUTH_CACHE_MAX_SIZE": 10000,
+    "LIGHTWEIGHT_IDENTITY": False,
+    "USE_AUTH_TOKEN_CACHE": False,
+    "AUTH_TOKEN_CACHE_TTL": 60,
+    "AUTH_TOKEN_CACHE_MAX_SIZE": 10000,
+    "USE_SESSION_USER_CACHE": False,
+    "SESSION_USER_CACHE_TTL": 60,
+    "SESSION_USER_CACHE_MAX_SIZE": 10000,
+    "SESSION_USER_CACHE_BACKEND": "memory",
+    "SESSION_USER_CACHE_BACKEND_CONFIG": {},
+    "HASHING_EXECUTOR": None,
+    "HASHING_EXECUTOR_WORKERS": 4,
+    "HASHING_EXECUTOR_QUEUE_SIZE": 16,
+    "DEFERRED_REHASH": False,
+    "DEFERRED_REHASH_QUEUE_SIZE": 1000,
+    "SEND_MAIL_ASYNC": False,
+    "MAIL_QUEUE_SIZE": 1000,
+    "MAIL_WORKERS": 1,
+    "MAIL_RETRIES": 3,
+    "MAIL_RETRY_BACKOFF": 1.0,
+    "MAIL_IDLE_TIMEOUT": 5.0,
+    "PHASE_TIMING": False,
+    "USE_NORMALIZED_IDENTITY": False,
     "TWO_FACTOR_REQUIRED": False,
     "TWO_FACTOR_SECRET": None,
     "TWO_FACTOR_ENABLED_METHODS": ["mail", "google_authenticator", "sms"],
@@ -291,6 +335,10 @@ _default_messages = {
         _("You can only access this endpoint when not logged in."),
         "error",
     ),
+    "PASSWORD_HASHING_BUSY": (
+        _("The server is too busy to check passwords right now. Please try again."),
+        "error",
+    ),
     "TWO_FACTOR_INVALID_TOKEN": (_("Invalid Token"), "error"),
     "TWO_FACTOR_LOGIN_SUCCESSFUL": (_("Your token has been confirmed"), "success"),
     "TWO_FACTOR_CHANGE_METHOD_SUCCESSFUL": (
@@ -333,12 +381,41 @@ _default_forms = {
 
 
 def _user_loader(user_id):
-    user = _security.datastore.find_user(id=user_id)
+    cache = _security.session_user_cache
+    if cache is not None:
+        principal = cache.get(user_id)
+        if principal is not None:
+            return principal
+    with phase("datastore_lookup"):
+        user = _security.datastore.find_auth_user(id=user_id)
     if not user or not user.active:
         return None
+    if cache is not None:
+        cache.set(user)
     return user
 
 
+def _get_cache(name, factory):
+    # One cache per application, shared by all threads in this process.
+    state = _security._get_current_object()
+    cache = getattr(state, name, None)
+    if cache is None:
+        with _cache_lock:
+            cache = getattr(state, name, None)
+            if cache is None:
+                cache = factory()
+                setattr(state, name, cache)
+    return cache
+
+
+def _get_verify_hash_cache():
+    return _get_cache("_verify_hash_cache", VerifyHashCache)
+
+
+def _get_token_auth_cache():
+    return _get_cache("_token_auth_cache", TokenAuthCache)
+
+
 def _request_loader(request):
     # Short-circuit if we have already been called and verified.
     # This can happen since Flask-Login will call us (if no session) and our own
@@ -359,12 +436,30 @@ def _request_loader(request):
             token = data.get(args_key, token)
 
     use_cache = cv("USE_VERIFY_PASSWORD_CACHE")
+    token_cache = None
+    if token and cv("USE_TOKEN_AUTH_CACHE"):
+        token_cache = _get_token_auth_cache()
+        principal = token_cache.get(token)
+        if principal is not None:
+            _request_ctx_stack.top.fs_authn_via = "token"
+            return principal
 
+    expires = None
+    # Before the user is loaded - see TokenAuthCache.set
+    loaded = time.time()
     try:
-        data = _security.remember_token_serializer.loads(
-            token, max_age=_security.token_max_age
-        )
-        user = _security.datastore.find_user(id=data[0])
+        with phase("token_decode"):
+            if token_cache is not None and _security.token_max_age:
+                data, ts = _security.remember_token_serializer.loads(
+                    token, max_age=_security.token_max_age, return_timestamp=True
+                )
+                expires = calendar.timegm(ts.utctimetuple()) + _security.token_max_age
+            else:
+                data = _security.remember_token_serializer.loads(
+                    token, max_age=_security.token_max_age
+                )
+        with phase("datastore_lookup"):
+            user = _security.datastore.find_auth_user(id=data[0])
         if not user.active:
             user = None
     except Exception:
@@ -372,26 +467,35 @@ def _request_loader(request):
 
     if not user:
         return _security.login_manager.anonymous_user()
-    if use_cache:
-        cache = getattr(local_cache, "verify_hash_cache", None)
-        if cache is None:
-            cache = VerifyHashCache()
-            local_cache.verify_hash_cache = cache
-        if cache.has_verify_hash_cache(user):
-            _request_ctx_stack.top.fs_authn_via = "token"
-            return user
-        if user.verify_auth_token(data):
-            _request_ctx_stack.top.fs_authn_via = "token"
-            cache.set_cache(user)
-            return user
-    else:
-        if user.verify_auth_token(data):
-            _request_ctx_stack.top.fs_authn_via = "token"
-            return user
+    verified = False
+    with phase("hash_verify"):
+        if use_cache:
+            cache = _get_verify_hash_cache()
+            if cache.has_verify_hash_cache(user):
+                verified = True
+            elif user.verify_auth_token(data):
+                verified = True
+                cache.set_cache(user)
+        else:
+            verified = user.verify_auth_token(data)
 
+    if verified:
+        _request_ctx_stack.top.fs_authn_via = "token"
+        if token_cache is not None:
+            token_cache.set(token, user, expires, loaded=loaded)
+        return user
     return _security.login_manager.anonymous_user()
 
 
+def _on_user_auth_changed(sender, user, **kwargs):
+    # Cached authentications for this user might no longer be valid.
+    token_cache = getattr(_security, "_token_auth_cache", None)
+    if token_cache is not None:
+        token_cache.invalidate(user.id)
+    if _security.session_user_cache is not None:
+        _security.session_user_cache.invalidate(user.id)
+
+
 def _identity_loader():
     if not isinstance(current_user._get_current_object(), AnonymousUserMixin):
         identity = Identity(current_user.id)
@@ -399,15 +503,20 @@ def _identity_loader():
 
 
 def _on_identity_loaded(sender, identity):
-    if hasattr(current_user, "id"):
-        identity.provides.add(UserNeed(current_user.id))
+    with phase("identity_load"):
+        if hasattr(current_user, "id"):
+            identity.provides.add(UserNeed(current_user.id))
 
-    for role in getattr(current_user, "roles", []):
-        identity.provides.add(RoleNeed(role.name))
-        for fsperm in role.get_permissions():
-            identity.provides.add(FsPermNeed(fsperm))
+        user = current_user._get_current_object()
+        if _security.lightweight_identity or isinstance(user, SecurityPrincipal):
+            identity.provides.update(_user_provides(_security, user))
+        else:
+            for role in getattr(user, "roles", []):
+                identity.provides.add(RoleNeed(role.name))
+                for fsperm in permission_registry.role_permissions(role):
+                    identity.provides.add(FsPermNeed(fsperm))
 
-    identity.user = current_user
+        identity.user = current_user
 
 
 def _get_login_manager(app, anonymous_user):
@@ -458,7 +567,26 @@ def _get_i18n_domain(app):
 
 def _get_hashing_context(app):
     schemes = cv("HASHING_SCHEMES", app=app)
-    deprecated = cv("DEPRECATED_HASHING_SCHEMES", app=app)
+    # The first scheme is the one new data is hashed with - so it can't be
+    # deprecated even if (as with the default) it is listed as such.
+    deprecated = [
+        s for s in cv("DEPRECATED_HASHING_SCHEMES", app=app) if s != schemes[0]
+    ]
+    if HMAC_SHA256 in schemes:
+        salt = cv("HASHING_SALT", app=app)
+
+        def get_key():
+            # On first use - SECRET_KEY may be set after init_app.
+            secret_key = app.config.get("SECRET_KEY")
+            if not secret_key:
+                raise ValueError(
+                    "The hashing scheme %s needs the application's SECRET_KEY"
+                    % HMAC_SHA256
+                )
+            return _derive_hmac_key(secret_key, salt)
+
+        handler = _hmac_sha256_handler(get_key)
+        schemes = [handler if s == HMAC_SHA256 else s for s in schemes]
     return CryptContext(schemes=schemes, deprecated=deprecated)
 
 
@@ -469,12 +597,14 @@ def _get_serializer(app, name):
 
 
 def _get_state(app, datastore, anonymous_user=None, **kwargs):
-    for key, value in get_config(app).items():
+    config = SecurityConfig(app)
+    for key, value in config.items():
         kwargs[key.lower()] = value
 
     kwargs.update(
         dict(
             app=app,
+            _config=config,
             datastore=datastore,
             principal=_get_principal(app),
             pwd_context=_get_pwd_context(app),
@@ -486,6 +616,17 @@ def _get_state(app, datastore, anonymous_user=None, **kwargs):
             confirm_serializer=_get_serializer(app, "confirm"),
             _context_processors={},
             _send_mail_task=None,
+            _verify_hash_cache=None,
+            _token_auth_cache=None,
+            _role_provides_cache={},
+            _identity_hooked=None,
+            _hashing_executor=None,
+            mail_dispatcher=None,
+            trackable_buffer=None,
+            deferred_rehasher=None,
+            auth_token_cache=None,
+            session_user_cache=None,
+            phase_histograms=PhaseHistograms(),
             _unauthorized_callback=None,
             _render_json=default_render_json,
             _want_json=default_want_json,
@@ -634,11 +775,11 @@ class UserMixin(BaseUserMixin):
         .. versionadded:: 3.3.0
 
         """
+        mask = 0
         for role in self.roles:
             if hasattr(role, "permissions"):
-                if permission in role.get_permissions():
-                    return True
-        return False
+                mask |= permission_registry.role_mask(role)
+        return bool(mask & permission_registry.lookup(permission))
 
     def get_security_payload(self):
         """Serialize user object as response payload."""
@@ -760,6 +901,82 @@ class _SecurityState(object):
     def unauthn_handler(self, cb):
         self._unauthn_handler = cb
 
+    def refresh_config(self):
+        old, self._config = self._config, SecurityConfig(self.app)
+        for key, value in self._config.items():
+            # Only update attributes that came from config - not ones such as
+            # i18n_domain that were replaced by the real object at init time.
+            name = key.lower()
+            if key not in old or getattr(self, name, None) is old[key]:
+                setattr(self, name, value)
+        app = self.app
+        self.pwd_context = _get_pwd_context(app)
+        self.hashing_context = _get_hashing_context(app)
+        for name in ("remember", "login", "reset", "confirm"):
+            setattr(self, "%s_serializer" % name, _get_serializer(app, name))
+        self._role_provides_cache = {}
+        # Rebuilt on next use with the (possibly) new TTL and size.
+        self._verify_hash_cache = None
+        self._token_auth_cache = None
+        if self._hashing_executor:
+            self._hashing_executor.shutdown(wait=False)
+            self._hashing_executor = None
+        self._stop_workers()
+        self._start_workers()
+
+    def _start_workers(self):
+        # The optional caches and background workers - per the configuration.
+        app = self.app
+        self.mail_dispatcher = None
+        if cv("SEND_MAIL_ASYNC", app=app):
+            self.mail_dispatcher = MailDispatcher(
+                app,
+                queue_size=cv("MAIL_QUEUE_SIZE", app=app),
+                workers=cv("MAIL_WORKERS", app=app),
+                retries=cv("MAIL_RETRIES", app=app),
+                backoff=cv("MAIL_RETRY_BACKOFF", app=app),
+                idle_timeout=cv("MAIL_IDLE_TIMEOUT", app=app),
+            )
+
+        self.deferred_rehasher = None
+        if cv("DEFERRED_REHASH", app=app):
+            self.deferred_rehasher = DeferredRehasher(
+                app, queue_size=cv("DEFERRED_REHASH_QUEUE_SIZE", app=app)
+            )
+
+        self.session_user_cache = None
+        if cv("USE_SESSION_USER_CACHE", app=app):
+            self.session_user_cache = SessionUserCache(
+                ttl=cv("SESSION_USER_CACHE_TTL", app=app),
+                max_size=cv("SESSION_USER_CACHE_MAX_SIZE", app=app),
+                backend=cv("SESSION_USER_CACHE_BACKEND", app=app),
+                backend_options=cv("SESSION_USER_CACHE_BACKEND_CONFIG", app=app),
+            )
+
+        self.auth_token_cache = None
+        if cv("USE_AUTH_TOKEN_CACHE", app=app):
+            self.auth_token_cache = AuthTokenCache(
+                ttl=cv("AUTH_TOKEN_CACHE_TTL", app=app),
+                max_size=cv("AUTH_TOKEN_CACHE_MAX_SIZE", app=app),
+                max_age=cv("TOKEN_MAX_AGE", app=app),
+            )
+
+        self.trackable_buffer = None
+        if cv("TRACKABLE", app=app) and cv("TRACKABLE_WRITE_BEHIND", app=app):
+            self.trackable_buffer = TrackableBuffer(
+                app,
+                interval=cv("TRACKABLE_FLUSH_INTERVAL", app=app),
+                max_size=cv("TRACKABLE_FLUSH_SIZE", app=app),
+            )
+
+    def _stop_workers(self):
+        # What is queued is still sent or written.
+        for worker in (self.mail_dispatcher, self.deferred_rehasher):
+            if worker is not None:
+                worker.shutdown()
+        if self.trackable_buffer is not None:
+            self.trackable_buffer.shutdown()
+
 
 class Security(object):
     """The :class:`Security` class initializes the Flask-Security extension.
@@ -835,9 +1052,17 @@ class Security(object):
             app.config.setdefault("SECURITY_MSG_" + key, value)
 
         identity_loaded.connect_via(app)(_on_identity_loaded)
+        if _record_phase_timings not in app.teardown_request_funcs.get(None, ()):
+            app.teardown_request(_record_phase_timings)
+        for signal in (user_auth_changed, password_changed, password_reset):
+            signal.connect_via(app)(_on_user_auth_changed)
 
+        # Don't let a previous initialization's config snapshot leak into this one.
+        app.extensions.pop("security", None)
         self._state = state = _get_state(app, datastore, **kwargs)
 
+        state._start_workers()
+
         if register_blueprint:
             bp = create_blueprint(
                 state, __name__, json_encoder=kwargs["json_encoder_cls"]
@@ -908,12 +1133,14 @@ class Security(object):
         app.extensions["security"] = state
 
         if hasattr(app, "cli"):
-            from .cli import users, roles
+            from .cli import users, roles, security
 
             if state.cli_users_name:
                 app.cli.add_command(users, state.cli_users_name)
             if state.cli_roles_name:
                 app.cli.add_command(roles, state.cli_roles_name)
+            if state.cli_security_name:
+                app.cli.add_command(security, state.cli_security_name)
 
         # Two factor configuration checks and setup
         if cv("TWO_FACTOR", app=app):
@@ -962,7 +1189,8 @@ class Security(object):
         return module_exists
 
     def render_template(self, *args, **kwargs):
-        return render_template(*args, **kwargs)
+        with phase("template_render"):
+            return render_template(*args, **kwargs)
 
     def send_mail(self, *args, **kwargs):
         return send_mail(*args, **kwargs)
@@ -1055,5 +1283,27 @@ class Security(object):
         """
         self._state._unauthn_handler = cb
 
+    def refresh_config(self):
+        """
+        Rebuild the configuration snapshot taken by :meth:`init_app`.
+
+        Flask-Security reads its ``SECURITY_`` settings once at initialization.
+        Applications that change any of them at runtime must call this so that
+        the new values are used.
+
+        Along with the settings themselves this rebuilds the password and
+        hashing contexts, the token serializers, the verify password and
+        token caches, the session user and auth token caches, the hashing
+        executor, the mail dispatcher, the deferred rehasher and the trackable
+        write-behind buffer (the old workers send or write what they have
+        queued first). It does not re-register the blueprint, views, login
+        manager or forms - settings they use at registration (such as URLs)
+        need a new :meth:`init_app`. The process wide
+        :data:`.permission_registry` has no settings.
+
+        .. versionadded:: 3.3.0
+        """
+        self._state.refresh_config()
+
     def __getattr__(self, name):
         return getattr(self._state, name, None)
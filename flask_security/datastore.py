@@ -11,7 +11,43 @@
 """
 import uuid
 
-from .utils import get_identity_attributes, string_types
+from .signals import user_auth_changed
+from .utils import (
+    NORMALIZED_SUFFIX,
+    config_value,
+    get_identity_attributes,
+    normalize_identity,
+    string_types,
+)
+
+
+def _unwrap(model):
+    # Stand-ins such as SecurityPrincipal know their model.
+    load = getattr(model, "_fs_load", None)
+    return load() if load is not None else model
+
+
+def _prepare_put(datastore, model):
+    # Unwrap, and bring a user's normalized identity columns up to date.
+    model = _unwrap(model)
+    normalize = getattr(datastore, "_normalize_model", None)
+    if normalize is not None:
+        normalize(model)
+    return model
+
+
+def _chunks(items, size=400):
+    # Keeps statements under database parameter limits (999 for SQLite).
+    for start in range(0, len(items), size):
+        end = start + size
+        yield items[start:end]
+
+
+def _send_user_auth_changed(user):
+    from flask import current_app, has_app_context
+
+    if has_app_context():
+        user_auth_changed.send(current_app._get_current_object(), user=user)
 
 
 class Datastore(object):
@@ -21,6 +57,13 @@ class Datastore(object):
     def commit(self):
         pass
 
+    def rollback(self):
+        """Discard uncommitted changes - where the datastore has transactions.
+
+        .. versionadded:: 3.3.0
+        """
+        pass
+
     def put(self, model):
         raise NotImplementedError
 
@@ -32,86 +75,113 @@ class SQLAlchemyDatastore(Datastore):
     def commit(self):
         self.db.session.commit()
 
+    def rollback(self):
+        self.db.session.rollback()
+
     def put(self, model):
+        model = _prepare_put(self, model)
         self.db.session.add(model)
         return model
 
     def delete(self, model):
-        self.db.session.delete(model)
+        self.db.session.delete(_unwrap(model))
 
 
 class MongoEngineDatastore(Datastore):
     def put(self, model):
+        model = _prepare_put(self, model)
         model.save()
         return model
 
     def delete(self, model):
-        model.delete()
+        _unwrap(model).delete()
 
 
 class PeeweeDatastore(Datastore):
     def put(self, model):
+        model = _prepare_put(self, model)
         model.save()
         return model
 
     def delete(self, model):
-        model.delete_instance(recursive=True)
+        _unwrap(model).delete_instance(recursive=True)
 
 
-def with_pony_session(f):
-    from functools import wraps
+def _pony_session_owner():
+    # The innermost context - a request if there is one.
+    from flask import _app_ctx_stack, _request_ctx_stack
 
-    @wraps(f)
-    def decorator(*args, **kwargs):
+    return _request_ctx_stack.top or _app_ctx_stack.top
+
+
+def _end_pony_session(ctx, exc):
+    if ctx is not None and ctx.__dict__.pop("_fs_pony_session", False):
         from pony.orm import db_session
-        from pony.orm.core import local
-        from flask import (
-            after_this_request,
-            current_app,
-            has_app_context,
-            has_request_context,
-        )
-        from flask.signals import appcontext_popped
 
-        register = local.db_context_counter == 0
-        if register and (has_app_context() or has_request_context()):
-            db_session.__enter__()
+        # Commits - or rolls back if the request failed.
+        if exc is None:
+            db_session.__exit__()
+        else:
+            db_session.__exit__(type(exc), exc, None)
 
-        result = f(*args, **kwargs)
 
-        if register:
-            if has_request_context():
+def _on_request_tearing_down(sender, exc=None, **kwargs):
+    from flask import _request_ctx_stack
 
-                @after_this_request
-                def pop(request):
-                    db_session.__exit__()
-                    return request
+    _end_pony_session(_request_ctx_stack.top, exc)
 
-            elif has_app_context():
 
-                @appcontext_popped.connect_via(current_app._get_current_object())
-                def pop(sender, *args, **kwargs):
-                    while local.db_context_counter:
-                        db_session.__exit__()
+def _on_appcontext_tearing_down(sender, exc=None, **kwargs):
+    from flask import _app_ctx_stack
 
-            else:
+    _end_pony_session(_app_ctx_stack.top, exc)
+
+
+def with_pony_session(f):
+    """Runs ``f`` in a Pony ``db_session``.
+
+    If none is active one is started, and lasts until the request (or the
+    application context outside of requests) is torn down - so all datastore
+    calls made while handling a request share one transaction and cache.
+    """
+    from functools import wraps
+
+    @wraps(f)
+    def decorator(*args, **kwargs):
+        from pony.orm.core import db_session, local
+
+        if not local.db_context_counter:
+            owner = _pony_session_owner()
+            if owner is None:
                 raise RuntimeError("Needs app or request context")
-        return result
+            db_session.__enter__()
+            owner._fs_pony_session = True
+        return f(*args, **kwargs)
 
     return decorator
 
 
 class PonyDatastore(Datastore):
+    def __init__(self, db):
+        from flask.signals import appcontext_tearing_down, request_tearing_down
+
+        Datastore.__init__(self, db)
+        request_tearing_down.connect(_on_request_tearing_down)
+        appcontext_tearing_down.connect(_on_appcontext_tearing_down)
+
     def commit(self):
         self.db.commit()
 
+    def rollback(self):
+        self.db.rollback()
+
     @with_pony_session
     def put(self, model):
-        return model
+        return _prepare_put(self, model)
 
     @with_pony_session
     def delete(self, model):
-        model.delete()
+        _unwrap(model).delete()
 
 
 class UserDatastore(object):
@@ -129,26 +199,106 @@ class UserDatastore(object):
     def __init__(self, user_model, role_model):
         self.user_model = user_model
         self.role_model = role_model
+        self._normalized = None
 
     def _prepare_role_modify_args(self, user, role):
         if isinstance(user, string_types):
             user = self.find_user(email=user)
+        user = _unwrap(user)
         if isinstance(role, string_types):
             role = self.find_role(role)
         return user, role
 
-    def _prepare_create_user_args(self, **kwargs):
+    def _prepare_role(self, role):
+        if isinstance(role, string_types):
+            role = self.find_role(role)
+        return role
+
+    def _users_by_id(self, users):
+        return dict((user.id, user) for user in map(_unwrap, users))
+
+    def _send_bulk_changed(self, users_by_id, ids):
+        for user_id in ids:
+            _send_user_auth_changed(users_by_id[user_id])
+
+    def _prepare_create_user_args(self, _role_cache=None, **kwargs):
         kwargs.setdefault("active", True)
         roles = kwargs.get("roles", [])
+        # create_users looks each role up once, whatever the number of users.
+        role_cache = {} if _role_cache is None else _role_cache
         for i, role in enumerate(roles):
             rn = role.name if isinstance(role, self.role_model) else role
             # see if the role exists
-            roles[i] = self.find_role(rn)
+            if rn not in role_cache:
+                role_cache[rn] = self.find_role(rn)
+            roles[i] = role_cache[rn]
         kwargs["roles"] = roles
         if hasattr(self.user_model, "fs_uniquifier"):
             kwargs.setdefault("fs_uniquifier", uuid.uuid4().hex)
+        for attr, normalized in self._normalized_attributes():
+            if attr in kwargs:
+                kwargs.setdefault(normalized, normalize_identity(kwargs[attr]))
         return kwargs
 
+    def _prepare_bulk_create(self, users):
+        # The create_user arguments of each user, keyed by fs_uniquifier - and
+        # grouped by argument names, as multi-row INSERTs need the same columns
+        # in every row.
+        role_cache = {}
+        order, roles, groups = [], {}, {}
+        for kwargs in users:
+            kwargs = self._prepare_create_user_args(role_cache, **kwargs)
+            key = kwargs["fs_uniquifier"]
+            order.append(key)
+            roles[key] = kwargs.pop("roles")
+            groups.setdefault(tuple(sorted(kwargs)), []).append(kwargs)
+        return order, roles, groups
+
+    def _normalized_attributes(self):
+        """(attribute, normalized attribute) pairs the user model has."""
+        if self._normalized is None:
+            self._normalized = [
+                (name[: -len(NORMALIZED_SUFFIX)], name)
+                for name in dir(self.user_model)
+                if name.endswith(NORMALIZED_SUFFIX)
+                and hasattr(self.user_model, name[: -len(NORMALIZED_SUFFIX)])
+            ]
+        return self._normalized
+
+    def _normalized_column(self, attr):
+        """The normalized column to look up ``attr`` in - or None."""
+        if config_value("USE_NORMALIZED_IDENTITY"):
+            return getattr(self.user_model, attr + NORMALIZED_SUFFIX, None)
+        return None
+
+    def normalize_identities(self, batch_size=1000):
+        """Fill in the ``<attr>_normalized`` columns of all existing users.
+
+        Run this (see the ``users normalize-identities`` command) after adding
+        normalized columns to the user model and before enabling
+        ``SECURITY_USE_NORMALIZED_IDENTITY``. Changes are committed every
+        ``batch_size`` users.
+
+        :return: The number of users that were updated.
+        """
+        raise NotImplementedError
+
+    def _normalize_model(self, model):
+        # Called by put() - so identity changes saved through the datastore
+        # keep the normalized columns current.
+        if self._normalized_attributes() and isinstance(model, self.user_model):
+            self._normalize_user(model)
+
+    def _normalize_user(self, user):
+        # Returns True if any normalized value had to be changed.
+        changed = False
+        for attr, normalized in self._normalized_attributes():
+            value = normalize_identity(getattr(user, attr))
+            if getattr(user, normalized) != value:
+                setattr(user, normalized, value)
+                changed = True
+        return changed
+
     def _is_numeric(self, value):
         try:
             int(value)
@@ -167,6 +317,24 @@ class UserDatastore(object):
         """Returns a user matching the provided parameters."""
         raise NotImplementedError
 
+    def existing_identities(self, attr, values):
+        """Returns the set of ``values`` for which a user exists whose ``attr``
+        matches (as :meth:`find_user` would) - with as few queries as the
+        datastore allows.
+
+        .. versionadded:: 3.3.0
+        """
+        return set(v for v in values if self.find_user(**{attr: v}) is not None)
+
+    def find_auth_user(self, **kwargs):
+        """Returns a user matching the provided parameters, for authenticating
+        a request - the session and token loaders use this rather than
+        :meth:`find_user`, so a datastore can load less of the user for them.
+
+        .. versionadded:: 3.3.0
+        """
+        return self.find_user(**kwargs)
+
     def find_role(self, *args, **kwargs):
         """Returns a role matching the provided name."""
         raise NotImplementedError
@@ -182,6 +350,7 @@ class UserDatastore(object):
         if role not in user.roles:
             user.roles.append(role)
             self.put(user)
+            _send_user_auth_changed(user)
             return True
         return False
 
@@ -198,12 +367,14 @@ class UserDatastore(object):
             rv = True
             user.roles.remove(role)
             self.put(user)
+            _send_user_auth_changed(user)
         return rv
 
     def toggle_active(self, user):
         """Toggles a user's active status. Always returns True."""
         user.active = not user.active
         self.put(user)
+        _send_user_auth_changed(user)
         return True
 
     def deactivate_user(self, user):
@@ -218,6 +389,7 @@ class UserDatastore(object):
         if user.active:
             user.active = False
             self.put(user)
+            _send_user_auth_changed(user)
             return True
         return False
 
@@ -250,6 +422,7 @@ class UserDatastore(object):
             uniquifier = uuid.uuid4().hex
         user.fs_uniquifier = uniquifier
         self.put(user)
+        _send_user_auth_changed(user)
 
     def create_role(self, **kwargs):
         """
@@ -308,6 +481,116 @@ class UserDatastore(object):
         :param user: The user to delete
         """
         self.delete(user)
+        _send_user_auth_changed(user)
+
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        """Replaces the password hash of the user with ``user_id`` - but only
+        if it is still ``old_hash`` - and sends ``user_auth_changed``. Used by
+        :class:`.DeferredRehasher`.
+
+        This implementation is a read-modify-write, so a hash changed between
+        the read and the write is overwritten - the bundled datastores override
+        it with a conditional update (or, for Pony, a locked read).
+
+        :return: ``True`` if the hash was replaced
+
+        .. versionadded:: 3.3.0
+        """
+        user = self.get_user(user_id)
+        if user is None or user.password != old_hash:
+            return False
+        user.password = new_hash
+        self.put(user)
+        _send_user_auth_changed(user)
+        return True
+
+    def update_login_stats(self, user_id, count, **fields):
+        """Sets the given trackable ``fields`` of the user with ``user_id`` and
+        adds ``count`` to its ``login_count``. Used by
+        :class:`.TrackableBuffer`. This implementation is a read-modify-write -
+        the bundled datastores override it with an atomic update (or, for Pony,
+        a locked read).
+
+        .. versionadded:: 3.3.0
+        """
+        user = self.get_user(user_id)
+        if user is None:
+            return
+        for name, value in fields.items():
+            setattr(user, name, value)
+        user.login_count = (user.login_count or 0) + count
+        self.put(user)
+
+    def create_users(self, users):
+        """Creates users from an iterable of :meth:`create_user` keyword
+        argument dicts and returns them (as a list).
+
+        MongoEngine inserts all the users at once. SQLAlchemy and Peewee insert
+        a batch of rows at a time if the user model has ``fs_uniquifier`` (to
+        find the new rows by), and a row at a time otherwise.
+
+        .. versionadded:: 3.3.0
+        """
+        role_cache = {}
+        created = []
+        for kwargs in users:
+            kwargs = self._prepare_create_user_args(role_cache, **kwargs)
+            created.append(self.put(self.user_model(**kwargs)))
+        return created
+
+    def add_role_to_users(self, users, role):
+        """Adds a role to many users at once. Returns the number of users
+        that didn't have it.
+
+        Unlike the single user methods, the bulk methods update the datastore
+        with set based statements where it supports them - user objects other
+        than the ones passed in might not reflect the change until reloaded.
+
+        :param users: An iterable of User objects
+        :param role: The role to add. Can be a Role object or string role name
+
+        .. versionadded:: 3.3.0
+        """
+        return sum(1 for user in users if self.add_role_to_user(user, role))
+
+    def remove_role_from_users(self, users, role):
+        """Removes a role from many users at once. Returns the number of users
+        that had it.
+
+        :param users: An iterable of User objects
+        :param role: The role to remove. Can be a Role object or string role
+            name
+
+        .. versionadded:: 3.3.0
+        """
+        return sum(1 for user in users if self.remove_role_from_user(user, role))
+
+    def deactivate_users(self, users):
+        """Deactivates many users at once. Returns the number of users that
+        were active.
+
+        :param users: An iterable of User objects
+
+        .. versionadded:: 3.3.0
+        """
+        return sum(1 for user in users if self.deactivate_user(user))
+
+    def reset_uniquifiers(self, users):
+        """Gives each user a new ``fs_uniquifier`` - invalidating their
+        outstanding auth tokens. Returns the number of users changed (``0`` if
+        the user model doesn't have ``fs_uniquifier``).
+
+        :param users: An iterable of User objects
+
+        .. versionadded:: 3.3.0
+        """
+        if not hasattr(self.user_model, "fs_uniquifier"):
+            return 0
+        count = 0
+        for user in users:
+            self.set_uniquifier(user)
+            count += 1
+        return count
 
 
 class SQLAlchemyUserDatastore(SQLAlchemyDatastore, UserDatastore):
@@ -316,58 +599,316 @@ class SQLAlchemyUserDatastore(SQLAlchemyDatastore, UserDatastore):
     """
 
     def __init__(self, db, user_model, role_model):
-        SQLAlchemyDatastore.__init__(self, db)
-        UserDatastore.__init__(self, user_model, role_model)
-
-    def get_user(self, identifier):
-        from sqlalchemy import func as alchemyFn
         from sqlalchemy import inspect
-        from sqlalchemy.sql import sqltypes
         from sqlalchemy.dialects.postgresql import UUID as PSQL_UUID
+        from sqlalchemy.ext import baked
+        from sqlalchemy.sql import sqltypes
 
-        user_model_query = self.user_model.query
-        if hasattr(self.user_model, "roles"):
-            from sqlalchemy.orm import joinedload
-
-            user_model_query = user_model_query.options(joinedload("roles"))
+        SQLAlchemyDatastore.__init__(self, db)
+        UserDatastore.__init__(self, user_model, role_model)
 
         # To support both numeric, string, and UUID primary keys, and support
-        # calling this routine with either a numeric value or a string or a UUID
+        # calling get_user with either a numeric value or a string or a UUID
         # we need to make sure the types basically match.
-        # psycopg2 for example will complain if we attempt to 'get' a
-        # numeric primary key with a string value.
+        # psycopg2 for example will complain if we attempt to compare a
+        # numeric column with a string value.
         # TODO: other datastores don't support this - they assume the only
         # PK is user.id. That makes things easier but for backwards compat...
-        ins = inspect(self.user_model)
-        pk_type = ins.primary_key[0].type
-        pk_isnumeric = isinstance(pk_type, sqltypes.Integer)
-        pk_isuuid = isinstance(pk_type, PSQL_UUID)
-        # Are they the same or NOT numeric nor UUID
-        if (
-            (pk_isnumeric and self._is_numeric(identifier))
-            or (pk_isuuid and self._is_uuid(identifier))
-            or (not pk_isnumeric and not pk_isuuid)
-        ):
-            rv = self.user_model.query.get(identifier)
-            if rv is not None:
-                return rv
+        self._pk_column = inspect(user_model).primary_key[0]
+        self._pk_isnumeric = isinstance(self._pk_column.type, sqltypes.Integer)
+        self._pk_isuuid = isinstance(self._pk_column.type, PSQL_UUID)
+        self._numeric_attrs = {}
+        self._bakery = baked.bakery()
+
+    def _is_numeric_attr(self, attr):
+        if attr not in self._numeric_attrs:
+            from sqlalchemy.sql import sqltypes
 
-        # Not PK - iterate through other attributes and look for 'identifier'
-        for attr in get_identity_attributes():
             column = getattr(self.user_model, attr)
-            attr_isnumeric = isinstance(column.type, sqltypes.Integer)
-
-            query = None
-            if attr_isnumeric and self._is_numeric(identifier):
-                query = column == identifier
-            elif not attr_isnumeric and not self._is_numeric(identifier):
-                # Look for exact case-insensitive match - 'ilike' honors
-                # wild cards which isn't what we want.
-                query = alchemyFn.lower(column) == alchemyFn.lower(identifier)
-            if query is not None:
-                rv = user_model_query.filter(query).first()
-                if rv is not None:
-                    return rv
+            self._numeric_attrs[attr] = isinstance(column.type, sqltypes.Integer)
+        return self._numeric_attrs[attr]
+
+    def _get_user_criteria(self, attrs, isnumeric, isuuid):
+        # The columns that could hold an identifier of this kind - the PK first.
+        from sqlalchemy import bindparam, func
+
+        criteria = []
+        if self._pk_isnumeric and isnumeric:
+            criteria.append(self._pk_column == bindparam("number"))
+        elif (self._pk_isuuid and isuuid) or (
+            not self._pk_isnumeric and not self._pk_isuuid
+        ):
+            criteria.append(self._pk_column == bindparam("ident"))
+        for attr in attrs:
+            column = getattr(self.user_model, attr)
+            if self._is_numeric_attr(attr):
+                if isnumeric:
+                    criteria.append(column == bindparam("number"))
+            elif not isnumeric:
+                normalized = self._normalized_column(attr)
+                if normalized is not None:
+                    # Plain equality - can use an index.
+                    criteria.append(normalized == bindparam("normalized"))
+                else:
+                    # Look for exact case-insensitive match - 'ilike' honors
+                    # wild cards which isn't what we want.
+                    criteria.append(
+                        func.lower(column) == func.lower(bindparam("ident"))
+                    )
+        return criteria
+
+    def _add_get_user_criteria(self, query, attrs, isnumeric, isuuid):
+        from sqlalchemy import case, or_
+
+        criteria = self._get_user_criteria(attrs, isnumeric, isuuid)
+        # One query - but a PK match wins over the first identity attribute
+        # match, which wins over the second, and so on.
+        order = case([(c, i) for i, c in enumerate(criteria)], else_=len(criteria))
+        return query.filter(or_(*criteria)).order_by(order)
+
+    def get_user(self, identifier):
+        from sqlalchemy.orm import joinedload, scoped_session
+
+        attrs = tuple(get_identity_attributes())
+        isnumeric = self._is_numeric(identifier)
+        isuuid = self._is_uuid(identifier)
+        if not self._get_user_criteria(attrs, isnumeric, isuuid):
+            return None
+
+        bq = self._bakery(lambda session: session.query(self.user_model))
+        if hasattr(self.user_model, "roles"):
+            bq += lambda q: q.options(joinedload("roles"))
+        # The query differs by identity attributes and kind of identifier.
+        bq.add_criteria(
+            lambda q: self._add_get_user_criteria(q, attrs, isnumeric, isuuid),
+            attrs,
+            isnumeric,
+            isuuid,
+            config_value("USE_NORMALIZED_IDENTITY"),
+        )
+
+        session = self.db.session
+        if isinstance(session, scoped_session):
+            session = session()
+        return (
+            bq(session)
+            .params(
+                number=int(identifier) if isnumeric else None,
+                ident=identifier,
+                normalized=normalize_identity(identifier),
+            )
+            .first()
+        )
+
+    def normalize_identities(self, batch_size=1000):
+        count = 0
+        last = None
+        while True:
+            # Page by primary key so each batch is an index range scan.
+            query = self.user_model.query.order_by(self._pk_column)
+            if last is not None:
+                query = query.filter(self._pk_column > last)
+            users = query.limit(batch_size).all()
+            if not users:
+                return count
+            for user in users:
+                if self._normalize_user(user):
+                    count += 1
+            self.commit()
+            last = getattr(user, self._pk_column.key)
+
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        User = self.user_model
+        session = self.db.session
+        query = session.query(User).filter(
+            self._pk_column == user_id, User.password == old_hash
+        )
+        if not query.update({User.password: new_hash}, synchronize_session=False):
+            return False
+        _send_user_auth_changed(session.query(User).get(user_id))
+        return True
+
+    def update_login_stats(self, user_id, count, **fields):
+        from sqlalchemy import func
+
+        User = self.user_model
+        values = dict((getattr(User, name), value) for name, value in fields.items())
+        values[User.login_count] = func.coalesce(User.login_count, 0) + count
+        self.db.session.query(User).filter(self._pk_column == user_id).update(
+            values, synchronize_session=False
+        )
+
+    def _users_by_id(self, users):
+        # Users and roles need their ids.
+        self.db.session.flush()
+        key = self._pk_column.key
+        return dict((getattr(user, key), user) for user in map(_unwrap, users))
+
+    def _roles_link(self):
+        # (table, user column, role column, role key) of a many-to-many
+        # user-role relation - None for anything else.
+        from sqlalchemy import inspect
+
+        rel = inspect(self.user_model).relationships.get("roles")
+        if rel is None or rel.secondary is None:
+            return None
+        role_key = inspect(self.role_model).get_property_by_column(
+            rel.secondary_synchronize_pairs[0][0]
+        )
+        return (
+            rel.secondary,
+            rel.synchronize_pairs[0][1],
+            rel.secondary_synchronize_pairs[0][1],
+            role_key.key,
+        )
+
+    def _bulk_roles_changed(self, users_by_id, ids):
+        session = self.db.session
+        for user_id in ids:
+            user = users_by_id[user_id]
+            if user in session:
+                session.expire(user, ["roles"])
+        self._send_bulk_changed(users_by_id, ids)
+
+    def add_role_to_users(self, users, role):
+        from sqlalchemy import select
+
+        link = self._roles_link()
+        if link is None:
+            return super(SQLAlchemyUserDatastore, self).add_role_to_users(users, role)
+        table, user_column, role_column, role_key = link
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        role_id = getattr(role, role_key)
+        session = self.db.session
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            query = select([user_column]).where(
+                (role_column == role_id) & user_column.in_(ids)
+            )
+            have = set(row[0] for row in session.execute(query))
+            missing = [user_id for user_id in ids if user_id not in have]
+            if missing:
+                session.execute(
+                    table.insert(),
+                    [
+                        {user_column.name: user_id, role_column.name: role_id}
+                        for user_id in missing
+                    ],
+                )
+            changed.extend(missing)
+        self._bulk_roles_changed(users_by_id, changed)
+        return len(changed)
+
+    def remove_role_from_users(self, users, role):
+        from sqlalchemy import select
+
+        link = self._roles_link()
+        if link is None:
+            return super(SQLAlchemyUserDatastore, self).remove_role_from_users(
+                users, role
+            )
+        table, user_column, role_column, role_key = link
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        role_id = getattr(role, role_key)
+        session = self.db.session
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            criteria = (role_column == role_id) & user_column.in_(ids)
+            have = set(
+                row[0] for row in session.execute(select([user_column]).where(criteria))
+            )
+            if have:
+                session.execute(table.delete().where(criteria))
+            changed.extend(have)
+        self._bulk_roles_changed(users_by_id, changed)
+        return len(changed)
+
+    def deactivate_users(self, users):
+        from sqlalchemy import true
+        from sqlalchemy.orm.attributes import set_committed_value
+
+        users_by_id = self._users_by_id(users)
+        session = self.db.session
+        pk, active = self._pk_column, self.user_model.active
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            ids = [
+                row[0]
+                for row in session.query(pk).filter(pk.in_(ids), active == true())
+            ]
+            if ids:
+                session.query(self.user_model).filter(pk.in_(ids)).update(
+                    {active: False}, synchronize_session=False
+                )
+            changed.extend(ids)
+        for user_id in changed:
+            set_committed_value(users_by_id[user_id], "active", False)
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def create_users(self, users):
+        link = self._roles_link()
+        if link is None or not hasattr(self.user_model, "fs_uniquifier"):
+            return super(SQLAlchemyUserDatastore, self).create_users(users)
+        from sqlalchemy.orm import joinedload
+
+        table, user_column, role_column, role_key = link
+        User = self.user_model
+        uniquifier = User.fs_uniquifier
+        order, roles, groups = self._prepare_bulk_create(users)
+        session = self.db.session
+        # New roles need their ids.
+        session.flush()
+        created = {}
+        for rows in groups.values():
+            for chunk in _chunks(rows):
+                # executemany INSERTs - then one SELECT for the new ids.
+                session.bulk_insert_mappings(User, chunk)
+                keys = [row["fs_uniquifier"] for row in chunk]
+                ids = dict(
+                    session.query(uniquifier, self._pk_column).filter(
+                        uniquifier.in_(keys)
+                    )
+                )
+                links = [
+                    {
+                        user_column.name: ids[key],
+                        role_column.name: getattr(role, role_key),
+                    }
+                    for key in keys
+                    for role in roles[key]
+                ]
+                if links:
+                    session.execute(table.insert(), links)
+                query = session.query(User).options(joinedload("roles"))
+                created.update(
+                    (user.fs_uniquifier, user)
+                    for user in query.filter(uniquifier.in_(keys))
+                )
+        return [created[key] for key in order]
+
+    def reset_uniquifiers(self, users):
+        if not hasattr(self.user_model, "fs_uniquifier"):
+            return 0
+        from sqlalchemy import case
+        from sqlalchemy.orm.attributes import set_committed_value
+
+        users_by_id = self._users_by_id(users)
+        session = self.db.session
+        pk, column = self._pk_column, self.user_model.fs_uniquifier
+        values = dict((user_id, uuid.uuid4().hex) for user_id in users_by_id)
+        # One UPDATE ... CASE per batch - 3 parameters per user.
+        for ids in _chunks(list(values), 300):
+            new = case(dict((user_id, values[user_id]) for user_id in ids), value=pk)
+            session.query(self.user_model).filter(pk.in_(ids)).update(
+                {column: new}, synchronize_session=False
+            )
+        for user_id, value in values.items():
+            set_committed_value(users_by_id[user_id], "fs_uniquifier", value)
+        self._send_bulk_changed(users_by_id, list(values))
+        return len(values)
 
     def find_user(self, **kwargs):
         query = self.user_model.query
@@ -378,6 +919,14 @@ class SQLAlchemyUserDatastore(SQLAlchemyDatastore, UserDatastore):
 
         return query.filter_by(**kwargs).first()
 
+    def existing_identities(self, attr, values):
+        column = getattr(self.user_model, attr)
+        found = set()
+        for chunk in _chunks(list(set(values))):
+            query = self.db.session.query(column).filter(column.in_(chunk))
+            found.update(row[0] for row in query)
+        return found
+
     def find_role(self, role):
         return self.role_model.query.filter_by(name=role).first()
 
@@ -414,27 +963,91 @@ class SQLAlchemySessionUserDatastore(SQLAlchemyUserDatastore, SQLAlchemyDatastor
 class MongoEngineUserDatastore(MongoEngineDatastore, UserDatastore):
     """A MongoEngine datastore implementation for Flask-Security that assumes
     the use of the Flask-MongoEngine extension.
+
+    By default :meth:`get_user` looks identity attributes up with
+    case-insensitive (``__iexact``) regex queries, which can't use an index.
+    With MongoDB 3.4+ pass ``collation=MongoEngineUserDatastore.case_insensitive``
+    to look them up with a case-insensitive collation instead, so lookups can
+    use an index - see :meth:`ensure_indexes`. Only queries on nothing but
+    identity attributes are collated - ``id``, ``fs_uniquifier`` and any other
+    fields are always compared exactly. mongomock doesn't support collations.
+
+    :param collation: The collation for identity attribute lookups
+    :param only: If set, the user fields :meth:`find_auth_user` loads - other
+        fields of the users the session and token loaders return are left at
+        their defaults. Only use this if nothing (including your own code, via
+        ``current_user``) needs the other fields of an authenticated user. Other
+        lookups always load the whole user.
+
+    .. versionchanged:: 3.3.0
+        Added ``collation`` and ``only``.
     """
 
-    def __init__(self, db, user_model, role_model):
+    #: Compares strings ignoring case (but not accents).
+    case_insensitive = {"locale": "en", "strength": 2}
+
+    def __init__(self, db, user_model, role_model, collation=None, only=None):
         MongoEngineDatastore.__init__(self, db)
         UserDatastore.__init__(self, user_model, role_model)
+        self.collation = collation
+        self.only = only
+
+    def _collated(self, kwargs):
+        if not self.collation or not kwargs:
+            return False
+        attrs = get_identity_attributes()
+        return all(key.split("__")[0] in attrs for key in kwargs)
+
+    def _user_objects(self, only=None, **kwargs):
+        query = self.user_model.objects(**kwargs)
+        if self._collated(kwargs):
+            query = query.collation(self.collation)
+        if only:
+            query = query.only(*only)
+        return query
+
+    def ensure_indexes(self):
+        """Create the indexes :meth:`get_user` and :meth:`find_user` need: one
+        for each identity attribute and for ``fs_uniquifier``, with this
+        datastore's collation. Must be called within an application context.
+
+        :return: The names of the indexes (existing ones are left alone).
+
+        .. versionadded:: 3.3.0
+        """
+        attrs = list(get_identity_attributes())
+        if hasattr(self.user_model, "fs_uniquifier"):
+            attrs.append("fs_uniquifier")
+        collection = self.user_model._get_collection()
+        names = []
+        for attr in attrs:
+            db_field = self.user_model._fields[attr].db_field
+            # Named so they don't clash with the model's own (uncollated)
+            # indexes on the same fields.
+            kwargs = dict(name="fs_%s" % db_field, background=True)
+            if self.collation:
+                kwargs["collation"] = self.collation
+            names.append(collection.create_index(db_field, **kwargs))
+        return names
 
     def get_user(self, identifier):
         from mongoengine import ValidationError
 
         try:
-            return self.user_model.objects(id=identifier).first()
+            return self._user_objects(id=identifier).first()
         except (ValidationError, ValueError):
             pass
 
         is_numeric = self._is_numeric(identifier)
 
         for attr in get_identity_attributes():
-            query_key = attr if is_numeric else "%s__iexact" % attr
+            if is_numeric or self.collation:
+                query_key = attr
+            else:
+                query_key = "%s__iexact" % attr
             query = {query_key: identifier}
             try:
-                rv = self.user_model.objects(**query).first()
+                rv = self._user_objects(**query).first()
                 if rv is not None:
                     return rv
             except (ValidationError, ValueError):
@@ -442,20 +1055,127 @@ class MongoEngineUserDatastore(MongoEngineDatastore, UserDatastore):
                 # an int.
                 pass
 
-    def find_user(self, **kwargs):
-        try:
-            from mongoengine.queryset import Q, QCombination
-        except ImportError:
-            from mongoengine.queryset.visitor import Q, QCombination
+    def find_user(self, only=None, **kwargs):
+        """Returns a user matching the provided parameters.
+
+        :param only: If set, the user fields to load
+        """
         from mongoengine.errors import ValidationError
 
-        queries = map(lambda i: Q(**{i[0]: i[1]}), kwargs.items())
-        query = QCombination(QCombination.AND, queries)
         try:
-            return self.user_model.objects(query).first()
+            return self._user_objects(only=only, **kwargs).first()
         except ValidationError:  # pragma: no cover
             return None
 
+    def find_auth_user(self, **kwargs):
+        return self.find_user(only=self.only, **kwargs)
+
+    def existing_identities(self, attr, values):
+        values = list(set(values))
+
+        key = "%s__in" % attr
+        collated = self._collated({key: values})
+
+        def fold(value):
+            # Lookups with the (case-insensitive) collation ignore case.
+            if collated and isinstance(value, string_types):
+                return value.lower()
+            return value
+
+        found = set()
+        for chunk in _chunks(values):
+            query = self._user_objects(**{key: chunk})
+            found.update(fold(v) for v in query.scalar(attr))
+        return set(v for v in values if fold(v) in found)
+
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        query = self.user_model.objects(id=user_id, password=old_hash)
+        if not query.update_one(set__password=new_hash):
+            return False
+        _send_user_auth_changed(self.find_user(id=user_id))
+        return True
+
+    def update_login_stats(self, user_id, count, **fields):
+        updates = dict(("set__%s" % name, value) for name, value in fields.items())
+        self.user_model.objects(id=user_id).update_one(
+            inc__login_count=count, **updates
+        )
+
+    def create_users(self, users):
+        role_cache = {}
+        docs = []
+        for kwargs in users:
+            kwargs = self._prepare_create_user_args(role_cache, **kwargs)
+            doc = self.user_model(**kwargs)
+            doc.validate()
+            docs.append(doc)
+        if not docs:
+            return []
+        return self.user_model.objects.insert(docs)
+
+    def add_role_to_users(self, users, role):
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        objects = self.user_model.objects
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            ids = list(objects(id__in=ids, roles__ne=role).scalar("id"))
+            if ids:
+                objects(id__in=ids).update(push__roles=role)
+            changed.extend(ids)
+        for user_id in changed:
+            users_by_id[user_id].roles.append(role)
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def remove_role_from_users(self, users, role):
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        objects = self.user_model.objects
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            ids = list(objects(id__in=ids, roles=role).scalar("id"))
+            if ids:
+                objects(id__in=ids).update(pull__roles=role)
+            changed.extend(ids)
+        for user_id in changed:
+            users_by_id[user_id].roles.remove(role)
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def deactivate_users(self, users):
+        users_by_id = self._users_by_id(users)
+        objects = self.user_model.objects
+        changed = []
+        for ids in _chunks(list(users_by_id)):
+            ids = list(objects(id__in=ids, active=True).scalar("id"))
+            if ids:
+                objects(id__in=ids).update(set__active=False)
+            changed.extend(ids)
+        for user_id in changed:
+            users_by_id[user_id].active = False
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def reset_uniquifiers(self, users):
+        if not hasattr(self.user_model, "fs_uniquifier"):
+            return 0
+        from pymongo import UpdateOne
+
+        users = [_unwrap(user) for user in users]
+        field = self.user_model._fields["fs_uniquifier"].db_field
+        updates = []
+        for user in users:
+            user.fs_uniquifier = uuid.uuid4().hex
+            updates.append(
+                UpdateOne({"_id": user.pk}, {"$set": {field: user.fs_uniquifier}})
+            )
+        if updates:
+            self.user_model._get_collection().bulk_write(updates, ordered=False)
+        for user in users:
+            _send_user_auth_changed(user)
+        return len(users)
+
     def find_role(self, role):
         return self.role_model.objects(name=role).first()
 
@@ -499,18 +1219,49 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
                 if attr_isnumeric and self._is_numeric(identifier):
                     return self.user_model.get(column == identifier)
                 elif not attr_isnumeric and not self._is_numeric(identifier):
+                    normalized = self._normalized_column(attr)
+                    if normalized is not None:
+                        return self.user_model.get(
+                            normalized == normalize_identity(identifier)
+                        )
                     return self.user_model.get(
                         peeweeFn.Lower(column) == peeweeFn.Lower(identifier)
                     )
             except (self.user_model.DoesNotExist, ValueError):
                 pass
 
+    def normalize_identities(self, batch_size=1000):
+        pk = self.user_model._meta.primary_key
+        count = 0
+        last = None
+        while True:
+            query = self.user_model.select().order_by(pk).limit(batch_size)
+            if last is not None:
+                query = query.where(pk > last)
+            users = list(query)
+            if not users:
+                return count
+            with self.db.database.atomic():
+                for user in users:
+                    if self._normalize_user(user):
+                        user.save()
+                        count += 1
+            last = getattr(user, pk.name)
+
     def find_user(self, **kwargs):
         try:
             return self.user_model.filter(**kwargs).get()
         except self.user_model.DoesNotExist:
             return None
 
+    def existing_identities(self, attr, values):
+        column = getattr(self.user_model, attr)
+        found = set()
+        for chunk in _chunks(list(set(values))):
+            query = self.user_model.select(column).where(column.in_(chunk))
+            found.update(getattr(user, attr) for user in query)
+        return found
+
     def find_role(self, role):
         try:
             return self.role_model.filter(name=role).get()
@@ -541,6 +1292,7 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
             return False
         else:
             self.put(self.UserRole.create(user=user.id, role=role.id))
+            _send_user_auth_changed(user)
             return True
 
     def remove_role_from_user(self, user, role):
@@ -558,10 +1310,136 @@ class PeeweeUserDatastore(PeeweeDatastore, UserDatastore):
                 self.UserRole.user == user, self.UserRole.role == role
             )
             query.execute()
+            _send_user_auth_changed(user)
             return True
         else:
             return False
 
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        User = self.user_model
+        query = User.update(password=new_hash).where(
+            User.id == user_id, User.password == old_hash
+        )
+        if not query.execute():
+            return False
+        _send_user_auth_changed(self.find_user(id=user_id))
+        return True
+
+    def update_login_stats(self, user_id, count, **fields):
+        from peewee import fn
+
+        User = self.user_model
+        fields["login_count"] = fn.COALESCE(User.login_count, 0) + count
+        User.update(**fields).where(User.id == user_id).execute()
+
+    def create_users(self, users):
+        User = self.user_model
+        if not hasattr(User, "fs_uniquifier"):
+            return self._create_users_by_row(users)
+        order, roles, groups = self._prepare_bulk_create(users)
+        created = {}
+        with self.db.database.atomic():
+            for names, rows in groups.items():
+                # Within SQLite's 999 parameter limit.
+                for chunk in _chunks(rows, max(1, 999 // len(names))):
+                    User.insert_many(chunk).execute()
+                    keys = [row["fs_uniquifier"] for row in chunk]
+                    query = User.select().where(User.fs_uniquifier.in_(keys))
+                    created.update((user.fs_uniquifier, user) for user in query)
+            links = [
+                dict(user=created[key].id, role=role.id)
+                for key in order
+                for role in roles[key]
+            ]
+            for rows in _chunks(links):
+                self.UserRole.insert_many(rows).execute()
+        return [created[key] for key in order]
+
+    def _create_users_by_row(self, users):
+        role_cache = {}
+        created = []
+        links = []
+        with self.db.database.atomic():
+            for kwargs in users:
+                kwargs = self._prepare_create_user_args(role_cache, **kwargs)
+                roles = kwargs.pop("roles")
+                user = self.put(self.user_model(**kwargs))
+                links.extend(dict(user=user.id, role=role.id) for role in roles)
+                created.append(user)
+            for rows in _chunks(links):
+                self.UserRole.insert_many(rows).execute()
+        return created
+
+    def _users_with_role(self, ids, role):
+        UserRole = self.UserRole
+        query = UserRole.select(UserRole.user).where(
+            UserRole.role == role.id, UserRole.user.in_(ids)
+        )
+        return set(row[0] for row in query.tuples())
+
+    def add_role_to_users(self, users, role):
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        changed = []
+        with self.db.database.atomic():
+            for ids in _chunks(list(users_by_id)):
+                have = self._users_with_role(ids, role)
+                missing = [user_id for user_id in ids if user_id not in have]
+                if missing:
+                    self.UserRole.insert_many(
+                        [dict(user=user_id, role=role.id) for user_id in missing]
+                    ).execute()
+                changed.extend(missing)
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def remove_role_from_users(self, users, role):
+        role = self._prepare_role(role)
+        users_by_id = self._users_by_id(users)
+        UserRole = self.UserRole
+        changed = []
+        with self.db.database.atomic():
+            for ids in _chunks(list(users_by_id)):
+                have = list(self._users_with_role(ids, role))
+                if have:
+                    UserRole.delete().where(
+                        UserRole.role == role.id, UserRole.user.in_(have)
+                    ).execute()
+                changed.extend(have)
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def deactivate_users(self, users):
+        users_by_id = self._users_by_id(users)
+        User = self.user_model
+        changed = []
+        with self.db.database.atomic():
+            for ids in _chunks(list(users_by_id)):
+                query = User.select(User.id).where(User.id.in_(ids), User.active)
+                ids = [row[0] for row in query.tuples()]
+                if ids:
+                    User.update(active=False).where(User.id.in_(ids)).execute()
+                changed.extend(ids)
+        for user_id in changed:
+            users_by_id[user_id].active = False
+        self._send_bulk_changed(users_by_id, changed)
+        return len(changed)
+
+    def reset_uniquifiers(self, users):
+        if not hasattr(self.user_model, "fs_uniquifier"):
+            return 0
+        users = [_unwrap(user) for user in users]
+        for user in users:
+            user.fs_uniquifier = uuid.uuid4().hex
+        with self.db.database.atomic():
+            # One UPDATE ... CASE per batch - 3 parameters per user.
+            self.user_model.bulk_update(
+                users, fields=[self.user_model.fs_uniquifier], batch_size=300
+            )
+        for user in users:
+            _send_user_auth_changed(user)
+        return len(users)
+
 
 class PonyUserDatastore(PonyDatastore, UserDatastore):
     """A Pony ORM datastore implementation for Flask-Security.
@@ -597,6 +1475,21 @@ class PonyUserDatastore(PonyDatastore, UserDatastore):
     def find_user(self, **kwargs):
         return self.user_model.get(**kwargs)
 
+    @with_pony_session
+    def existing_identities(self, attr, values):
+        from pony.orm import select
+
+        found = set()
+        for chunk in _chunks(list(set(values))):
+            found.update(
+                select(
+                    getattr(u, attr)
+                    for u in self.user_model
+                    if getattr(u, attr) in chunk
+                )[:]
+            )
+        return found
+
     @with_pony_session
     def find_role(self, role):
         return self.role_model.get(name=role)
@@ -609,6 +1502,39 @@ class PonyUserDatastore(PonyDatastore, UserDatastore):
     def create_user(self, **kwargs):
         return super(PonyUserDatastore, self).create_user(**kwargs)
 
+    @with_pony_session
+    def update_password_hash(self, user_id, old_hash, new_hash):
+        # Locks the row (as below), so the hash can't change between the
+        # check and the update.
+        user = self.user_model.get_for_update(id=user_id)
+        if user is None or user.password != old_hash:
+            return False
+        user.password = new_hash
+        _send_user_auth_changed(user)
+        return True
+
+    @with_pony_session
+    def update_login_stats(self, user_id, count, **fields):
+        # Locks the row (BEGIN IMMEDIATE on SQLite) so concurrent updates are
+        # serialized rather than lost.
+        user = self.user_model.get_for_update(id=user_id)
+        if user is None:
+            return
+        for name, value in fields.items():
+            setattr(user, name, value)
+        user.login_count = (user.login_count or 0) + count
+
+    @with_pony_session
+    def create_users(self, users):
+        # Pony has no multi-row statements - it INSERTs the users one at a time
+        # when the session is flushed.
+        return super(PonyUserDatastore, self).create_users(users)
+
+    @with_pony_session
+    def reset_uniquifiers(self, users):
+        # As above - one UPDATE per user, when the session is flushed.
+        return super(PonyUserDatastore, self).reset_uniquifiers(users)
+
     @with_pony_session
     def create_role(self, **kwargs):
         return super(PonyUserDatastore, self).create_role(**kwargs)
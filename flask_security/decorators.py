@@ -14,13 +14,16 @@ from collections import namedtuple
 from functools import wraps
 
 from flask import Response, _request_ctx_stack, abort, current_app, g, redirect, request
+from flask.sessions import SecureCookieSessionInterface
 from flask_login import current_user, login_required  # noqa: F401
-from flask_principal import Identity, Permission, RoleNeed, identity_changed
+from flask_principal import RoleNeed
 from flask_wtf.csrf import CSRFError
 from werkzeug.local import LocalProxy
 from werkzeug.routing import BuildError
 
 from . import utils
+from .instrumentation import phase
+from .permissions import permission_registry
 
 # Convenient references
 _security = LocalProxy(lambda: current_app.extensions["security"])
@@ -89,13 +92,17 @@ def default_unauthz_handler(func, params):
     abort(403)
 
 
+def _identity_provides():
+    identity = g.get("identity")
+    return identity.provides if identity is not None else ()
+
+
 def _check_token():
     user = _security.login_manager.request_callback(request)
 
     if user and user.is_authenticated:
-        app = current_app._get_current_object()
         _request_ctx_stack.top.user = user
-        identity_changed.send(app, identity=Identity(user.id))
+        utils.set_request_identity(user)
         return True
 
     return False
@@ -105,18 +112,68 @@ def _check_http_auth():
     auth = request.authorization or BasicAuth(username=None, password=None)
     if not auth.username:
         return False
-    user = _security.datastore.get_user(auth.username)
+    with phase("datastore_lookup"):
+        user = _security.datastore.get_user(auth.username)
 
     if user and user.verify_and_update_password(auth.password):
         _security.datastore.commit()
-        app = current_app._get_current_object()
         _request_ctx_stack.top.user = user
-        identity_changed.send(app, identity=Identity(user.id))
+        utils.set_request_identity(user)
         return True
 
     return False
 
 
+def _check_session():
+    return current_user.is_authenticated
+
+
+def _has_token():
+    # Could _check_token succeed? Only answerable for our own request loader.
+    from .core import _request_loader
+
+    if _security.login_manager.request_callback is not _request_loader:
+        return True
+    if (
+        _security.token_authentication_header in request.headers
+        or _security.token_authentication_key in request.args
+    ):
+        return True
+    if request.is_json:
+        data = request.get_json(silent=True)
+        return isinstance(data, dict) and _security.token_authentication_key in data
+    return False
+
+
+def _has_session():
+    # Flask-Login loads current_user from the session, the remember cookie or
+    # - failing those - the request loader.
+    ctx = _request_ctx_stack.top
+    if hasattr(ctx, "user"):
+        return True
+    cookies = request.cookies
+    app = ctx.app
+    return (
+        app.config.get("SESSION_COOKIE_NAME", "session") in cookies
+        or app.config.get("REMEMBER_COOKIE_NAME", "remember_token") in cookies
+        or not isinstance(app.session_interface, SecureCookieSessionInterface)
+        or _has_token()
+    )
+
+
+def _has_basic_auth():
+    return "Authorization" in request.headers
+
+
+# Each mechanism is (cheap check its credentials are present at all, check).
+_mechanisms = {
+    "token": (_has_token, _check_token),
+    "session": (_has_session, _check_session),
+    "basic": (_has_basic_auth, _check_http_auth),
+}
+_mechanisms_order = ("token", "session", "basic")
+
+
 def handle_csrf(method):
     """ Invoke CSRF protection based on authentication method.
 
@@ -149,7 +206,8 @@ def handle_csrf(method):
 
     if utils.config_value("CSRF_PROTECT_MECHANISMS"):
         if method in utils.config_value("CSRF_PROTECT_MECHANISMS"):
-            _csrf.protect()
+            with phase("csrf_check"):
+                _csrf.protect()
         else:
             _request_ctx_stack.top.fs_ignore_csrf = True
 
@@ -229,28 +287,22 @@ def auth_required(*auth_methods):
        mechanisms will always be tried in order of ``token``, ``session``, ``basic``
        regardless of how they are specified in the ``auth_methods`` parameter.
     """
-    login_mechanisms = {
-        "token": lambda: _check_token(),
-        "session": lambda: current_user.is_authenticated,
-        "basic": lambda: _check_http_auth(),
-    }
-    mechanisms_order = ["token", "session", "basic"]
     if not auth_methods:
         auth_methods = {"basic", "session", "token"}
     else:
         auth_methods = [am for am in auth_methods]
+    chain = tuple(
+        (method,) + _mechanisms[method]
+        for method in _mechanisms_order
+        if method in auth_methods
+    )
 
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
             h = {}
-            mechanisms = [
-                (method, login_mechanisms.get(method))
-                for method in mechanisms_order
-                if method in auth_methods
-            ]
-            for method, mechanism in mechanisms:
-                if mechanism and mechanism():
+            for method, present, check in chain:
+                if present() and check():
                     handle_csrf(method)
                     return fn(*args, **kwargs)
                 elif method == "basic":
@@ -308,7 +360,8 @@ def unauth_csrf(fall_through=False):
                 _request_ctx_stack.top.fs_ignore_csrf = True
             else:
                 try:
-                    _csrf.protect()
+                    with phase("csrf_check"):
+                        _csrf.protect()
                 except CSRFError:
                     if not fall_through:
                         raise
@@ -335,16 +388,16 @@ def roles_required(*roles):
     :param roles: The required roles.
     """
 
+    needs = frozenset(RoleNeed(role) for role in roles)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perms = [Permission(RoleNeed(role)) for role in roles]
-            for perm in perms:
-                if not perm.can():
-                    if _security._unauthorized_callback:
-                        # Backwards compat - deprecated
-                        return _security._unauthorized_callback()
-                    return _security._unauthz_handler(roles_required, list(roles))
+            if not needs.issubset(_identity_provides()):
+                if _security._unauthorized_callback:
+                    # Backwards compat - deprecated
+                    return _security._unauthorized_callback()
+                return _security._unauthz_handler(roles_required, list(roles))
             return fn(*args, **kwargs)
 
         return decorated_view
@@ -367,11 +420,12 @@ def roles_accepted(*roles):
     :param roles: The possible roles.
     """
 
+    needs = frozenset(RoleNeed(role) for role in roles)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perm = Permission(*[RoleNeed(role) for role in roles])
-            if perm.can():
+            if not needs or not needs.isdisjoint(_identity_provides()):
                 return fn(*args, **kwargs)
             if _security._unauthorized_callback:
                 # Backwards compat - deprecated
@@ -402,18 +456,17 @@ def permissions_required(*fsperms):
     .. versionadded:: 3.3.0
     """
 
+    required = permission_registry.mask(fsperms)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perms = [Permission(utils.FsPermNeed(fsperm)) for fsperm in fsperms]
-            for perm in perms:
-                if not perm.can():
-                    if _security._unauthorized_callback:
-                        # Backwards compat - deprecated
-                        return _security._unauthorized_callback()
-                    return _security._unauthz_handler(
-                        permissions_required, list(fsperms)
-                    )
+            mask = permission_registry.identity_mask(g.get("identity"))
+            if mask & required != required:
+                if _security._unauthorized_callback:
+                    # Backwards compat - deprecated
+                    return _security._unauthorized_callback()
+                return _security._unauthz_handler(permissions_required, list(fsperms))
 
             return fn(*args, **kwargs)
 
@@ -441,11 +494,13 @@ def permissions_accepted(*fsperms):
     .. versionadded:: 3.3.0
     """
 
+    accepted = permission_registry.mask(fsperms)
+
     def wrapper(fn):
         @wraps(fn)
         def decorated_view(*args, **kwargs):
-            perm = Permission(*[utils.FsPermNeed(fsperm) for fsperm in fsperms])
-            if perm.can():
+            mask = permission_registry.identity_mask(g.get("identity"))
+            if not accepted or mask & accepted:
                 return fn(*args, **kwargs)
             if _security._unauthorized_callback:
                 # Backwards compat - deprecated
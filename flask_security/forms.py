@@ -30,6 +30,7 @@ from wtforms import (
 )
 
 from .confirmable import requires_confirmation
+from .instrumentation import phase
 from .utils import (
     _,
     _datastore,
@@ -149,6 +150,10 @@ class Form(BaseForm):
             self.TIME_LIMIT = None
         super(Form, self).__init__(*args, **kwargs)
 
+    def validate(self):
+        with phase("form_validation"):
+            return super(Form, self).validate()
+
 
 class EmailFormMixin:
     email = StringField(
@@ -298,7 +303,8 @@ class LoginForm(Form, NextFormMixin):
         if not super(LoginForm, self).validate():
             return False
 
-        self.user = _datastore.get_user(self.email.data)
+        with phase("datastore_lookup"):
+            self.user = _datastore.get_user(self.email.data)
 
         if self.user is None:
             self.email.errors.append(get_message("USER_DOES_NOT_EXIST")[0])
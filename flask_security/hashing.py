@@ -0,0 +1,318 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.hashing
+    ~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security password hashing executor module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+from functools import partial
+import hashlib
+import hmac
+import os
+import threading
+import time
+import weakref
+
+from passlib.utils import handlers as uh
+from werkzeug.exceptions import ServiceUnavailable
+
+try:  # pragma: no cover
+    from queue import Full, Queue
+except ImportError:  # pragma: no cover
+    from Queue import Full, Queue
+
+# Put on the queue to stop the worker.
+_STOP = object()
+
+
+class HashingExecutorBusy(ServiceUnavailable):
+    """Raised when a password hash is requested and the hashing executor
+    already has as many hashes running and queued as it allows.
+
+    Being a :class:`werkzeug.exceptions.ServiceUnavailable` it results in a 503
+    unless handled.
+
+    .. versionadded:: 3.3.0
+    """
+
+
+#: Name of the keyed HMAC scheme in ``SECURITY_HASHING_SCHEMES``.
+HMAC_SHA256 = "hmac_sha256"
+
+
+def _hmac_sha256_handler(get_key):
+    # A passlib handler (so it can sit in a CryptContext next to sha256_crypt
+    # for dual-verify) for HMAC-SHA256 keyed with what ``get_key()`` returns -
+    # called the first time something is hashed or verified, so the key can be
+    # configured after the handler is made. Unlike a password hash it has
+    # neither salt nor rounds - it is for data that is already high entropy,
+    # such as a password hash put in a token.
+    # GenericHandler.verify() compares checksums in constant time.
+    keys = []
+
+    class hmac_sha256(uh.StaticHandler):
+        name = HMAC_SHA256
+        checksum_chars = uh.HEX_CHARS
+        checksum_size = 64
+        _hash_prefix = u"$fs-hmac-sha256$"
+
+        def _calc_checksum(self, secret):
+            if not keys:
+                keys.append(get_key())
+            if not isinstance(secret, bytes):
+                secret = secret.encode("utf-8")
+            return hmac.new(keys[0], secret, hashlib.sha256).hexdigest()
+
+    return hmac_sha256
+
+
+def _derive_hmac_key(secret_key, salt):
+    if not isinstance(secret_key, bytes):
+        secret_key = secret_key.encode("utf-8")
+    return hmac.new(secret_key, salt.encode("utf-8"), hashlib.sha256).digest()
+
+
+# CryptContexts rebuilt in worker processes - keyed by their configuration.
+_worker_contexts = {}
+
+
+def _context_call(context_string, method, *args, **kwargs):
+    context = _worker_contexts.get(context_string)
+    if context is None:
+        from passlib.context import CryptContext
+
+        context = CryptContext.from_string(context_string)
+        _worker_contexts[context_string] = context
+    return getattr(context, method)(*args, **kwargs)
+
+
+def _timed(fn, args, kwargs):
+    # Report when the work actually started so the caller can compute time
+    # spent waiting in the queue. Wall clock so it works across processes.
+    return time.time(), fn(*args, **kwargs)
+
+
+class HashingExecutor(object):
+    """Runs password hashing and verification on a bounded pool of workers.
+
+    At most ``max_workers`` hashes run at once and at most ``max_queue`` more
+    wait for a worker. Past that, :meth:`run` raises
+    :class:`HashingExecutorBusy` immediately rather than blocking the caller.
+
+    ``kind`` is either ``thread`` or ``process``. Threads are enough for bcrypt
+    and argon2 (which release the GIL); pure-python schemes need processes.
+    On Python 2 this needs the `futures` package (installed with
+    Flask-Security).
+
+    .. versionadded:: 3.3.0
+    """
+
+    kinds = ("thread", "process")
+
+    def __init__(self, kind="thread", max_workers=4, max_queue=16):
+        if kind not in self.kinds:
+            raise ValueError("Unknown hashing executor: %s" % kind)
+        try:
+            from concurrent import futures
+        except ImportError:  # pragma: no cover
+            raise ValueError(
+                "The %s hashing executor requires concurrent.futures - "
+                "install the futures package on Python 2" % kind
+            )
+
+        if kind == "thread":
+            self._pool = futures.ThreadPoolExecutor(max_workers=max_workers)
+        else:
+            self._pool = futures.ProcessPoolExecutor(max_workers=max_workers)
+        self.kind = kind
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self._slots = threading.BoundedSemaphore(max_workers + max_queue)
+        self._lock = threading.Lock()
+        # Keyed by the context itself - an id() can be reused once the context
+        # is garbage collected.
+        self._context_strings = weakref.WeakKeyDictionary()
+        self._in_flight = 0
+        self._completed = 0
+        self._rejected = 0
+        self._wait_total = 0.0
+        self._wait_max = 0.0
+
+    def _context_string(self, context):
+        rv = self._context_strings.get(context)
+        if rv is None:
+            rv = self._context_strings[context] = context.to_string()
+        return rv
+
+    def run(self, context, method, *args, **kwargs):
+        """Call ``method`` of the passlib ``context`` on a worker and wait
+        for the result.
+
+        :param context: The :class:`passlib.context.CryptContext` to use
+        :param method: The name of the method to call, e.g. ``hash``
+        """
+        if not self._slots.acquire(False):
+            with self._lock:
+                self._rejected += 1
+            raise HashingExecutorBusy()
+        try:
+            with self._lock:
+                self._in_flight += 1
+            if self.kind == "process":
+                fn = partial(_context_call, self._context_string(context), method)
+            else:
+                fn = getattr(context, method)
+            submitted = time.time()
+            started, result = self._pool.submit(_timed, fn, args, kwargs).result()
+        finally:
+            with self._lock:
+                self._in_flight -= 1
+            self._slots.release()
+
+        waited = max(0.0, started - submitted)
+        with self._lock:
+            self._completed += 1
+            self._wait_total += waited
+            self._wait_max = max(self._wait_max, waited)
+        return result
+
+    def stats(self):
+        """Return a dict of ``in_flight`` (running plus queued), ``queue_depth``,
+        ``completed`` and ``rejected`` counts, and ``wait_total``/``wait_max``:
+        the seconds completed hashes spent queued.
+        """
+        with self._lock:
+            return dict(
+                in_flight=self._in_flight,
+                queue_depth=max(0, self._in_flight - self.max_workers),
+                completed=self._completed,
+                rejected=self._rejected,
+                wait_total=self._wait_total,
+                wait_max=self._wait_max,
+            )
+
+    def shutdown(self, wait=True):
+        self._pool.shutdown(wait=wait)
+
+
+class DeferredRehasher(object):
+    """Upgrades password hashes from a background thread rather than on the
+    login request.
+
+    When a login's password verifies against a hash that passlib says needs
+    updating (e.g. after a scheme change or raising bcrypt rounds),
+    :func:`.verify_and_update_password` hands the user's id, current hash and
+    plaintext password to :meth:`submit`. The worker computes the new hash
+    (on the :class:`HashingExecutor` if one is configured) and stores it with
+    :meth:`.UserDatastore.update_password_hash` - only if the user's hash is
+    still the one that was verified, so a password changed in the meantime is
+    never overwritten.
+
+    Each queued upgrade holds the user's plaintext password in this process's
+    memory until it is applied - so it can show up in a memory dump or core
+    file. At most ``queue_size`` (at least 1) are queued, plus the one being
+    hashed; when the queue is full the upgrade is skipped and happens on a
+    later login instead. Don't enable this if that exposure isn't acceptable.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, app, queue_size=1000):
+        self.app = app
+        # maxsize=0 would be unbounded.
+        self._queue = Queue(maxsize=max(1, queue_size))
+        self._lock = threading.Lock()
+        self._pending = set()
+        self._thread = None
+        self._pid = None
+        self._stopped = threading.Event()
+        self.upgraded = 0
+        self.conflicts = 0
+        self.dropped = 0
+        self.failed = 0
+
+    def _start(self):
+        # Started on first use (and again in a forked child, where the
+        # parent's thread doesn't exist) rather than at init_app time.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="flask-security-rehash"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def submit(self, user, password):
+        """Queue an upgrade of ``user``'s password hash.
+
+        :return: ``False`` if it wasn't queued (already queued for this user,
+            queue full or shut down).
+        """
+        if self._stopped.is_set():
+            return False
+        self._start()
+        with self._lock:
+            if user.id in self._pending:
+                return False
+            try:
+                self._queue.put_nowait((user.id, user.password, password))
+            except Full:
+                self.dropped += 1
+                return False
+            self._pending.add(user.id)
+        return True
+
+    def shutdown(self, timeout=None):
+        """Apply everything already queued and stop the worker."""
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._pid != os.getpid():
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+
+    def join(self):
+        """Wait until everything queued so far has been applied."""
+        self._queue.join()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is _STOP:
+                    break
+                self._apply(*item)
+            finally:
+                # Don't keep the password around until the next upgrade.
+                item = None
+                self._queue.task_done()
+
+    def _apply(self, user_id, old_hash, password):
+        from .utils import hash_password
+
+        try:
+            with self.app.app_context():
+                datastore = self.app.extensions["security"].datastore
+                new_hash = hash_password(password)
+                updated = datastore.update_password_hash(user_id, old_hash, new_hash)
+                datastore.commit()
+        except Exception:
+            with self._lock:
+                self.failed += 1
+            self.app.logger.exception("Failed to upgrade password hash")
+            updated = None
+        with self._lock:
+            self._pending.discard(user_id)
+            if updated:
+                self.upgraded += 1
+            elif updated is not None:
+                self.conflicts += 1
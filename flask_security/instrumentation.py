@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.instrumentation
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security per-request phase timing module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from bisect import bisect_left
+import threading
+from timeit import default_timer
+
+from flask import current_app, g, has_request_context
+
+from .signals import request_timed
+
+
+class _NullPhase(object):
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+
+_null_phase = _NullPhase()
+
+
+class _Phase(object):
+    __slots__ = ("name", "timings", "active", "start")
+
+    def __init__(self, name, timings, active):
+        self.name = name
+        self.timings = timings
+        self.active = active
+
+    def __enter__(self):
+        self.active.add(self.name)
+        self.start = default_timer()
+        return self
+
+    def __exit__(self, *exc_info):
+        elapsed = default_timer() - self.start
+        self.active.discard(self.name)
+        self.timings[self.name] = self.timings.get(self.name, 0.0) + elapsed
+        return False
+
+
+def phase(name):
+    """Return a context manager that adds the time spent in it to
+    ``g.fs_timings[name]``.
+
+    Does nothing (and costs close to nothing) unless ``SECURITY_PHASE_TIMING``
+    is set and there is a request. A phase entered again while already running
+    (e.g. a form's ``validate`` calling its parent's) is only timed once.
+    """
+    if not has_request_context():
+        return _null_phase
+    if not getattr(current_app.extensions.get("security"), "phase_timing", False):
+        return _null_phase
+    timings = g.setdefault("fs_timings", {})
+    active = g.setdefault("_fs_active_phases", set())
+    if name in active:
+        return _null_phase
+    return _Phase(name, timings, active)
+
+
+class PhaseHistograms(object):
+    """Per-phase histograms of request timings, aggregated in this process.
+
+    .. versionadded:: 3.3.0
+    """
+
+    #: Upper bounds, in seconds, of each bucket. A final bucket holds the rest.
+    bounds = (0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._phases = {}
+
+    def record(self, timings):
+        """Add a request's ``{phase: seconds}``."""
+        with self._lock:
+            for name, seconds in timings.items():
+                h = self._phases.get(name)
+                if h is None:
+                    h = dict(count=0, total=0.0, buckets=[0] * (len(self.bounds) + 1))
+                    self._phases[name] = h
+                h["count"] += 1
+                h["total"] += seconds
+                h["buckets"][bisect_left(self.bounds, seconds)] += 1
+
+    def stats(self):
+        """Return ``{phase: {count, total, buckets}}`` where ``buckets`` is a
+        list of ``(upper bound in seconds, count)`` - the last bound is ``None``.
+        """
+        bounds = self.bounds + (None,)
+        with self._lock:
+            return dict(
+                (
+                    name,
+                    dict(
+                        count=h["count"],
+                        total=h["total"],
+                        buckets=list(zip(bounds, h["buckets"])),
+                    ),
+                )
+                for name, h in self._phases.items()
+            )
+
+    def clear(self):
+        with self._lock:
+            self._phases.clear()
+
+
+def _record_phase_timings(exc):
+    timings = g.pop("fs_timings", None)
+    if timings:
+        app = current_app._get_current_object()
+        app.extensions["security"].phase_histograms.record(timings)
+        request_timed.send(app, timings=timings)
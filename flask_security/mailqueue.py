@@ -0,0 +1,164 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.mailqueue
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security background mail dispatch module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import os
+import threading
+import time
+
+try:  # pragma: no cover
+    from queue import Empty, Full, Queue
+except ImportError:  # pragma: no cover
+    from Queue import Empty, Full, Queue
+
+# Put on the queue to stop a worker - after everything queued before it.
+_STOP = object()
+
+
+class MailDispatcher(object):
+    """Sends Flask-Mail messages from background worker threads.
+
+    Messages are put on a bounded queue by :meth:`send` and the request
+    returns right away. Each worker keeps its SMTP connection open while there
+    is mail to send - consecutive messages share one connection - and closes
+    it after ``idle_timeout`` seconds without mail. A failed send is retried
+    up to ``retries`` times on a new connection, waiting ``backoff`` seconds
+    and doubling that each time.
+
+    If the queue is full, or the dispatcher has been shut down, the message is
+    sent on the calling thread instead - mail is never dropped to protect the
+    queue.
+
+    The queue is drained when the process exits, or on :meth:`shutdown`.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(
+        self, app, queue_size=1000, workers=1, retries=3, backoff=1.0, idle_timeout=5.0,
+    ):
+        self.app = app
+        self.workers = workers
+        self.retries = retries
+        self.backoff = backoff
+        self.idle_timeout = idle_timeout
+        self._queue = Queue(maxsize=queue_size)
+        self._lock = threading.Lock()
+        self._threads = []
+        self._pid = None
+        self._stopped = threading.Event()
+        self.sent = 0
+        self.failed = 0
+
+    def _start(self):
+        # Started on first use (and again in a forked child, where the
+        # parent's threads don't exist) rather than at init_app time.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._threads = []
+            for i in range(self.workers):
+                t = threading.Thread(
+                    target=self._run, name="flask-security-mail-%d" % i
+                )
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+            atexit.register(self.shutdown)
+
+    def send(self, msg):
+        """Queue a :class:`flask_mail.Message` for sending."""
+        if not self._stopped.is_set():
+            self._start()
+            try:
+                self._queue.put_nowait(msg)
+                return
+            except Full:
+                self.app.logger.warning("Mail queue full - sending synchronously")
+        self.app.extensions["mail"].send(msg)
+
+    def shutdown(self, timeout=None):
+        """Send everything already queued and stop the workers.
+
+        :param timeout: Seconds to wait for the workers, ``None`` waits until
+            the queue is drained.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        if self._pid != os.getpid():
+            return
+        for _ in self._threads:
+            self._queue.put(_STOP)
+        for t in self._threads:
+            t.join(timeout)
+        # Anything that raced in behind the stop markers.
+        with self.app.app_context():
+            while True:
+                try:
+                    msg = self._queue.get_nowait()
+                except Empty:
+                    break
+                if msg is not _STOP:
+                    self.app.extensions["mail"].send(msg)
+
+    def _connect(self):
+        conn = self.app.extensions["mail"].connect()
+        conn.__enter__()
+        return conn
+
+    def _close(self, conn):
+        try:
+            conn.__exit__(None, None, None)
+        except Exception:
+            # Connection already broken - nothing to say goodbye to.
+            pass
+
+    def _run(self):
+        with self.app.app_context():
+            conn = None
+            while True:
+                try:
+                    msg = self._queue.get(timeout=self.idle_timeout)
+                except Empty:
+                    if conn is not None:
+                        self._close(conn)
+                        conn = None
+                    continue
+                if msg is _STOP:
+                    break
+                conn = self._deliver(conn, msg)
+            if conn is not None:
+                self._close(conn)
+
+    def _deliver(self, conn, msg):
+        # Returns the connection to use for the next message.
+        for attempt in range(self.retries + 1):
+            try:
+                if conn is None:
+                    conn = self._connect()
+                conn.send(msg)
+                with self._lock:
+                    self.sent += 1
+                return conn
+            except Exception:
+                if conn is not None:
+                    self._close(conn)
+                    conn = None
+                if attempt == self.retries:
+                    with self._lock:
+                        self.failed += 1
+                    self.app.logger.exception(
+                        "Failed to send mail to %s" % ", ".join(msg.send_to)
+                    )
+                    return None
+                time.sleep(self.backoff * 2 ** attempt)
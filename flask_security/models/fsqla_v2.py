@@ -0,0 +1,33 @@
+"""
+Copyright 2019 by J. Christopher Wagner (jwag). All rights reserved.
+:license: MIT, see LICENSE for more details.
+
+
+Complete models for all features when using Flask-SqlAlchemy
+
+Adds normalized (lower-cased) copies of the identity attributes so users can
+be looked up by plain, indexed equality - see SECURITY_USE_NORMALIZED_IDENTITY.
+
+BE AWARE: Once any version of this is shipped no changes can be made - instead
+a new version needs to be created.
+"""
+
+from sqlalchemy import Column, String
+from sqlalchemy.orm import validates
+
+from flask_security.utils import NORMALIZED_SUFFIX, normalize_identity
+from .fsqla import FsModels, FsRoleMixin  # noqa: F401
+from .fsqla import FsUserMixin as FsUserMixinV1
+
+
+class FsUserMixin(FsUserMixinV1):
+    """ User information
+    """
+
+    email_normalized = Column(String(255), unique=True)
+    username_normalized = Column(String(255), index=True)
+
+    @validates("email", "username")
+    def _normalize_identity(self, key, value):
+        setattr(self, key + NORMALIZED_SUFFIX, normalize_identity(value))
+        return value
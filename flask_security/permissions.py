@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.permissions
+    ~~~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security permission registry module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import threading
+
+
+class PermissionRegistry(object):
+    """Interns permission names as bits so a set of permissions is an integer
+    mask and checking for one is a bit test.
+
+    Each role's permissions are parsed once and remembered - along with their
+    mask - keyed by the role's class, id, name and ``permissions`` value, so
+    changing a role's permissions (even before it is committed) is picked up
+    right away. Up to ``max_roles`` roles are remembered.
+
+    There is one registry per process: :data:`permission_registry`.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, max_roles=10000):
+        self.max_roles = max_roles
+        self._lock = threading.Lock()
+        self._bits = {}
+        self._names = []
+        self._roles = {}
+        self._role_names = {}
+
+    def bit(self, name):
+        """Return the bit for permission ``name`` - registering it if new."""
+        bit = self._bits.get(name)
+        if bit is None:
+            with self._lock:
+                bit = self._bits.get(name)
+                if bit is None:
+                    bit = self._bits[name] = 1 << len(self._names)
+                    self._names.append(name)
+        return bit
+
+    def lookup(self, name):
+        """Return the bit for permission ``name`` or 0 if no role or identity
+        seen so far has it."""
+        return self._bits.get(name, 0)
+
+    def mask(self, names):
+        """Return the mask of the permissions ``names``."""
+        mask = 0
+        for name in names:
+            mask |= self.bit(name)
+        return mask
+
+    def names(self, mask):
+        """Return the permission names in ``mask`` as a frozenset."""
+        names = []
+        while mask:
+            low = mask & -mask
+            names.append(self._names[low.bit_length() - 1])
+            mask ^= low
+        return frozenset(names)
+
+    def _role_entry(self, role):
+        permissions = getattr(role, "permissions", None)
+        if isinstance(permissions, (list, set)):
+            permissions = tuple(permissions)
+        key = (type(role), getattr(role, "id", None), role.name, permissions)
+        entry = self._roles.get(key)
+        if entry is None:
+            names = frozenset(role.get_permissions())
+            entry = (self.mask(names), names)
+            if len(self._roles) >= self.max_roles:
+                self._roles.clear()
+            self._roles[key] = entry
+        return entry
+
+    def role_mask(self, role):
+        """Return the mask of ``role.get_permissions()``."""
+        return self._role_entry(role)[0]
+
+    def role_permissions(self, role):
+        """Return ``role.get_permissions()`` as a frozenset."""
+        return self._role_entry(role)[1]
+
+    def user_roles(self, roles):
+        """Return the names of ``roles`` as a frozenset, and the mask of their
+        permissions.
+
+        Equal sets of names are shared, so users with the same roles don't
+        each hold a copy.
+        """
+        names = []
+        mask = 0
+        for role in roles:
+            names.append(role.name)
+            if hasattr(role, "permissions"):
+                mask |= self.role_mask(role)
+        names = frozenset(names)
+        shared = self._role_names.get(names)
+        if shared is None:
+            if len(self._role_names) >= self.max_roles:
+                self._role_names.clear()
+            shared = self._role_names.setdefault(names, names)
+        return shared, mask
+
+    def identity_mask(self, identity):
+        """Return the mask of the ``fsperm`` needs an identity provides.
+
+        It is remembered on the identity (until its needs change).
+        """
+        if identity is None:
+            return 0
+        provides = frozenset(identity.provides)
+        cached = getattr(identity, "_fs_permission_mask", None)
+        if cached is not None and cached[0] == provides:
+            return cached[1]
+        mask = self.mask(need.value for need in provides if need.method == "fsperm")
+        identity._fs_permission_mask = (provides, mask)
+        return mask
+
+
+#: The process wide :class:`PermissionRegistry`.
+permission_registry = PermissionRegistry()
@@ -0,0 +1,171 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.principal
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security compact authenticated user module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+from flask_login import UserMixin as BaseUserMixin
+
+from .permissions import permission_registry
+from .utils import _principal_provides, _security, string_types, text_type
+
+
+def _function(method):
+    # The plain function behind a (Python 2 unbound) method.
+    return getattr(method, "__func__", method)
+
+
+class SecurityPrincipal(object):
+    """Compact stand-in for an authenticated user.
+
+    Holds just what authentication and authorization need - the user's id,
+    ``fs_uniquifier``, active flag, the names of its roles and the
+    :class:`.PermissionRegistry` mask of their permissions - in ``__slots__``,
+    so no DB query is needed to authenticate or authorize a request and many
+    can be cached cheaply. It implements the :class:`.UserMixin`
+    authentication API; accessing or setting anything else loads the real user
+    from the datastore (once). Datastore methods accept it in place of the
+    real user.
+
+    The token auth and session user caches hand these out, so
+    ``current_user`` may be one.
+
+    .. versionadded:: 3.3.0
+    """
+
+    __slots__ = (
+        "id",
+        "fs_uniquifier",
+        "active",
+        "role_names",
+        "permission_mask",
+        "_fs_model",
+    )
+
+    def __init__(self, id, fs_uniquifier, active, role_names, permission_mask):
+        set_slot = object.__setattr__
+        set_slot(self, "_fs_model", None)
+        set_slot(self, "id", id)
+        if fs_uniquifier is not None:
+            set_slot(self, "fs_uniquifier", fs_uniquifier)
+        set_slot(self, "active", active)
+        set_slot(self, "role_names", role_names)
+        set_slot(self, "permission_mask", permission_mask)
+
+    @classmethod
+    def from_user(cls, user):
+        """Return a principal for the ``User`` model instance ``user``."""
+        role_names, permission_mask = permission_registry.user_roles(
+            getattr(user, "roles", [])
+        )
+        return cls(
+            user.id,
+            getattr(user, "fs_uniquifier", None),
+            user.active,
+            role_names,
+            permission_mask,
+        )
+
+    def astuple(self):
+        """Return the arguments that recreate this principal - caches keep
+        these rather than the principal, so a loaded model never outlives its
+        request."""
+        try:
+            fs_uniquifier = object.__getattribute__(self, "fs_uniquifier")
+        except AttributeError:
+            fs_uniquifier = None
+        return (
+            self.id,
+            fs_uniquifier,
+            self.active,
+            self.role_names,
+            self.permission_mask,
+        )
+
+    @property
+    def is_active(self):
+        """Returns `True` if the user is active."""
+        return self.active
+
+    @property
+    def is_authenticated(self):
+        return True
+
+    @property
+    def is_anonymous(self):
+        return False
+
+    def get_id(self):
+        return text_type(self.id)
+
+    def __eq__(self, other):
+        if isinstance(other, (SecurityPrincipal, BaseUserMixin)):
+            return self.get_id() == other.get_id()
+        return NotImplemented
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        if equal is NotImplemented:
+            return NotImplemented
+        return not equal
+
+    def __hash__(self):
+        return hash(self.get_id())
+
+    def has_role(self, role):
+        """Returns `True` if the user identifies with the specified role.
+
+        :param role: A role name or `Role` instance"""
+        if not isinstance(role, string_types):
+            role = role.name
+        return role in self.role_names
+
+    def has_permission(self, permission):
+        """Returns `True` if user has this permission (via a role it has).
+
+        :param permission: permission string name
+        """
+        return bool(self.permission_mask & permission_registry.lookup(permission))
+
+    def get_security_payload(self):
+        """Serialize user object as response payload - the ``User`` model's
+        own ``get_security_payload`` is used if it has one."""
+        from .core import UserMixin
+
+        method = getattr(_security.datastore.user_model, "get_security_payload", None)
+        if _function(method) is _function(UserMixin.get_security_payload):
+            return {"id": str(self.id)}
+        return self._fs_load().get_security_payload()
+
+    def needs(self):
+        """Return the Flask-Principal ``RoleNeed`` and ``fsperm`` needs this
+        user provides as a frozenset."""
+        return _principal_provides(
+            _security._get_current_object(), self.role_names, self.permission_mask
+        )
+
+    def _fs_load(self):
+        model = self._fs_model
+        if model is None:
+            model = _security.datastore.find_user(id=self.id)
+            object.__setattr__(self, "_fs_model", model)
+        return model
+
+    def __getattr__(self, name):
+        # Only called for what isn't a (set) slot or class attribute.
+        if name.startswith("__"):
+            raise AttributeError(name)
+        return getattr(self._fs_load(), name)
+
+    def __setattr__(self, name, value):
+        setattr(self._fs_load(), name, value)
+        if name in SecurityPrincipal.__slots__:
+            object.__setattr__(self, name, value)
+
+    def __repr__(self):
+        return "<SecurityPrincipal %s>" % self.id
@@ -25,6 +25,8 @@ password_reset = signals.signal("password-reset")
 
 password_changed = signals.signal("password-changed")
 
+user_auth_changed = signals.signal("user-auth-changed")
+
 reset_password_instructions_sent = signals.signal("password-reset-instructions-sent")
 
 tf_code_confirmed = signals.signal("tf-code-confirmed")
@@ -34,3 +36,5 @@ tf_profile_changed = signals.signal("tf-profile-changed")
 tf_security_token_sent = signals.signal("tf-security-token-sent")
 
 tf_disabled = signals.signal("tf-disabled")
+
+request_timed = signals.signal("request-timed")
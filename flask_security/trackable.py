@@ -0,0 +1,158 @@
+# -*- coding: utf-8 -*-
+"""
+    flask_security.trackable
+    ~~~~~~~~~~~~~~~~~~~~~~~~
+
+    Flask-Security write-behind login statistics module
+
+    :copyright: (c) 2019.
+    :license: MIT, see LICENSE for more details.
+"""
+
+import atexit
+import os
+import threading
+
+
+class TrackableBuffer(object):
+    """Collects ``SECURITY_TRACKABLE`` login statistics in memory and writes
+    them to the datastore from a background thread.
+
+    All the logins of a user since the last flush become a single update,
+    which sets the login times and IPs and adds the number of logins to
+    ``login_count`` in the datastore (see
+    :meth:`.UserDatastore.update_login_stats`) - so a busy account costs one
+    write per flush rather than a read-modify-write per login.
+
+    Pending statistics are flushed every ``interval`` seconds, as soon as
+    ``max_size`` users have some, and when the process exits (or on
+    :meth:`shutdown`). Statistics not yet flushed are lost if the process is
+    killed, and the user objects themselves aren't updated.
+
+    .. versionadded:: 3.3.0
+    """
+
+    def __init__(self, app, interval=5.0, max_size=1000):
+        self.app = app
+        self.interval = interval
+        self.max_size = max_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+        self._pid = None
+        self.flushed = 0
+
+    def _start(self):
+        # Started on first use (and again in a forked child, where the
+        # parent's thread doesn't exist) rather than at init_app time.
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(
+                target=self._run, name="flask-security-trackable"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            atexit.register(self.shutdown)
+
+    def record(self, user, login_at, ip):
+        """Add a login of ``user`` at ``login_at`` from ``ip``.
+
+        :return: ``False`` (and nothing is recorded) after :meth:`shutdown`.
+        """
+        if self._stopped.is_set():
+            return False
+        self._start()
+        with self._lock:
+            logins = self._pending.get(user.id)
+            if logins is None:
+                logins = self._pending[user.id] = dict(
+                    count=0,
+                    current_login_at=user.current_login_at,
+                    current_login_ip=user.current_login_ip,
+                )
+            logins["last_login_at"] = logins["current_login_at"] or login_at
+            logins["last_login_ip"] = logins["current_login_ip"]
+            logins["current_login_at"] = login_at
+            logins["current_login_ip"] = ip
+            logins["count"] += 1
+            full = len(self._pending) >= self.max_size
+        if full:
+            self._wakeup.set()
+        return True
+
+    def flush(self):
+        """Write everything pending to the datastore and commit.
+
+        :return: The number of users updated.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+        try:
+            with self.app.app_context():
+                datastore = self.app.extensions["security"].datastore
+                for user_id, logins in pending.items():
+                    logins = dict(logins)
+                    count = logins.pop("count")
+                    datastore.update_login_stats(user_id, count, **logins)
+                datastore.commit()
+        except Exception:
+            self._restore(pending)
+            raise
+        with self._lock:
+            self.flushed += len(pending)
+        return len(pending)
+
+    def _restore(self, pending):
+        # Put back what couldn't be written - merged with anything recorded
+        # since, keeping the latest login and the one before it.
+        with self._lock:
+            for user_id, logins in pending.items():
+                other = self._pending.get(user_id)
+                if other is None:
+                    self._pending[user_id] = logins
+                    continue
+                earlier, later = sorted(
+                    (logins, other), key=lambda entry: entry["current_login_at"]
+                )
+                merged = dict(later, count=logins["count"] + other["count"])
+                # The later entry's previous login is only one of its own if it
+                # has several - otherwise it came from the user, which the
+                # failed write didn't update.
+                if (
+                    later["count"] == 1
+                    or earlier["current_login_at"] > later["last_login_at"]
+                ):
+                    merged["last_login_at"] = earlier["current_login_at"]
+                    merged["last_login_ip"] = earlier["current_login_ip"]
+                self._pending[user_id] = merged
+
+    def shutdown(self, timeout=None):
+        """Stop the background thread and flush what is pending. After this
+        :func:`.login_user` updates the user itself again.
+        """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        if self._pid == os.getpid():
+            self._thread.join(timeout)
+        self._flush_logged()
+
+    def _flush_logged(self):
+        try:
+            self.flush()
+        except Exception:
+            self.app.logger.exception("Failed to write login statistics")
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            if not self._stopped.is_set():
+                self._flush_logged()
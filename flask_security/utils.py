@@ -15,17 +15,26 @@ from functools import partial
 import hashlib
 import hmac
 import sys
+import threading
 import warnings
 from contextlib import contextmanager
 from datetime import timedelta
 
-from flask import current_app, flash, request, session, url_for
+from flask import current_app, flash, g, request, session, url_for
 from flask.json import JSONEncoder
 from flask.signals import message_flashed
 from flask_login import login_user as _login_user
 from flask_login import logout_user as _logout_user
 from flask_mail import Message
-from flask_principal import AnonymousIdentity, Identity, identity_changed, Need
+from flask_principal import (
+    AnonymousIdentity,
+    Identity,
+    Need,
+    RoleNeed,
+    UserNeed,
+    identity_changed,
+    identity_loaded,
+)
 from flask_wtf import csrf
 from wtforms import ValidationError
 from itsdangerous import BadSignature, SignatureExpired
@@ -33,12 +42,20 @@ from speaklater import is_lazy_string
 from werkzeug.local import LocalProxy
 from werkzeug.datastructures import MultiDict
 
+from .hashing import HashingExecutor
+from .instrumentation import phase
+from .permissions import permission_registry
 from .signals import (
     login_instructions_sent,
     reset_password_instructions_sent,
     user_registered,
 )
 
+try:  # pragma: no cover
+    from collections.abc import Mapping
+except ImportError:  # pragma: no cover
+    from collections import Mapping
+
 try:  # pragma: no cover
     from urlparse import parse_qsl, urlsplit, urlunsplit
     from urllib import urlencode
@@ -66,6 +83,11 @@ else:  # pragma: no cover
     string_types = (basestring,)  # noqa
     text_type = unicode  # noqa
 
+_hashing_executor_lock = threading.Lock()
+
+# Distinct sets of roles (not users) are cached - so this is plenty.
+_ROLE_PROVIDES_CACHE_SIZE = 1000
+
 FsPermNeed = partial(Need, "fsperm")
 FsPermNeed.__doc__ = """A need with the method preset to `"fsperm"`."""
 
@@ -112,15 +134,19 @@ def login_user(user, remember=None):
             user.current_login_at,
             _security.datetime_factory(),
         )
-        old_current_ip, new_current_ip = user.current_login_ip, remote_addr
 
-        user.last_login_at = old_current_login or new_current_login
-        user.current_login_at = new_current_login
-        user.last_login_ip = old_current_ip
-        user.current_login_ip = new_current_ip
-        user.login_count = user.login_count + 1 if user.login_count else 1
+        # With write-behind the buffer updates the datastore later.
+        buffer = _security.trackable_buffer
+        if buffer is None or not buffer.record(user, new_current_login, remote_addr):
+            old_current_ip, new_current_ip = user.current_login_ip, remote_addr
 
-        _datastore.put(user)
+            user.last_login_at = old_current_login or new_current_login
+            user.current_login_at = new_current_login
+            user.last_login_ip = old_current_ip
+            user.current_login_ip = new_current_ip
+            user.login_count = user.login_count + 1 if user.login_count else 1
+
+            _datastore.put(user)
 
     session["fs_cc"] = "set"
 
@@ -153,6 +179,100 @@ def logout_user():
     _logout_user()
 
 
+def _role_provides(state, roles):
+    # The RoleNeeds and FsPermNeeds of a user with ``roles`` - memoized by the
+    # roles' names and permissions.
+    roles = list(roles)
+    key = []
+    for role in roles:
+        permissions = getattr(role, "permissions", None)
+        if permissions is not None and not isinstance(permissions, string_types):
+            permissions = tuple(permissions)
+        key.append((role.name, permissions))
+    key = tuple(key)
+    cache = state._role_provides_cache
+    provides = cache.get(key)
+    if provides is None:
+        needs = set()
+        for role in roles:
+            needs.add(RoleNeed(role.name))
+            for fsperm in permission_registry.role_permissions(role):
+                needs.add(FsPermNeed(fsperm))
+        provides = frozenset(needs)
+        if len(cache) >= _ROLE_PROVIDES_CACHE_SIZE:
+            cache.clear()
+        cache[key] = provides
+    return provides
+
+
+def _principal_provides(state, role_names, permission_mask):
+    # As _role_provides for a SecurityPrincipal's roles and permissions.
+    key = (role_names, permission_mask)
+    cache = state._role_provides_cache
+    provides = cache.get(key)
+    if provides is None:
+        needs = set(RoleNeed(name) for name in role_names)
+        for fsperm in permission_registry.names(permission_mask):
+            needs.add(FsPermNeed(fsperm))
+        provides = frozenset(needs)
+        if len(cache) >= _ROLE_PROVIDES_CACHE_SIZE:
+            cache.clear()
+        cache[key] = provides
+    return provides
+
+
+def _user_provides(state, user):
+    from .principal import SecurityPrincipal
+
+    if isinstance(user, SecurityPrincipal):
+        return _principal_provides(state, user.role_names, user.permission_mask)
+    return _role_provides(state, getattr(user, "roles", []))
+
+
+def _identity_hooked(state, app):
+    # True if anything besides Flask-Principal and Flask-Security itself wants
+    # to know about (or change) the identity. Only re-checked when receivers or
+    # savers come or go.
+    savers = state.principal.identity_savers
+    key = (tuple(identity_changed.receivers), tuple(identity_loaded.receivers))
+    cached = state._identity_hooked
+    if not savers and cached is not None and cached[0] == key:
+        return cached[1]
+    hooked = bool(savers)
+    for signal in (identity_changed, identity_loaded):
+        receivers = signal.receivers_for(app)
+        if next(receivers, None) is not None and next(receivers, None) is not None:
+            hooked = True
+    state._identity_hooked = (key, hooked)
+    return hooked
+
+
+def set_request_identity(user):
+    """Establish ``user`` as the Flask-Principal identity of this request.
+
+    Normally this sends ``identity_changed``. With
+    ``SECURITY_LIGHTWEIGHT_IDENTITY`` - and as long as the application hasn't
+    connected its own receivers to ``identity_changed`` or ``identity_loaded``
+    or added identity savers - ``g.identity`` is set directly, only once per
+    request, with needs that are shared by all users with the same roles.
+
+    .. versionadded:: 3.3.0
+    """
+    app = current_app._get_current_object()
+    state = app.extensions["security"]
+    if not state.lightweight_identity or _identity_hooked(state, app):
+        identity_changed.send(app, identity=Identity(user.id))
+        return
+    identity = g.get("identity")
+    if getattr(identity, "user", None) is user:
+        return
+    identity = Identity(user.id)
+    identity.provides.add(UserNeed(user.id))
+    identity.provides.update(_user_provides(state, user))
+    identity.user = user
+    g.identity = identity
+
+
 def get_hmac(password):
     """Returns a Base64 encoded HMAC+SHA512 of the password signed with
     the salt specified by ``SECURITY_PASSWORD_SALT``.
@@ -182,7 +302,37 @@ def verify_password(password, password_hash):
     if use_double_hash(password_hash):
         password = get_hmac(password)
 
-    return _pwd_context.verify(password, password_hash)
+    with phase("hash_verify"):
+        return _pwd_call("verify", password, password_hash)
+
+
+def _get_hashing_executor():
+    """Return the application's hashing executor - or None if passwords
+    should be hashed inline (``SECURITY_HASHING_EXECUTOR`` not set).
+    """
+    kind = config_value("HASHING_EXECUTOR")
+    if not kind:
+        return None
+    state = _security._get_current_object()
+    executor = getattr(state, "_hashing_executor", None)
+    if executor is None:
+        with _hashing_executor_lock:
+            executor = getattr(state, "_hashing_executor", None)
+            if executor is None:
+                executor = HashingExecutor(
+                    kind,
+                    max_workers=config_value("HASHING_EXECUTOR_WORKERS"),
+                    max_queue=config_value("HASHING_EXECUTOR_QUEUE_SIZE"),
+                )
+                state._hashing_executor = executor
+    return executor
+
+
+def _pwd_call(method, *args, **kwargs):
+    executor = _get_hashing_executor()
+    if executor is None:
+        return getattr(_pwd_context, method)(*args, **kwargs)
+    return executor.run(_pwd_context._get_current_object(), method, *args, **kwargs)
 
 
 def verify_and_update_password(password, user):
@@ -199,15 +349,19 @@ def verify_and_update_password(password, user):
     :param password: A plaintext password to verify
     :param user: The user to verify against
     """
-    if use_double_hash(user.password):
-        verified = _pwd_context.verify(get_hmac(password), user.password)
-    else:
-        # Try with original password.
-        verified = _pwd_context.verify(password, user.password)
+    with phase("hash_verify"):
+        if use_double_hash(user.password):
+            verified = _pwd_call("verify", get_hmac(password), user.password)
+        else:
+            # Try with original password.
+            verified = _pwd_call("verify", password, user.password)
 
     if verified and _pwd_context.needs_update(user.password):
-        user.password = hash_password(password)
-        _datastore.put(user)
+        if _security.deferred_rehasher:
+            _security.deferred_rehasher.submit(user, password)
+        else:
+            user.password = hash_password(password)
+            _datastore.put(user)
     return verified
 
 
@@ -236,15 +390,18 @@ def hash_password(password):
 
     :param password: The plaintext password to hash
     """
+    password, options = _hash_password_args(password)
+    return _pwd_call("hash", password, **options)
+
+
+def _hash_password_args(password):
+    # What to actually hand to passlib's hash() for this plaintext password.
     if use_double_hash():
         password = get_hmac(password).decode("ascii")
-
-    return _pwd_context.hash(
-        password,
-        **config_value("PASSWORD_HASH_OPTIONS", default={}).get(
-            _security.password_hash, {}
-        )
+    options = config_value("PASSWORD_HASH_OPTIONS", default={}).get(
+        _security.password_hash, {}
     )
+    return password, options
 
 
 def encode_string(string):
@@ -406,11 +563,68 @@ def get_config(app):
     prefix = "SECURITY_"
 
     def strip_prefix(tup):
-        return (tup[0].replace("SECURITY_", ""), tup[1])
+        return (tup[0].replace(prefix, "", 1), tup[1])
 
     return dict([strip_prefix(i) for i in items if i[0].startswith(prefix)])
 
 
+def _parse_within(txt):
+    values = txt.split()
+    return timedelta(**{values[1]: int(values[0])})
+
+
+class SecurityConfig(Mapping):
+    """Read-only snapshot of the Flask-Security configuration of an application.
+
+    Built once by :meth:`.Security.init_app` so that :func:`config_value` doesn't
+    have to scan ``app.config`` on every call. Keys don't have the
+    ``SECURITY_`` prefix. ``*_WITHIN`` values are pre-parsed into timedeltas and
+    ``USER_IDENTITY_ATTRIBUTES`` is pre-split.
+
+    Call :meth:`.Security.refresh_config` after changing settings at runtime.
+
+    .. versionadded:: 3.3.0
+    """
+
+    __slots__ = ("_values", "_within", "identity_attributes")
+
+    def __init__(self, app):
+        values = get_config(app)
+        within = {}
+        for key, value in values.items():
+            if key.endswith("_WITHIN"):
+                try:
+                    within[key] = _parse_within(value)
+                except (AttributeError, IndexError, TypeError, ValueError):
+                    # Let get_within_delta() complain if it is ever used.
+                    pass
+        object.__setattr__(self, "_values", values)
+        object.__setattr__(self, "_within", within)
+        attrs = _split_identity_attributes(values.get("USER_IDENTITY_ATTRIBUTES", []))
+        object.__setattr__(self, "identity_attributes", tuple(attrs))
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SecurityConfig is read-only")
+
+    def __getitem__(self, key):
+        return self._values[key]
+
+    def __iter__(self):
+        return iter(self._values)
+
+    def __len__(self):
+        return len(self._values)
+
+    def within(self, key):
+        """Return the pre-parsed timedelta for ``key`` (e.g. ``LOGIN_WITHIN``)."""
+        return self._within[key]
+
+
+def _get_compiled_config(app):
+    state = app.extensions.get("security", None)
+    return getattr(state, "_config", None)
+
+
 def get_message(key, **kwargs):
     rv = config_value("MSG_" + key)
     return localize_callback(rv[0], **kwargs), rv[1]
@@ -425,6 +639,9 @@ def config_value(key, app=None, default=None):
     :param default: An optional default value if the value is not set
     """
     app = app or current_app
+    compiled = _get_compiled_config(app)
+    if compiled is not None:
+        return compiled.get(key.upper(), default)
     return get_config(app).get(key.upper(), default)
 
 
@@ -448,9 +665,13 @@ def get_within_delta(key, app=None):
     :param app: Optional application to inspect. Defaults to Flask's
                 `current_app`
     """
-    txt = config_value(key, app=app)
-    values = txt.split()
-    return timedelta(**{values[1]: int(values[0])})
+    compiled = _get_compiled_config(app or current_app)
+    if compiled is not None:
+        try:
+            return compiled.within(key.upper())
+        except KeyError:
+            pass
+    return _parse_within(config_value(key, app=app))
 
 
 def send_mail(subject, recipient, template, **context):
@@ -481,6 +702,10 @@ def send_mail(subject, recipient, template, **context):
         _security._send_mail_task(msg)
         return
 
+    if _security.mail_dispatcher:
+        _security.mail_dispatcher.send(msg)
+        return
+
     mail = current_app.extensions.get("mail")
     mail.send(msg)
 
@@ -519,9 +744,7 @@ def get_token_status(token, serializer, max_age=None, return_data=False):
         return expired, invalid, user
 
 
-def get_identity_attributes(app=None):
-    app = app or current_app
-    attrs = app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"]
+def _split_identity_attributes(attrs):
     try:
         attrs = [f.strip() for f in attrs.split(",")]
     except AttributeError:
@@ -529,6 +752,30 @@ def get_identity_attributes(app=None):
     return attrs
 
 
+def get_identity_attributes(app=None):
+    app = app or current_app
+    compiled = _get_compiled_config(app)
+    if compiled is not None:
+        # A new list, as callers may change it.
+        return list(compiled.identity_attributes)
+    return _split_identity_attributes(app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"])
+
+
+#: Suffix of the column holding an identity attribute's normalized value.
+NORMALIZED_SUFFIX = "_normalized"
+
+
+def normalize_identity(value):
+    """Return the canonical form of an identity attribute value - as stored in
+    its ``<attr>_normalized`` column so it can be looked up by equality.
+
+    .. versionadded:: 3.3.0
+    """
+    if isinstance(value, string_types):
+        return value.lower()
+    return value
+
+
 def use_double_hash(password_hash=None):
     """Return a bool indicating whether a password should be hashed twice."""
     # Default to plaintext for backward compatibility with
@@ -54,6 +54,7 @@ from .confirmable import (
     send_confirmation_instructions,
 )
 from .decorators import anonymous_user_required, auth_required, unauth_csrf
+from .hashing import HashingExecutorBusy
 from .passwordless import login_token_status, send_login_instructions
 from .recoverable import (
     reset_password_token_status,
@@ -112,7 +113,11 @@ def _base_render_json(
                     config_value("BACKWARDS_COMPAT_AUTH_TOKEN")
                     or "include_auth_token" in request.args
                 ):
-                    token = user.get_auth_token()
+                    cache = _security.auth_token_cache
+                    if cache is not None:
+                        token = cache.get_auth_token(user)
+                    else:
+                        token = user.get_auth_token()
                     payload["user"]["authentication_token"] = token
 
         # Return csrf_token on each JSON response - just as every form
@@ -1008,6 +1013,15 @@ def two_factor_qrcode():
     )
 
 
+def _hashing_busy(error):
+    # The hashing executor is full - fail fast rather than queue the request.
+    m, c = get_message("PASSWORD_HASHING_BUSY")
+    if _security._want_json(request):
+        return _security._render_json(dict(errors=[m]), 503, None, None)
+    error.description = m
+    return error
+
+
 def _tf_illegal_state(form, redirect_to):
     m, c = get_message("TWO_FACTOR_PERMISSION_DENIED")
     if not request.is_json:
@@ -1031,6 +1045,8 @@ def create_blueprint(state, import_name, json_encoder=None):
     if json_encoder:
         bp.json_encoder = json_encoder
 
+    bp.register_error_handler(HashingExecutorBusy, _hashing_busy)
+
     bp.route(state.logout_url, methods=["GET", "POST"], endpoint="logout")(logout)
 
     if state.passwordless:
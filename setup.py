@@ -63,6 +63,7 @@ install_requires = [
     "itsdangerous>=1.1.0",
     "passlib>=1.7.1",
     "cachetools>=3.1.0",
+    "futures>=3.0.0; python_version<'3'",
 ]
 
 packages = find_packages()
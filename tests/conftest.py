@@ -426,6 +426,7 @@ def peewee_setup(request, app, tmpdir, realdburl):
         login_count = IntegerField(null=True)
         active = BooleanField(default=True)
         confirmed_at = DateTimeField(null=True)
+        fs_uniquifier = TextField(null=True)
 
     class UserRoles(db.Model):
         """ Peewee does not have built-in many-to-many support, so we have to
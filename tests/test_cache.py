@@ -6,8 +6,29 @@
     verify hash cache tests
 """
 
-from flask_security.cache import VerifyHashCache
-from flask_security.core import _request_loader, local_cache
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from utils import authenticate, init_app_with_options, json_authenticate, verify_token
+
+from flask_security.cache import (
+    AuthTokenCache,
+    InProcessBackend,
+    KeyValueBackend,
+    SessionUserCache,
+    SharedMemoryBackend,
+    TokenAuthCache,
+    VerifyHashCache,
+    VerifyHashCacheBackend,
+)
+from flask_security.core import RoleMixin, _request_loader, _user_loader
+from flask_security.permissions import permission_registry
+from flask_security.principal import SecurityPrincipal
 
 
 class MockRequest:
@@ -69,7 +90,7 @@ class MockExtensionSecurity:
     @property
     def datastore(self):
         class MockDataStore:
-            def find_user(self, id=None):
+            def find_auth_user(self, id=None):
                 return MockUser(id, "token")
 
         return MockDataStore()
@@ -86,14 +107,16 @@ class MockExtensionSecurity:
 def test_verify_password_cache_init(app):
     with app.app_context():
         vhc = VerifyHashCache()
-        assert len(vhc._cache) == 0
-        assert vhc._cache.ttl == 60 * 5
-        assert vhc._cache.maxsize == 500
+        assert len(vhc._backend) == 0
+        assert vhc.ttl == 60 * 5
+        assert vhc.maxsize == 500
+        assert sum(s.cache.maxsize for s in vhc._backend._shards) == 500
         app.config["SECURITY_VERIFY_HASH_CACHE_TTL"] = 10
         app.config["SECURITY_VERIFY_HASH_CACHE_MAX_SIZE"] = 10
         vhc = VerifyHashCache()
-        assert vhc._cache.ttl == 10
-        assert vhc._cache.maxsize == 10
+        assert vhc.ttl == 10
+        assert vhc.maxsize == 10
+        assert sum(s.cache.maxsize for s in vhc._backend._shards) == 10
 
 
 def test_verify_password_cache_set_get(app):
@@ -106,10 +129,11 @@ def test_verify_password_cache_set_get(app):
         vhc = VerifyHashCache()
         assert vhc.has_verify_hash_cache(user) is None
         vhc.set_cache(user)
-        assert len(vhc._cache) == 1
+        assert len(vhc._backend) == 1
         assert vhc.has_verify_hash_cache(user)
         vhc.clear()
         assert vhc.has_verify_hash_cache(user) is None
+        assert vhc.stats() == dict(hits=1, misses=2, evictions=0)
 
 
 def test_request_loader_not_using_cache(app):
@@ -117,7 +141,8 @@ def test_request_loader_not_using_cache(app):
         app.extensions["security"] = MockExtensionSecurity()
         with app.test_request_context("/"):
             _request_loader(MockRequest())
-            assert getattr(local_cache, "verify_hash_cache", None) is None
+            security = app.extensions["security"]
+            assert getattr(security, "_verify_hash_cache", None) is None
 
 
 def test_request_loader_using_cache(app):
@@ -127,7 +152,440 @@ def test_request_loader_using_cache(app):
         app.extensions["security"] = MockExtensionSecurity()
         with app.test_request_context("/"):
             _request_loader(MockRequest())
-            assert local_cache.verify_hash_cache is not None
-            assert local_cache.verify_hash_cache.has_verify_hash_cache(
-                MockUser(1, "token")
+            cache = app.extensions["security"]._verify_hash_cache
+            assert cache is not None
+            assert cache.has_verify_hash_cache(MockUser(1, "token"))
+
+            # Same cache is seen by other threads.
+            seen = []
+            thread = threading.Thread(
+                target=lambda: seen.append(
+                    cache is app.extensions["security"]._verify_hash_cache
+                )
             )
+            thread.start()
+            thread.join()
+            assert seen == [True]
+
+
+def test_verify_password_cache_evictions():
+    backend = InProcessBackend(60, 4, shards=1)
+    for i in range(10):
+        backend.set(str(i), b"1")
+    assert len(backend) == 4
+    assert backend.stats()["evictions"] == 6
+    assert backend.get("9") == b"1"
+    assert backend.get("0") is None
+    backend.delete("9")
+    assert backend.get("9") is None
+
+
+def test_verify_password_cache_concurrent(app):
+    class MockUser:
+        def __init__(self, id):
+            self.id = id
+
+    app.config["SECURITY_VERIFY_HASH_CACHE_MAX_SIZE"] = 100
+    with app.app_context():
+        vhc = VerifyHashCache()
+    errors = []
+
+    def worker(offset):
+        try:
+            for i in range(500):
+                user = MockUser((offset + i) % 150)
+                if not vhc.has_verify_hash_cache(user):
+                    vhc.set_cache(user)
+        except Exception as e:  # pragma: no cover
+            errors.append(e)
+
+    threads = [threading.Thread(target=worker, args=(n * 7,)) for n in range(16)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert not errors
+    assert len(vhc._backend) <= 100
+    stats = vhc.stats()
+    assert stats["hits"] + stats["misses"] == 16 * 500
+    assert stats["hits"] > 0
+    assert stats["evictions"] > 0
+
+
+class FakeRedis(object):
+    """Just enough of redis.Redis for KeyValueBackend."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key):
+        value, expires = self.data.get(key, (None, 0))
+        return value if expires > time.time() else None
+
+    def set(self, key, value, px=None):
+        if px is not None and px <= 0:
+            raise ValueError("invalid expire time in set")
+        self.data[key] = (value, time.time() + px / 1000.0)
+
+    def delete(self, key):
+        self.data.pop(key, None)
+
+    def scan_iter(self, match):
+        return [k for k in list(self.data) if k.startswith(match.rstrip("*"))]
+
+
+def _shm_setter(path, key):
+    SharedMemoryBackend(60, 64, path=path).set(key, b"1")
+
+
+@pytest.mark.skipif(os.name != "posix", reason="requires fcntl")
+@pytest.mark.skipif(sys.version_info[0] < 3, reason="requires get_context")
+def test_shared_memory_backend(tmpdir):
+    path = str(tmpdir.join("vhc"))
+    backend = SharedMemoryBackend(60, 64, path=path)
+    assert backend.get("1") is None
+    backend.set("1", b"1")
+    assert backend.get("1") == b"1"
+
+    # Another process sees (and adds to) the same entries.
+    ctx = multiprocessing.get_context("fork")
+    p = ctx.Process(target=_shm_setter, args=(path, "2"))
+    p.start()
+    p.join()
+    assert p.exitcode == 0
+    assert backend.get("2") == b"1"
+
+    backend.delete("1")
+    assert backend.get("1") is None
+    backend.clear()
+    assert backend.get("2") is None
+    assert backend.stats()["hits"] == 2
+
+    with pytest.raises(ValueError):
+        SharedMemoryBackend(60, 32, path=path)
+    with pytest.raises(ValueError):
+        backend.set("3", b"x" * 100)
+    backend.close()
+
+
+def _check_fork_lock(backend, work):
+    """Fork while holding ``backend``'s lock, check the child is excluded by
+    it and, once released, that ``work()`` succeeds in the child."""
+    import fcntl
+
+    tried_r, tried_w = os.pipe()
+    # Held by the parent across the fork - as a preforked server's master
+    # process might.
+    fcntl.flock(backend._fd, fcntl.LOCK_EX)
+    pid = os.fork()
+    if pid == 0:  # pragma: no cover
+        code = 1
+        try:
+            try:
+                with backend._locked(fcntl.LOCK_EX | fcntl.LOCK_NB):
+                    pass
+            except (IOError, OSError):
+                # Excluded by the parent.
+                code = 0
+            os.write(tried_w, b"x")
+            if code == 0:
+                # Waits for the parent - then works as usual.
+                code = 0 if work() else 2
+        finally:
+            os._exit(code)
+    try:
+        assert os.read(tried_r, 1) == b"x"
+    finally:
+        fcntl.flock(backend._fd, fcntl.LOCK_UN)
+    assert os.waitpid(pid, 0)[1] == 0
+
+
+@pytest.mark.skipif(os.name != "posix", reason="requires fcntl")
+def test_shared_memory_backend_fork_lock(tmpdir):
+    backend = SharedMemoryBackend(60, 64, path=str(tmpdir.join("vhc")))
+    backend.set("1", b"1")
+
+    def work():
+        backend.set("2", b"2")
+        return backend.get("1") == b"1"
+
+    _check_fork_lock(backend, work)
+    assert backend.get("2") == b"2"
+    backend.close()
+
+
+@pytest.mark.skipif(os.name != "posix", reason="requires fcntl")
+def test_shared_memory_backend_expiry_eviction(tmpdir):
+    backend = SharedMemoryBackend(60, 4, path=str(tmpdir.join("vhc")), probes=4)
+    for i in range(10):
+        backend.set(str(i), b"1")
+    assert backend.get("9") == b"1"
+    assert backend.stats()["evictions"] == 6
+
+    backend = SharedMemoryBackend(-1, 8, path=str(tmpdir.join("vhc2")))
+    backend.set("1", b"1")
+    assert backend.get("1") is None
+
+
+def test_key_value_backend():
+    client = FakeRedis()
+    client.set("other", b"x", px=60000)
+    backend = KeyValueBackend(60, 500, client=client, prefix="app1:")
+    assert backend.get("1") is None
+    backend.set("1", b"1")
+    assert client.get("app1:1") == b"1"
+    assert backend.get("1") == b"1"
+    backend.delete("1")
+    assert backend.get("1") is None
+    backend.set("2", b"1")
+    backend.clear()
+    assert backend.get("2") is None
+    assert client.get("other") == b"x"
+    assert backend.stats() == dict(hits=1, misses=3, evictions=0)
+
+    with pytest.raises(ValueError):
+        KeyValueBackend(60, 500)
+
+
+def test_key_value_backend_subsecond_ttl():
+    client = FakeRedis()
+    backend = KeyValueBackend(0.5, 500, client=client)
+    backend.set("1", b"1")
+    assert backend.get("1") == b"1"
+
+
+def test_backend_abstract():
+    class Incomplete(VerifyHashCacheBackend):
+        def get(self, key):
+            return None
+
+    with pytest.raises(TypeError):
+        Incomplete(60, 10)
+
+
+def test_verify_password_cache_backend_config(app):
+    class MockUser:
+        def __init__(self, id):
+            self.id = id
+
+    client = FakeRedis()
+    app.config["SECURITY_VERIFY_HASH_CACHE_BACKEND"] = "key_value"
+    app.config["SECURITY_VERIFY_HASH_CACHE_BACKEND_CONFIG"] = {"client": client}
+    with app.app_context():
+        vhc = VerifyHashCache()
+        assert isinstance(vhc._backend, KeyValueBackend)
+        vhc.set_cache(MockUser(1))
+        assert vhc.has_verify_hash_cache(MockUser(1))
+        assert "fs_vhc:1" in client.data
+
+
+def test_token_auth_cache(app):
+    class MockRole(RoleMixin):
+        def __init__(self, name, permissions):
+            self.name = name
+            self.permissions = permissions
+
+    user = MockUser(1, "token")
+    user.fs_uniquifier = "uniq"
+    user.roles = [MockRole("admin", "super,read")]
+
+    app.config["SECURITY_TOKEN_MAX_AGE"] = 10
+    with app.app_context():
+        cache = TokenAuthCache()
+    # Never cache longer than a token is valid.
+    assert cache.ttl == 10
+    assert cache.get("token") is None
+    cache.set("token", user, expires=time.time() + 10)
+    principal = cache.get("token")
+    assert isinstance(principal, SecurityPrincipal)
+    assert principal.astuple() == (
+        1,
+        "uniq",
+        True,
+        frozenset(["admin"]),
+        permission_registry.mask(["super", "read"]),
+    )
+    # Principals for the same user are equal - and hash the same.
+    again = cache.get("token")
+    assert again is not principal
+    assert again == principal
+    assert len(set([principal, again])) == 1
+    assert cache.get("other") is None
+    cache.invalidate(2)
+    assert cache.get("token") is not None
+    cache.invalidate(1)
+    assert cache.get("token") is None
+
+    # token itself expired
+    cache.set("token", user, expires=time.time() - 1)
+    assert cache.get("token") is None
+
+    # A user loaded before an invalidation isn't cached after it.
+    loaded = time.time()
+    cache.invalidate(1)
+    cache.set("token", user, loaded=loaded)
+    assert cache.get("token") is None
+    cache.set("token", user, loaded=time.time() + 1)
+    assert cache.get("token") is not None
+
+
+def test_auth_token_cache():
+    class MintingUser(MockUser):
+        minted = 0
+        fs_uniquifier = None
+
+        def get_auth_token(self):
+            self.minted += 1
+            return "token-%d-%s" % (self.minted, self.fs_uniquifier)
+
+    user = MintingUser(1, "hash")
+    user.fs_uniquifier = "uniq"
+    cache = AuthTokenCache(ttl=60, max_age=10)
+    assert cache.ttl == 10
+    assert cache.get_auth_token(user) == "token-1-uniq"
+    assert cache.get_auth_token(user) == "token-1-uniq"
+
+    user.password = "new hash"
+    assert cache.get_auth_token(user) == "token-2-uniq"
+    user.fs_uniquifier = "new uniq"
+    assert cache.get_auth_token(user) == "token-3-new uniq"
+    assert cache.get_auth_token(MintingUser(2, "hash")) != "token-3-new uniq"
+
+
+@pytest.mark.settings(use_auth_token_cache=True)
+def test_auth_token_cache_login(app, client_nc):
+    assert app.security.auth_token_cache is not None
+    tokens = set()
+    for _ in range(3):
+        response = json_authenticate(client_nc)
+        assert response.status_code == 200
+        tokens.add(response.json["response"]["user"]["authentication_token"])
+    assert len(tokens) == 1
+    old_token = tokens.pop()
+    verify_token(client_nc, old_token)
+
+    with app.app_context():
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        app.security.datastore.set_uniquifier(user)
+        app.security.datastore.commit()
+    response = json_authenticate(client_nc)
+    token = response.json["response"]["user"]["authentication_token"]
+    assert token != old_token
+    verify_token(client_nc, token)
+    verify_token(client_nc, old_token, status=401)
+
+
+def test_session_user_cache():
+    class Role(RoleMixin):
+        def __init__(self, name, permissions):
+            self.name = name
+            self.permissions = permissions
+
+    class User(object):
+        id = 4
+        fs_uniquifier = "uniq"
+        active = True
+        roles = [Role("admin", "read,write"), Role("editor", None)]
+
+    expected = (
+        4,
+        "uniq",
+        True,
+        frozenset(["admin", "editor"]),
+        permission_registry.mask(["read", "write"]),
+    )
+    for cache in (
+        SessionUserCache(),
+        SessionUserCache(backend="key_value", backend_options=dict(client=FakeRedis())),
+    ):
+        assert cache.get(4) is None
+        cache.set(User())
+        assert cache.get(4).astuple() == expected
+        assert cache.get("4").astuple() == expected
+        cache.invalidate(4)
+        assert cache.get(4) is None
+        cache.set(User())
+        cache.clear()
+        assert cache.get(4) is None
+
+    client = FakeRedis()
+    SessionUserCache(backend="key_value", backend_options=dict(client=client)).set(
+        User()
+    )
+    assert client.get("fs_suc:4") is not None
+
+
+@pytest.mark.skipif(os.name != "posix", reason="requires fcntl")
+def test_session_user_cache_shared_memory_fork(app, sqlalchemy_datastore, tmpdir):
+    # init_app creates the cache (and maps its file) before a preforking server
+    # forks its workers - which must still exclude each other.
+    init_app_with_options(
+        app,
+        sqlalchemy_datastore,
+        SECURITY_USE_SESSION_USER_CACHE=True,
+        SECURITY_SESSION_USER_CACHE_BACKEND="shared_memory",
+        SECURITY_SESSION_USER_CACHE_BACKEND_CONFIG=dict(
+            path=str(tmpdir.join("suc")), value_size=256
+        ),
+    )
+    cache = app.security.session_user_cache
+    with app.app_context():
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        cache.set(user)
+        user_id = user.id
+
+    class User(object):
+        id = "other"
+        fs_uniquifier = None
+        active = True
+        roles = []
+
+    def work():
+        cache.set(User())
+        return cache.get(user_id).has_role("admin")
+
+    _check_fork_lock(cache._backend, work)
+    assert cache.get("other").active
+
+
+@pytest.mark.settings(use_session_user_cache=True)
+def test_session_user_cache_login(app, client):
+    cache = app.security.session_user_cache
+    assert cache is not None
+    authenticate(client)
+    with app.app_context():
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        user_id = user.id
+    # Logging in sets the user directly - it is cached once loaded.
+    assert cache.get(user_id) is None
+    assert client.get("/profile").status_code == 200
+    assert cache.get(user_id) is not None
+
+    lookups = []
+    find_user = app.security.datastore.find_user
+
+    def counting_find_user(**kwargs):
+        lookups.append(kwargs)
+        return find_user(**kwargs)
+
+    app.security.datastore.find_user = counting_find_user
+    try:
+        with app.test_request_context("/profile"):
+            loaded = _user_loader(user_id)
+            assert isinstance(loaded, SecurityPrincipal)
+            assert loaded.has_role("admin")
+            assert not lookups
+            # Anything not in the snapshot is loaded on demand.
+            assert loaded.email == "matt@lp.com"
+            assert len(lookups) == 1
+        assert client.get("/profile").status_code == 200
+    finally:
+        app.security.datastore.find_user = find_user
+
+    with app.app_context():
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        app.security.datastore.deactivate_user(user)
+        app.security.datastore.commit()
+    assert cache.get(user_id) is None
+    assert client.get("/profile").status_code == 302
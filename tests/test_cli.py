@@ -6,16 +6,33 @@
     Test command line interface.
 """
 
+import json
+
 from click.testing import CliRunner
 
+try:
+    from flask.cli import ScriptInfo
+except ImportError:
+    from flask_cli import ScriptInfo
+
+from flask_security import (
+    MongoEngineUserDatastore,
+    PeeweeUserDatastore,
+    Security,
+    SQLAlchemyUserDatastore,
+)
 from flask_security.cli import (
     roles_add,
     roles_create,
     roles_remove,
+    security_calibrate_hash,
     users_activate,
     users_create,
     users_deactivate,
+    users_import,
+    users_normalize_identities,
 )
+from flask_security.utils import hash_password, verify_password
 
 
 def test_cli_createuser(script_info):
@@ -149,3 +166,247 @@ def test_cli_activate_deactivate(script_info):
     assert result.exit_code == 0
     result = runner.invoke(users_deactivate, ["a@example.org"], obj=script_info)
     assert result.exit_code == 0
+
+
+def test_cli_import_users(script_info, tmpdir):
+    """Test bulk user import CLI."""
+    runner = CliRunner()
+    result = runner.invoke(roles_create, ["superuser"], obj=script_info)
+    assert result.exit_code == 0
+
+    app = script_info.load_app()
+    app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"] = "email, username"
+    app.security.refresh_config()
+    with app.app_context():
+        hashed = hash_password("prehashed")
+
+    users = tmpdir.join("users.csv")
+    users.write(
+        "email,username,security_number,password,password_hash,roles,active\n"
+        "a@example.org,a,1,123456,,superuser,yes\n"
+        "b@example.org,b,2,,%s,,no\n"
+        "c@example.org,c,3,123456,,nosuchrole,\n"
+        "a@example.org,a2,4,123456,,,\n"
+        ",d,5,123456,,,\n"
+        "e@example.org,e,6,,,,\n"
+        "f@example.org,f,7,123456,,,\n"
+        "not-an-email,g,8,123456,,,\n"
+        "h@example.org,h,9,123,,,\n"
+        "i@example.org,f,10,123456,,,\n" % hashed
+    )
+    rejects = tmpdir.join("rejects.jsonl")
+    result = runner.invoke(
+        users_import,
+        [str(users), "-b", "2", "-w", "0", "-r", str(rejects)],
+        obj=script_info,
+    )
+    assert result.exit_code == 0, result.output
+    assert "Imported 3 users, rejected 7." in result.output
+
+    errors = [json.loads(line) for line in rejects.readlines()]
+    assert [e["line"] for e in errors] == [4, 5, 6, 7, 9, 10, 11]
+    assert "nosuchrole" in errors[0]["error"]
+    assert errors[0]["row"]["password"] == "****"
+    # Register form validation
+    assert "Invalid email address" in errors[4]["error"]
+    assert "Password must be at least 6 characters" in errors[5]["error"]
+    # A string of identity attributes works too.
+    assert "username f already exists" in errors[6]["error"]
+
+    with app.app_context():
+        datastore = app.security.datastore
+        a = datastore.find_user(email="a@example.org")
+        assert a.active
+        assert [r.name for r in a.roles] == ["superuser"]
+        assert verify_password("123456", a.password)
+        b = datastore.find_user(email="b@example.org")
+        assert not b.active
+        assert b.password == hashed
+        assert datastore.find_user(email="c@example.org") is None
+
+    # Re-running skips everything already imported - without looking up the
+    # users one at a time.
+    datastore = app.security.datastore
+    datastore.find_user = None
+    try:
+        result = runner.invoke(
+            users_import, [str(users), "-w", "0", "-r", str(rejects)], obj=script_info,
+        )
+    finally:
+        del datastore.find_user
+    assert result.exit_code == 0, result.output
+    assert "Imported 0 users, rejected 10." in result.output
+    # Neither passwords nor their hashes end up in the rejects file.
+    errors = {e["line"]: e for e in map(json.loads, rejects.readlines())}
+    assert errors[3]["row"]["password_hash"] == "****"
+    assert hashed not in rejects.read()
+
+
+def test_cli_import_users_failed_batch(script_info, tmpdir):
+    """Test that a batch that fails to commit is rolled back and rejected."""
+    runner = CliRunner()
+    app = script_info.load_app()
+    datastore = app.security.datastore
+    users = tmpdir.join("users.csv")
+    users.write(
+        "email,username,security_number,password\n"
+        "a@example.org,a,1,123456\n"
+        "b@example.org,b,2,123456\n"
+        "c@example.org,c,3,123456\n"
+    )
+    create_users = datastore.create_users
+
+    def failing_create_users(users):
+        created = create_users(users)
+        if any(kwargs["email"] == "b@example.org" for kwargs in users):
+            raise RuntimeError("no space left")
+        return created
+
+    rejects = tmpdir.join("rejects.jsonl")
+    datastore.create_users = failing_create_users
+    try:
+        result = runner.invoke(
+            users_import,
+            [str(users), "-b", "2", "-w", "0", "-r", str(rejects)],
+            obj=script_info,
+        )
+    finally:
+        del datastore.create_users
+    assert result.exit_code == 0, result.output
+    assert "Imported 1 users, rejected 2." in result.output
+    errors = [json.loads(line) for line in rejects.readlines()]
+    assert [e["line"] for e in errors] == [2, 3]
+    assert "no space left" in errors[1]["error"]
+
+    with app.app_context():
+        assert datastore.find_user(email="c@example.org") is not None
+        assert datastore.find_user(email="b@example.org") is None or (
+            isinstance(datastore, MongoEngineUserDatastore)
+        )
+        if not isinstance(datastore, MongoEngineUserDatastore):
+            assert datastore.find_user(email="a@example.org") is None
+
+
+def test_cli_import_users_jsonl(script_info, tmpdir):
+    """Test bulk user import CLI with JSON lines and a process pool."""
+    runner = CliRunner()
+    users = tmpdir.join("users.jsonl")
+    users.write(
+        '{"email": "a@example.org", "username": "a", "security_number": 1,'
+        ' "password": "123456"}\n'
+        "\n"
+        "not json\n"
+        '{"email": "b@example.org", "username": "b", "security_number": 2,'
+        ' "password": "123456"}\n'
+    )
+    result = runner.invoke(users_import, [str(users), "-w", "1"], obj=script_info)
+    assert result.exit_code == 0, result.output
+    assert "Imported 2 users, rejected 1." in result.output
+
+    app = script_info.load_app()
+    with app.app_context():
+        user = app.security.datastore.find_user(email="b@example.org")
+        assert verify_password("123456", user.password)
+
+
+def test_cli_normalize_identities(script_info):
+    """Test normalize-identities on a datastore without normalized columns."""
+    runner = CliRunner()
+    result = runner.invoke(users_normalize_identities, [], obj=script_info)
+    datastore = script_info.load_app().security.datastore
+    if isinstance(datastore, (SQLAlchemyUserDatastore, PeeweeUserDatastore)):
+        # The test model has no <attr>_normalized columns - nothing to change.
+        assert result.exit_code == 0, result.output
+        assert "Normalized 0 users." in result.output
+    else:
+        assert result.exit_code == 2
+        assert "does not support" in result.output
+
+
+def test_cli_normalize_identities_backfill(app):
+    """Test normalize-identities fills in the columns of existing users."""
+    from flask_sqlalchemy import SQLAlchemy
+    from flask_security.models import fsqla_v2 as fsqla
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"] = ("email", "username")
+    db = SQLAlchemy(app)
+    fsqla.FsModels.set_db_info(db)
+
+    class Role(db.Model, fsqla.FsRoleMixin):
+        pass
+
+    class User(db.Model, fsqla.FsUserMixin):
+        pass
+
+    datastore = SQLAlchemyUserDatastore(db, User, Role)
+    app.security = Security(app, datastore=datastore)
+    with app.app_context():
+        db.create_all()
+        for name in ("Matt", "Joe", "Jill"):
+            datastore.create_user(
+                email="%s@LP.com" % name, username=name, password="password"
+            )
+        datastore.commit()
+        # As if the columns had just been added.
+        User.query.filter(User.username != "Jill").update(
+            {"email_normalized": None, "username_normalized": None}
+        )
+        datastore.commit()
+
+    script_info = ScriptInfo(create_app=lambda info: app)
+    runner = CliRunner()
+    result = runner.invoke(users_normalize_identities, ["-b", "1"], obj=script_info)
+    assert result.exit_code == 0, result.output
+    assert "Normalized 2 users." in result.output
+
+    app.config["SECURITY_USE_NORMALIZED_IDENTITY"] = True
+    app.security.refresh_config()
+    with app.app_context():
+        assert datastore.get_user("matt@lp.com").username == "Matt"
+        assert datastore.get_user("joe").email == "Joe@LP.com"
+        assert datastore.get_user("JILL@lp.com").username == "Jill"
+
+    result = runner.invoke(users_normalize_identities, [], obj=script_info)
+    assert "Normalized 0 users." in result.output
+
+
+def test_cli_calibrate_hash(script_info):
+    """Test calibrate-hash CLI."""
+    runner = CliRunner()
+    result = runner.invoke(
+        security_calibrate_hash,
+        ["-s", "pbkdf2_sha256", "-s", "plaintext", "-t", "5", "-n", "1", "-w", "1"],
+        obj=script_info,
+    )
+    assert result.exit_code == 0, result.output
+    assert "plaintext: fixed cost" in result.output
+    assert "pbkdf2_sha256: rounds=" in result.output
+    assert "ms HMAC" in result.output
+    assert "hashes/s with 1 processes" in result.output
+    assert 'SECURITY_PASSWORD_HASH_OPTIONS = {"pbkdf2_sha256": {"rounds": ' in (
+        result.output
+    )
+
+    result = runner.invoke(
+        security_calibrate_hash, ["-s", "nosuch", "-w", "0"], obj=script_info
+    )
+    assert result.exit_code == 2
+    assert "Unknown password scheme: nosuch" in result.output
+
+
+def test_cli_calibrate_hash_no_futures(script_info, monkeypatch):
+    """Test calibrate-hash without concurrent.futures (e.g. Python 2)."""
+    import sys
+
+    monkeypatch.setitem(sys.modules, "concurrent.futures", None)
+    runner = CliRunner()
+    result = runner.invoke(
+        security_calibrate_hash,
+        ["-s", "pbkdf2_sha256", "-t", "5", "-n", "1", "-w", "2"],
+        obj=script_info,
+    )
+    assert result.exit_code == 0, result.output
+    assert "concurrent.futures is not available" in result.output
+    assert "pbkdf2_sha256: rounds=" in result.output
+    assert "hashes/s" not in result.output
@@ -427,6 +427,29 @@ def test_multi_auth_session(client):
     assert b"Session" in response.data
 
 
+def test_auth_mechanism_prechecks(app, client):
+    from flask_security.decorators import _has_basic_auth, _has_session, _has_token
+
+    def present(**kwargs):
+        with app.test_request_context("/multi_auth", **kwargs):
+            return _has_token(), _has_session(), _has_basic_auth()
+
+    assert present() == (False, False, False)
+    assert present(headers={"Authentication-Token": "x"}) == (True, True, False)
+    assert present(query_string={"auth_token": "x"}) == (True, True, False)
+    assert present(json={"auth_token": "x"}) == (True, True, False)
+    assert present(json={"email": "x"}) == (False, False, False)
+    assert present(headers={"Authorization": "Basic x"}) == (False, False, True)
+    cookie = {"Cookie": "session=x"}
+    assert present(headers=cookie) == (False, True, False)
+    cookie = {"Cookie": "remember_token=x"}
+    assert present(headers=cookie) == (False, True, False)
+
+    # Nothing to authenticate with - so none of the mechanisms is tried.
+    response = client.get("/multi_auth", headers={"Accept": "application/json"})
+    assert response.status_code == 401
+
+
 def test_user_deleted_during_session_reverts_to_anonymous_user(app, client):
     authenticate(client)
 
@@ -588,6 +611,156 @@ def test_token_query(in_app_context):
     assert current_nqueries is None or end_nqueries == (current_nqueries + 1)
 
 
+@pytest.mark.settings(use_token_auth_cache=True)
+def test_token_auth_cache(in_app_context):
+    # Once a token has been verified, further requests with it need no DB query.
+    from flask_security import (
+        auth_token_required,
+        permissions_required,
+        roles_required,
+    )
+
+    app = in_app_context
+    populate_data(app)
+
+    # Unlike the standard test views, these don't render any user attributes.
+    @app.route("/token_cached")
+    @auth_token_required
+    @permissions_required("super")
+    def token_cached():
+        return "cached"
+
+    @app.route("/token_cached_editor")
+    @auth_token_required
+    @roles_required("editor")
+    def token_cached_editor():
+        return "cached"
+
+    client_nc = app.test_client(use_cookies=False)
+    response = json_authenticate(client_nc)
+    token = response.jdata["response"]["user"]["authentication_token"]
+    headers = {"Content-Type": "application/json", "Authentication-Token": token}
+    response = client_nc.get("/token_cached", headers=headers)
+    assert response.status_code == 200
+
+    current_nqueries = get_num_queries(app.security.datastore)
+    response = client_nc.get("/token_cached", headers=headers)
+    assert response.status_code == 200
+    # roles and permissions come from the cached snapshot as well.
+    response = client_nc.get("/token_cached_editor", headers=headers)
+    assert response.status_code == 403
+    end_nqueries = get_num_queries(app.security.datastore)
+    assert current_nqueries is None or end_nqueries == current_nqueries
+
+    # deactivating the user drops the cached authentication
+    with app.test_request_context("/"):
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        app.security.datastore.deactivate_user(user)
+        app.security.datastore.commit()
+    verify_token(client_nc, token, status=401)
+
+
+@pytest.mark.settings(use_token_auth_cache=True)
+def test_token_auth_cache_invalidation(app, client_nc):
+    from flask_security.signals import password_changed
+
+    response = json_authenticate(client_nc)
+    token = response.jdata["response"]["user"]["authentication_token"]
+    verify_token(client_nc, token)
+    cache = app.security._token_auth_cache
+    assert cache.get(token) is not None
+
+    with app.test_request_context("/"):
+        user = app.security.datastore.find_user(email="matt@lp.com")
+        password_changed.send(app, user=user)
+        assert cache.get(token) is None
+        verify_token(client_nc, token)
+        assert cache.get(token) is not None
+
+        app.security.datastore.remove_role_from_user(user, "admin")
+        app.security.datastore.commit()
+        assert cache.get(token) is None
+        # new roles are seen
+        response = client_nc.get("/admin_perm", headers={"Authentication-Token": token})
+        assert response.status_code == 403
+
+        app.security.datastore.set_uniquifier(user)
+        app.security.datastore.commit()
+    verify_token(client_nc, token, status=401)
+
+
+@pytest.mark.settings(use_token_auth_cache=True)
+def test_token_auth_cache_principal(app, client_nc):
+    from flask_principal import RoleNeed
+
+    from flask_security import SecurityPrincipal
+
+    response = json_authenticate(client_nc)
+    token = response.jdata["response"]["user"]["authentication_token"]
+    verify_token(client_nc, token)
+
+    with app.test_request_context("/"):
+        user = app.security._token_auth_cache.get(token)
+        assert isinstance(user, SecurityPrincipal)
+        assert not hasattr(user, "__dict__")
+        assert user.is_authenticated and user.is_active
+        assert user.has_role("admin") and not user.has_role("editor")
+        assert user.has_permission("super") and not user.has_permission("nope")
+        assert RoleNeed("admin") in user.needs()
+        assert user._fs_model is None
+        # anything else comes from the real user
+        assert user.email == "matt@lp.com"
+        model = user._fs_model
+        assert model is not None and model == user and user == model
+        # The model overrides get_security_payload
+        assert user.get_security_payload() == model.get_security_payload()
+        assert user.has_role(model.roles[0])
+        user.username = "newmatt"
+        assert app.security.datastore.put(user) is model
+        app.security.datastore.commit()
+        assert app.security.datastore.find_user(username="newmatt").id == user.id
+
+
+@pytest.mark.settings(phase_timing=True)
+def test_phase_timing(app, client):
+    from flask_security.signals import request_timed
+
+    recorded = []
+
+    def on_timed(sender, timings):
+        recorded.append(timings)
+
+    with request_timed.connected_to(on_timed):
+        response = json_authenticate(client)
+        assert response.status_code == 200
+        token = response.jdata["response"]["user"]["authentication_token"]
+        assert {"form_validation", "datastore_lookup", "hash_verify"} <= set(
+            recorded[-1]
+        )
+
+        client.get("/login")
+        assert "template_render" in recorded[-1]
+
+        verify_token(app.test_client(use_cookies=False), token)
+        assert {
+            "token_decode",
+            "datastore_lookup",
+            "hash_verify",
+            "identity_load",
+        } <= set(recorded[-1])
+        assert all(t >= 0 for t in recorded[-1].values())
+
+    stats = app.security.phase_histograms.stats()
+    assert stats["hash_verify"]["count"] == 2
+    assert sum(c for _, c in stats["hash_verify"]["buckets"]) == 2
+    assert stats["hash_verify"]["buckets"][-1][0] is None
+
+
+def test_phase_timing_disabled(app, client):
+    json_authenticate(client)
+    assert app.security.phase_histograms.stats() == {}
+
+
 def test_session_query(in_app_context):
     # Verify that when authenticating with auth token (but also sending session)
     # that there are 2 DB queries to get user.
@@ -609,3 +782,121 @@ def test_session_query(in_app_context):
     assert response.status_code == 200
     end_nqueries = get_num_queries(app.security.datastore)
     assert current_nqueries is None or end_nqueries == (current_nqueries + 2)
+
+
+@pytest.mark.settings(lightweight_identity=True)
+def test_lightweight_identity(app, client_nc):
+    from flask_principal import identity_changed
+    from flask_security import auth_token_required, permissions_required
+
+    @app.route("/token_perm")
+    @auth_token_required
+    @permissions_required("full-write", "super")
+    def token_perm():
+        return "Token and permissions"
+
+    sent = []
+    send = identity_changed.send
+
+    def spy(*args, **kwargs):
+        sent.append(kwargs["identity"])
+        return send(*args, **kwargs)
+
+    identity_changed.send = spy
+    try:
+        tokens = {}
+        for email in ("matt@lp.com", "joe@lp.com"):
+            response = json_authenticate(client_nc, email=email)
+            tokens[email] = response.jdata["response"]["user"]["authentication_token"]
+        del sent[:]
+
+        headers = {"Authentication-Token": tokens["matt@lp.com"]}
+        response = client_nc.get("/token_perm", headers=headers)
+        assert response.data == b"Token and permissions"
+        headers = {"Authentication-Token": tokens["joe@lp.com"]}
+        response = client_nc.get("/token_perm", headers=headers)
+        assert response.status_code == 403
+        assert sent == []
+
+        # An application receiver still gets the signal.
+        changed = []
+        receiver = identity_changed.connect_via(app)(
+            lambda sender, identity: changed.append(identity.id)
+        )
+        headers = {"Authentication-Token": tokens["matt@lp.com"]}
+        response = client_nc.get("/token_perm", headers=headers)
+        assert response.status_code == 200
+        assert len(changed) == 1
+        identity_changed.disconnect(receiver)
+    finally:
+        identity_changed.send = send
+
+
+def test_decorator_needs(in_app_context):
+    # The precomputed decorator checks against Flask-Principal's own.
+    import itertools
+    from flask import g
+    from flask_principal import AnonymousIdentity, Identity, Permission, RoleNeed
+    from flask_security import (
+        permissions_accepted,
+        permissions_required,
+        roles_accepted,
+        roles_required,
+    )
+    from flask_security.utils import FsPermNeed
+
+    app = in_app_context
+    app.security.unauthz_handler(lambda func, params: "denied")
+
+    def check(decorator, *args):
+        return decorator(*args)(lambda: "allowed")()
+
+    decorators = (
+        roles_required,
+        roles_accepted,
+        permissions_required,
+        permissions_accepted,
+    )
+    with app.test_request_context("/"):
+        # Empty requirements allow anyone, as an empty Permission does.
+        for identity in (None, AnonymousIdentity(), Identity(1)):
+            g.identity = identity
+            for decorator in decorators:
+                assert check(decorator) == "allowed"
+
+        # No identity, or an anonymous one, provides nothing.
+        for identity in (None, AnonymousIdentity()):
+            g.identity = identity
+            for decorator in decorators:
+                assert check(decorator, "admin") == "denied"
+                assert check(decorator, "admin", "editor") == "denied"
+
+        # Permissions first seen after the view was decorated.
+        view = permissions_required("fresh-perm", "fresher-perm")(lambda: "allowed")
+        view_accepted = permissions_accepted("fresh-perm")(lambda: "allowed")
+        identity = g.identity = Identity(1)
+        identity.provides.add(FsPermNeed("fresh-perm"))
+        assert view() == "denied"
+        assert view_accepted() == "allowed"
+        identity.provides.add(FsPermNeed("fresher-perm"))
+        assert view() == "allowed"
+
+        names = ("admin", "editor", "author")
+        for required, accepted, need in (
+            (roles_required, roles_accepted, RoleNeed),
+            (permissions_required, permissions_accepted, FsPermNeed),
+        ):
+            for size in range(len(names) + 1):
+                for provided in itertools.combinations(names + ("other",), size):
+                    identity = g.identity = Identity(1)
+                    identity.provides.update(need(name) for name in provided)
+                    for count in range(1, len(names) + 1):
+                        for wanted in itertools.combinations(names, count):
+                            needs = [need(name) for name in wanted]
+                            # What roles_required did: a Permission per role.
+                            expected = all(
+                                Permission(n).allows(identity) for n in needs
+                            )
+                            assert (check(required, *wanted) == "allowed") is expected
+                            expected = Permission(*needs).allows(identity)
+                            assert (check(accepted, *wanted) == "allowed") is expected
@@ -92,6 +92,7 @@ def test_confirmable_flag(app, client, sqlalchemy_datastore, get_message):
 
     # Test already confirmed and expired token
     app.config["SECURITY_CONFIRM_EMAIL_WITHIN"] = "-1 days"
+    app.security.refresh_config()
     with app.app_context():
         user = registrations[0]["user"]
         expired_token = generate_confirmation_token(user)
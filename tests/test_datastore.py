@@ -133,6 +133,48 @@ def test_get_user(app, datastore):
         assert user is not None
 
 
+def test_get_user_single_query(app, sqlalchemy_datastore):
+    datastore = sqlalchemy_datastore
+    init_app_with_options(
+        app,
+        datastore,
+        **{
+            "SECURITY_USER_IDENTITY_ATTRIBUTES": (
+                "email",
+                "security_number",
+                "username",
+            )
+        }
+    )
+
+    with app.app_context():
+        matt_id = datastore.find_user(email="matt@lp.com").id
+        # A user whose security_number is matt's id - the PK match must win.
+        datastore.create_user(
+            email="pk@lp.com", username="pk", password="p", security_number=matt_id
+        )
+        datastore.commit()
+        datastore.db.session.expunge_all()
+
+        for identifier, email in [
+            (matt_id, "matt@lp.com"),
+            (str(matt_id), "matt@lp.com"),
+            ("MATT@lp.com", "matt@lp.com"),
+            ("matt", "matt@lp.com"),
+            (123456, "matt@lp.com"),
+        ]:
+            current_nqueries = get_num_queries(datastore)
+            user = datastore.get_user(identifier)
+            assert user.email == email
+            # roles are loaded by the same query
+            assert [r.name for r in user.roles] == ["admin"]
+            assert get_num_queries(datastore) == current_nqueries + 1
+
+        current_nqueries = get_num_queries(datastore)
+        assert datastore.get_user("nobody@lp.com") is None
+        assert get_num_queries(datastore) == current_nqueries + 1
+
+
 def test_find_user(app, datastore):
     init_app_with_options(app, datastore)
 
@@ -150,6 +192,20 @@ def test_find_user(app, datastore):
         assert user_id == datastore.find_user(username="gene").id
 
 
+def test_existing_identities(app, datastore):
+    init_app_with_options(app, datastore)
+
+    with app.app_context():
+        emails = ["gene@lp.com", "matt@lp.com", "nobody@lp.com"]
+        current_nqueries = get_num_queries(datastore)
+        assert datastore.existing_identities("email", emails) == set(emails[:2])
+        end_nqueries = get_num_queries(datastore)
+        if current_nqueries is not None and is_sqlalchemy(datastore):
+            assert end_nqueries == (current_nqueries + 1)
+        assert datastore.existing_identities("username", ["gene", "x"]) == {"gene"}
+        assert datastore.existing_identities("email", []) == set()
+
+
 def test_find_role(app, datastore):
     init_app_with_options(app, datastore)
 
@@ -212,6 +268,92 @@ def test_delete_user(app, datastore):
         assert user is None
 
 
+def test_bulk_user_methods(app, datastore):
+    from flask_security.signals import user_auth_changed
+
+    init_app_with_options(app, datastore)
+
+    changed = []
+
+    @user_auth_changed.connect_via(app)
+    def on_changed(sender, user, **kwargs):
+        changed.append(user.email)
+
+    with app.app_context():
+        created = datastore.create_users(
+            dict(
+                email="bulk%d@lp.com" % i,
+                username="bulk%d" % i,
+                security_number=1000 + i,
+                password="password",
+                roles=["author"],
+            )
+            for i in range(3)
+        )
+        datastore.commit()
+        assert [u.email for u in created] == ["bulk%d@lp.com" % i for i in range(3)]
+        user = datastore.find_user(email="bulk2@lp.com")
+        assert user.has_role("author")
+
+        # Role objects and rows with different columns.
+        mixed = datastore.create_users(
+            [
+                dict(
+                    email="mixed0@lp.com",
+                    username="mixed0",
+                    security_number=1100,
+                    roles=[datastore.find_role("editor"), "author"],
+                ),
+                dict(
+                    email="mixed1@lp.com",
+                    username="mixed1",
+                    security_number=1101,
+                    password="password",
+                ),
+            ]
+        )
+        datastore.commit()
+        assert [u.email for u in mixed] == ["mixed0@lp.com", "mixed1@lp.com"]
+        user = datastore.find_user(email="mixed0@lp.com")
+        assert user.has_role("editor") and user.has_role("author")
+        assert datastore.find_user(email="mixed1@lp.com").password == "password"
+        assert datastore.create_users([]) == []
+
+        users = [datastore.find_user(email=e) for e in ("matt@lp.com", "joe@lp.com")]
+        users.extend(created)
+        assert datastore.add_role_to_users(users, "editor") == 4
+        assert datastore.add_role_to_users(users, "editor") == 0
+        datastore.commit()
+        assert sorted(changed) == sorted(
+            ["matt@lp.com", "bulk0@lp.com", "bulk1@lp.com", "bulk2@lp.com"]
+        )
+        assert all(u.has_role("editor") for u in users)
+        assert datastore.find_user(email="bulk1@lp.com").has_role("editor")
+
+        del changed[:]
+        assert datastore.remove_role_from_users(users, "editor") == 5
+        assert datastore.remove_role_from_users(users, "editor") == 0
+        datastore.commit()
+        assert len(changed) == 5
+        assert not datastore.find_user(email="joe@lp.com").has_role("editor")
+
+        tiya = datastore.find_user(email="tiya@lp.com")
+        assert datastore.deactivate_users(users + [tiya]) == 5
+        assert datastore.deactivate_users(users + [tiya]) == 0
+        datastore.commit()
+        assert not any(u.active for u in users)
+        assert not datastore.find_user(email="bulk0@lp.com").active
+
+        if hasattr(datastore.user_model, "fs_uniquifier"):
+            before = [u.fs_uniquifier for u in users]
+            assert datastore.reset_uniquifiers(users) == 5
+            datastore.commit()
+            user = datastore.find_user(email="matt@lp.com")
+            assert user.fs_uniquifier not in before
+        else:
+            assert datastore.reset_uniquifiers(users) == 0
+
+
 def test_access_datastore_from_factory(app, datastore):
     security = Security()
     security.init_app(app, datastore)
@@ -259,6 +401,14 @@ def test_create_user_with_roles_and_permissions(app, datastore):
         assert user.has_role("test1") is True
         assert user.has_permission("read") is True
 
+        # Permission masks follow changes to the role - committed or not.
+        role = ds.find_role("test1")
+        role.add_permissions("write")
+        assert user.has_permission("write") is True
+        role.remove_permissions("read")
+        assert user.has_permission("read") is False
+        assert user.has_permission("never-seen") is False
+
 
 def test_modify_permissions(app, datastore):
     ds = datastore
@@ -439,3 +589,202 @@ def test_uuid(app, request, tmpdir, realdburl):
     with app.app_context():
         user = ds.get_user("matt@lp.com")
         assert not user
+
+
+def test_normalized_identity(app):
+    from flask_sqlalchemy import SQLAlchemy
+    from flask_security import SQLAlchemyUserDatastore
+    from flask_security.models import fsqla_v2 as fsqla
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SECURITY_USE_NORMALIZED_IDENTITY"] = True
+    app.config["SECURITY_USER_IDENTITY_ATTRIBUTES"] = ("email", "username")
+    db = SQLAlchemy(app)
+    fsqla.FsModels.set_db_info(db)
+
+    class Role(db.Model, fsqla.FsRoleMixin):
+        pass
+
+    class User(db.Model, fsqla.FsUserMixin):
+        pass
+
+    datastore = SQLAlchemyUserDatastore(db, User, Role)
+    app.security = Security(app, datastore=datastore)
+
+    with app.app_context():
+        db.create_all()
+        user = datastore.create_user(
+            email="Matt@LP.com", username="Matt", password="password"
+        )
+        datastore.commit()
+        assert user.email_normalized == "matt@lp.com"
+        assert user.username_normalized == "matt"
+
+        assert datastore.get_user("MATT@lp.com").email == "Matt@LP.com"
+        assert datastore.get_user("matt").email == "Matt@LP.com"
+
+        # Users created before the columns existed need a backfill.
+        User.query.update({"email_normalized": None, "username_normalized": None})
+        datastore.commit()
+        assert datastore.get_user("matt@lp.com") is None
+        assert datastore.normalize_identities(batch_size=1) == 1
+        assert datastore.normalize_identities() == 0
+        assert datastore.get_user("matt@lp.com").email == "Matt@LP.com"
+
+
+def test_normalized_identity_put(app):
+    # Models without fsqla_v2's @validates are kept current by put().
+    from flask_sqlalchemy import SQLAlchemy
+    from sqlalchemy import Column, String
+    from flask_security import SQLAlchemyUserDatastore
+    from flask_security.models import fsqla
+
+    app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite://"
+    app.config["SECURITY_USE_NORMALIZED_IDENTITY"] = True
+    db = SQLAlchemy(app)
+    fsqla.FsModels.set_db_info(db)
+
+    class Role(db.Model, fsqla.FsRoleMixin):
+        pass
+
+    class User(db.Model, fsqla.FsUserMixin):
+        email_normalized = Column(String(255), unique=True)
+
+    datastore = SQLAlchemyUserDatastore(db, User, Role)
+    app.security = Security(app, datastore=datastore)
+
+    with app.app_context():
+        db.create_all()
+        user = datastore.create_user(email="Matt@LP.com", password="password")
+        datastore.commit()
+        user.email = "Matthew@LP.com"
+        datastore.put(user)
+        datastore.commit()
+        assert user.email_normalized == "matthew@lp.com"
+        assert datastore.get_user("MATTHEW@lp.com") is user
+        assert datastore.get_user("matt@lp.com") is None
+
+
+def test_normalize_identities_unimplemented():
+    datastore = MockDatastore(None, None)
+    with raises(NotImplementedError):
+        datastore.normalize_identities()
+
+
+def test_mongoengine_collation(app, mongoengine_datastore):
+    datastore = mongoengine_datastore
+    init_app_with_options(app, datastore)
+
+    with app.app_context():
+        assert datastore.ensure_indexes() == ["fs_email"]
+        indexes = datastore.user_model._get_collection().index_information()
+        assert "fs_email" in indexes
+
+        # Collations are opt-in. mongomock can't run collated queries - check
+        # they are asked for.
+        assert datastore.collation is None
+        query = datastore._user_objects(email="MATT@lp.com")
+        assert query._collation is None
+        datastore.collation = datastore.case_insensitive
+        try:
+            query = datastore._user_objects(email="MATT@lp.com")
+            assert query._collation == {"locale": "en", "strength": 2}
+            query = datastore._user_objects(email__in=["MATT@lp.com"])
+            assert query._collation == {"locale": "en", "strength": 2}
+            # Only identity attribute lookups ignore case.
+            for kwargs in (
+                dict(fs_uniquifier="ABC"),
+                dict(username="matt"),
+                dict(email="MATT@lp.com", active=True),
+                dict(id="5c6dd6d5c1b5b3a8b3c4c1a1"),
+            ):
+                assert datastore._user_objects(**kwargs)._collation is None
+        finally:
+            datastore.collation = None
+
+        datastore.only = ("email", "active")
+        user = datastore.find_auth_user(email="matt@lp.com")
+        assert user.email == "matt@lp.com"
+        assert user.password is None
+        # Other lookups load the whole user.
+        assert datastore.get_user("MATT@lp.com").password is not None
+        assert datastore.find_user(email="matt@lp.com").username == "matt"
+        user = datastore.find_user(email="matt@lp.com", only=("email",))
+        assert user.username is None
+
+
+def test_pony_request_session(app, pony_datastore):
+    from pony.orm.core import local
+
+    datastore = pony_datastore
+    init_app_with_options(app, datastore)
+
+    with app.test_request_context("/"):
+        user = datastore.find_user(email="matt@lp.com")
+        session = local.db_session
+        # One session - and identity map - for the whole request.
+        assert datastore.get_user("matt@lp.com") is user
+        assert datastore.find_role("admin") is not None
+        assert local.db_session is session
+        assert local.db_context_counter == 1
+    assert local.db_context_counter == 0
+
+    # A failed request is rolled back.
+    app.config["PRESERVE_CONTEXT_ON_EXCEPTION"] = False
+    with raises(ZeroDivisionError):
+        with app.test_request_context("/"):
+            datastore.create_role(name="doomed")
+            1 / 0
+    assert local.db_context_counter == 0
+    with app.app_context():
+        assert datastore.find_role("doomed") is None
+        assert datastore.find_role("admin") is not None
+    assert local.db_context_counter == 0
+
+
+def test_update_login_stats(app, datastore):
+    init_app_with_options(app, datastore)
+
+    with app.app_context():
+        user = datastore.find_user(email="matt@lp.com")
+        now = datetime.datetime.utcnow().replace(microsecond=0)
+        for count in (2, 3):
+            datastore.update_login_stats(
+                user.id,
+                count,
+                current_login_at=now,
+                current_login_ip="127.0.0.1",
+                last_login_ip="10.0.0.1",
+            )
+        datastore.commit()
+
+    with app.app_context():
+        user = datastore.find_user(email="matt@lp.com")
+        assert user.login_count == 5
+        assert user.current_login_at == now
+        assert user.current_login_ip == "127.0.0.1"
+        assert user.last_login_ip == "10.0.0.1"
+
+
+def test_update_password_hash(app, datastore):
+    from flask_security.signals import user_auth_changed
+
+    init_app_with_options(app, datastore)
+
+    changed = []
+
+    @user_auth_changed.connect_via(app)
+    def on_changed(sender, user, **kwargs):
+        changed.append(user.id)
+
+    with app.app_context():
+        user = datastore.find_user(email="matt@lp.com")
+        old_hash = user.password
+        assert not datastore.update_password_hash(user.id, "stale", "new")
+        assert changed == []
+        assert datastore.update_password_hash(user.id, old_hash, "new")
+        assert changed == [user.id]
+        datastore.commit()
+
+    with app.app_context():
+        assert datastore.find_user(email="matt@lp.com").password == "new"
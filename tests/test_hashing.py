@@ -6,11 +6,19 @@
     hashing tests
 """
 
+import gc
+
 from pytest import raises
 from utils import authenticate, init_app_with_options
 from passlib.hash import pbkdf2_sha256, django_pbkdf2_sha256, plaintext
 
-from flask_security.utils import hash_password, verify_password, get_hmac
+from flask_security.hashing import HashingExecutor, HashingExecutorBusy
+from flask_security.utils import (
+    get_hmac,
+    hash_password,
+    verify_and_update_password,
+    verify_password,
+)
 
 
 def test_verify_password_bcrypt_double_hash(app, sqlalchemy_datastore):
@@ -122,3 +130,148 @@ def test_missing_hash_salt_option(app, sqlalchemy_datastore):
                 "SECURITY_PASSWORD_SINGLE_HASH": False,
             }
         )
+
+
+def test_hashing_executor(app, sqlalchemy_datastore):
+    init_app_with_options(
+        app, sqlalchemy_datastore, **{"SECURITY_HASHING_EXECUTOR": "thread"}
+    )
+    response = authenticate(app.test_client(), follow_redirects=True)
+    assert b"Home Page" in response.data
+
+    executor = app.security._hashing_executor
+    assert isinstance(executor, HashingExecutor)
+    stats = executor.stats()
+    assert stats["completed"] >= 1
+    assert stats["in_flight"] == 0
+    assert stats["rejected"] == 0
+
+
+def test_hashing_executor_context_strings():
+    from passlib.context import CryptContext
+
+    executor = HashingExecutor("thread", max_workers=1)
+    try:
+        md5 = CryptContext(schemes=["hex_md5"])
+        sha = CryptContext(schemes=["hex_sha256"])
+        assert "hex_md5" in executor._context_string(md5)
+        assert "hex_sha256" in executor._context_string(sha)
+        assert executor._context_string(md5) is executor._context_string(md5)
+        # Collected contexts are forgotten (so a reused id can't match).
+        del md5
+        gc.collect()
+        assert len(executor._context_strings) == 1
+    finally:
+        executor.shutdown()
+
+
+def test_hashing_executor_busy(app, sqlalchemy_datastore):
+    init_app_with_options(
+        app,
+        sqlalchemy_datastore,
+        **{
+            "SECURITY_HASHING_EXECUTOR": "thread",
+            "SECURITY_HASHING_EXECUTOR_WORKERS": 1,
+            "SECURITY_HASHING_EXECUTOR_QUEUE_SIZE": 0,
+        }
+    )
+    with app.app_context():
+        assert verify_password("pass", hash_password("pass"))
+        executor = app.security._hashing_executor
+        # Occupy the only slot.
+        executor._slots.acquire()
+        with raises(HashingExecutorBusy):
+            hash_password("pass")
+
+    client = app.test_client()
+    response = client.post(
+        "/login", json=dict(email="matt@lp.com", password="password")
+    )
+    assert response.status_code == 503
+    assert "too busy" in response.json["response"]["errors"][0]
+
+    response = authenticate(client)
+    assert response.status_code == 503
+    assert executor.stats()["rejected"] == 3
+
+    executor._slots.release()
+    response = authenticate(client, follow_redirects=True)
+    assert b"Home Page" in response.data
+
+
+def test_hashing_executor_process(app, sqlalchemy_datastore):
+    init_app_with_options(
+        app,
+        sqlalchemy_datastore,
+        **{
+            "SECURITY_HASHING_EXECUTOR": "process",
+            "SECURITY_HASHING_EXECUTOR_WORKERS": 1,
+        }
+    )
+    with app.app_context():
+        executor = app.security._hashing_executor
+        completed = executor.stats()["completed"]
+        hashed = hash_password("pass")
+        assert verify_password("pass", hashed)
+        assert not verify_password("other", hashed)
+        assert executor.stats()["completed"] == completed + 3
+        executor.shutdown()
+
+
+def test_deferred_rehash(app, sqlalchemy_datastore):
+    datastore = sqlalchemy_datastore
+    init_app_with_options(
+        app,
+        datastore,
+        **{
+            "SECURITY_PASSWORD_HASH": "pbkdf2_sha256",
+            "SECURITY_PASSWORD_HASH_OPTIONS": {"pbkdf2_sha256": {"rounds": 1000}},
+            "SECURITY_DEFERRED_REHASH": True,
+        }
+    )
+    rehasher = app.security.deferred_rehasher
+    with app.app_context():
+        # A (deprecated) plaintext hash.
+        old_hash = "password"
+        for email in ("matt@lp.com", "joe@lp.com"):
+            user = datastore.find_user(email=email)
+            user.password = old_hash
+            datastore.put(user)
+        datastore.commit()
+
+    with app.test_request_context("/"):
+        user = datastore.find_user(email="matt@lp.com")
+        assert verify_and_update_password("password", user)
+        assert user.password == old_hash
+    rehasher.join()
+    assert rehasher.upgraded == 1
+
+    with app.app_context():
+        user = datastore.find_user(email="matt@lp.com")
+        assert user.password.startswith("$pbkdf2-sha256$")
+        assert verify_password("password", user.password)
+
+        # A hash changed since it was verified isn't overwritten.
+        user = datastore.find_user(email="joe@lp.com")
+        rehasher._apply(user.id, "changed", "password")
+        assert rehasher.conflicts == 1
+    with app.app_context():
+        assert datastore.find_user(email="joe@lp.com").password == old_hash
+    rehasher.shutdown()
+
+
+def test_deferred_rehash_queue_bound(app):
+    from flask_security.hashing import DeferredRehasher
+
+    class User(object):
+        password = "hash"
+
+        def __init__(self, id):
+            self.id = id
+
+    # No worker - nothing is taken off the queue.
+    rehasher = DeferredRehasher(app, queue_size=0)
+    rehasher._start = lambda: None
+    assert rehasher.submit(User(1), "password")
+    assert not rehasher.submit(User(2), "password")
+    assert rehasher.dropped == 1
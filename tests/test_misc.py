@@ -6,13 +6,16 @@
     Email and other functionality tests
 """
 
+import datetime
 import hashlib
+import smtplib
 
+import flask_mail
 import pytest
 
 from utils import authenticate, check_xlation, init_app_with_options, populate_data
 
-from flask_security import Security
+from flask_security import RoleMixin, Security
 from flask_security.forms import (
     ChangePasswordForm,
     ConfirmRegisterForm,
@@ -30,8 +33,12 @@ from flask_security.forms import (
     valid_user_email,
 )
 from flask_security.utils import (
+    SecurityConfig,
     capture_reset_password_requests,
+    config_value,
     encode_string,
+    get_identity_attributes,
+    get_within_delta,
     hash_data,
     send_mail,
     string_types,
@@ -51,6 +58,56 @@ def test_async_email_task(app, client):
     assert app.mail_sent is True
 
 
+class FakeSMTP(object):
+    """Stand-in for smtplib.SMTP that records what it was asked to send."""
+
+    connections = 0
+    sent = []
+    failures = 0
+
+    def __init__(self, host, port):
+        FakeSMTP.connections += 1
+
+    def set_debuglevel(self, level):
+        pass
+
+    def sendmail(self, sender, recipients, msg, *args):
+        if FakeSMTP.failures:
+            FakeSMTP.failures -= 1
+            raise smtplib.SMTPServerDisconnected("Connection unexpectedly closed")
+        FakeSMTP.sent.append(recipients)
+
+    def quit(self):
+        pass
+
+
+@pytest.mark.recoverable()
+@pytest.mark.settings(send_mail_async=True, mail_retry_backoff=0)
+def test_send_mail_async(app, client, monkeypatch):
+    monkeypatch.setattr(FakeSMTP, "sent", [])
+    monkeypatch.setattr(FakeSMTP, "connections", 0)
+    monkeypatch.setattr(flask_mail.smtplib, "SMTP", FakeSMTP)
+    monkeypatch.setattr(app.extensions["mail"], "suppress", False)
+    dispatcher = app.security.mail_dispatcher
+
+    for _ in range(3):
+        response = client.post("/reset", data=dict(email="matt@lp.com"))
+        assert response.status_code == 200
+    FakeSMTP.failures = 1
+    client.post("/reset", data=dict(email="joe@lp.com"))
+
+    dispatcher.shutdown()
+    assert FakeSMTP.sent == [["matt@lp.com"]] * 3 + [["joe@lp.com"]]
+    assert dispatcher.sent == 4
+    assert dispatcher.failed == 0
+    # One connection for all the mail, a new one for the retry.
+    assert FakeSMTP.connections == 2
+
+    # Once shut down mail is sent synchronously.
+    client.post("/reset", data=dict(email="matt@lp.com"))
+    assert len(FakeSMTP.sent) == 5
+
+
 @pytest.mark.recoverable()
 def test_alt_send_mail(app, sqlalchemy_datastore):
     """ Verify that can override the send_mail method. """
@@ -272,6 +329,58 @@ def test_verify_hash(in_app_context):
     assert verify_hash(legacy_data, u"hello") is False
 
 
+@pytest.mark.settings(
+    hashing_schemes=["hmac_sha256", "sha256_crypt", "hex_md5"],
+    deprecated_hashing_schemes=["sha256_crypt", "hex_md5"],
+)
+def test_hmac_hash_data(in_app_context):
+    from passlib.hash import sha256_crypt
+
+    data = hash_data(u"hellö")
+    assert data.startswith("$fs-hmac-sha256$")
+    # Keyed but not salted.
+    assert hash_data(u"hellö") == data
+    assert verify_hash(data, u"hellö") is True
+    assert verify_hash(data, u"hello") is False
+
+    # Data hashed before the upgrade still verifies.
+    old = sha256_crypt.hash(encode_string(u"hellö"))
+    assert verify_hash(old, u"hellö") is True
+    assert verify_hash(old, u"hello") is False
+
+    # A different SECRET_KEY (or HASHING_SALT) is a different key.
+    from flask_security.core import _get_hashing_context
+
+    in_app_context.config["SECRET_KEY"] = "another secret"
+    context = _get_hashing_context(in_app_context)
+    assert context.verify(encode_string(u"hellö"), data) is False
+    assert context.verify(encode_string(u"hellö"), old) is True
+
+
+@pytest.mark.settings(
+    hashing_schemes=["hmac_sha256", "sha256_crypt", "hex_md5"],
+    deprecated_hashing_schemes=["sha256_crypt", "hex_md5"],
+)
+def test_hmac_key_set_after_init_app(app, sqlalchemy_datastore):
+    # The hmac_sha256 key is derived on first use - not by init_app.
+    del app.config["SECRET_KEY"]
+    init_app_with_options(app, sqlalchemy_datastore)
+    with app.app_context():
+        with pytest.raises(ValueError):
+            hash_data(u"hellö")
+    app.config["SECRET_KEY"] = "set later"
+    with app.app_context():
+        data = hash_data(u"hellö")
+        assert data.startswith("$fs-hmac-sha256$")
+        assert verify_hash(data, u"hellö") is True
+
+
+@pytest.mark.settings(hashing_schemes=["sha256_crypt", "hex_md5"])
+def test_hash_data_default_not_deprecated(in_app_context):
+    # The default deprecates sha256_crypt - but not when it is the only choice.
+    assert hash_data(u"hellö").startswith("$5$")
+
+
 @pytest.mark.settings(
     password_salt=u"öööööööööööööööööööööööööööööööööö", password_hash="bcrypt"
 )
@@ -476,3 +585,112 @@ def test_per_request_xlate(app, client):
     assert response.jdata["response"]["errors"]["new_password"] == [
         "Merci d'indiquer un mot de passe"
     ]
+
+
+def test_config_snapshot(app, sqlalchemy_datastore):
+    init_app_with_options(
+        app,
+        sqlalchemy_datastore,
+        **{
+            "SECURITY_USER_IDENTITY_ATTRIBUTES": "email, username",
+            "SECURITY_LOGIN_WITHIN": "2 hours",
+        }
+    )
+    with app.app_context():
+        config = app.extensions["security"]._config
+        assert isinstance(config, SecurityConfig)
+        with pytest.raises(AttributeError):
+            config.foo = "bar"
+        with pytest.raises(TypeError):
+            config["LOGIN_WITHIN"] = "1 days"
+        assert get_identity_attributes() == ["email", "username"]
+        get_identity_attributes().append("phone")
+        assert get_identity_attributes() == ["email", "username"]
+        assert get_within_delta("LOGIN_WITHIN") == datetime.timedelta(hours=2)
+
+        # Runtime changes aren't seen until the snapshot is refreshed.
+        app.config["SECURITY_LOGIN_WITHIN"] = "3 days"
+        app.config["SECURITY_FLASH_MESSAGES"] = False
+        assert config_value("FLASH_MESSAGES")
+        app.security.refresh_config()
+        assert not config_value("FLASH_MESSAGES")
+        assert get_within_delta("LOGIN_WITHIN") == datetime.timedelta(days=3)
+        assert app.security.login_within == "3 days"
+        # Objects built at init time aren't replaced by their config value.
+        assert not isinstance(app.security.i18n_domain, string_types)
+
+
+def test_refresh_config_rebuilds(app, sqlalchemy_datastore):
+    from flask_security.instrumentation import _record_phase_timings
+
+    init_app_with_options(app, sqlalchemy_datastore)
+    # Re-initializing doesn't add the teardown again.
+    state = Security(app, datastore=sqlalchemy_datastore, register_blueprint=False)
+    assert app.teardown_request_funcs[None].count(_record_phase_timings) == 1
+
+    assert state.session_user_cache is None
+    pwd_context = state.pwd_context
+    app.config["SECURITY_USE_SESSION_USER_CACHE"] = True
+    app.config["SECURITY_SESSION_USER_CACHE_TTL"] = 5
+    app.config["SECURITY_SEND_MAIL_ASYNC"] = True
+    app.config["SECURITY_PASSWORD_HASH"] = "pbkdf2_sha512"
+    state.refresh_config()
+    assert state.session_user_cache.ttl == 5
+    assert state.mail_dispatcher is not None
+    assert state.pwd_context is not pwd_context
+    assert state.pwd_context.default_scheme() == "pbkdf2_sha512"
+
+    dispatcher = state.mail_dispatcher
+    app.config["SECURITY_USE_SESSION_USER_CACHE"] = False
+    app.config["SECURITY_SEND_MAIL_ASYNC"] = False
+    state.refresh_config()
+    assert state.session_user_cache is None
+    assert state.mail_dispatcher is None
+    assert dispatcher._stopped.is_set()
+
+
+def test_permission_registry():
+    from flask_principal import Identity
+    from flask_security.permissions import PermissionRegistry
+    from flask_security.utils import FsPermNeed
+
+    class Role(RoleMixin):
+        def __init__(self, id, name, permissions):
+            self.id = id
+            self.name = name
+            self.permissions = permissions
+
+    registry = PermissionRegistry(max_roles=2)
+    assert registry.lookup("read") == 0
+    admin = Role(1, "admin", "read,write")
+    mask = registry.role_mask(admin)
+    assert mask == registry.bit("read") | registry.bit("write")
+    assert registry.role_permissions(admin) == frozenset(["read", "write"])
+    assert registry.mask(["write", "read"]) == mask
+
+    admin.permissions = "read,write,delete"
+    assert registry.role_mask(admin) & registry.lookup("delete")
+    registry.role_mask(Role(2, "editor", None))
+    registry.role_mask(Role(3, "author", "read"))
+    assert len(registry._roles) <= 2
+
+    identity = Identity(1)
+    identity.provides.update([FsPermNeed("write"), FsPermNeed("custom")])
+    assert registry.identity_mask(identity) == registry.mask(["write", "custom"])
+    identity.provides.add(FsPermNeed("read"))
+    assert registry.identity_mask(identity) & registry.bit("read")
+    # Swapping a need for another (the same number of needs) is noticed too.
+    identity.provides.discard(FsPermNeed("read"))
+    identity.provides.add(FsPermNeed("delete"))
+    mask = registry.identity_mask(identity)
+    assert mask == registry.mask(["write", "custom", "delete"])
+    assert registry.identity_mask(None) == 0
+
+    assert registry.names(registry.mask(["read", "custom"])) == frozenset(
+        ["read", "custom"]
+    )
+    assert registry.names(0) == frozenset()
+    names, mask = registry.user_roles([Role(3, "author", "read")])
+    assert names == frozenset(["author"]) and mask == registry.bit("read")
+    # Users with the same roles share the names.
+    assert registry.user_roles([Role(3, "author", "read")])[0] is names
@@ -92,3 +92,76 @@ def test_trackable_using_login_user(app, client):
         assert user.last_login_ip == _client_ip(client)
         assert user.current_login_ip == "127.0.0.1"
         assert user.login_count == 2
+
+
+@pytest.mark.settings(trackable_write_behind=True, trackable_flush_interval=3600)
+def test_trackable_write_behind(app, client):
+    app.wsgi_app = ProxyFix(app.wsgi_app, num_proxies=1)
+    buffer = app.security.trackable_buffer
+    e = "matt@lp.com"
+    authenticate(client, email=e)
+    logout(client)
+    authenticate(client, email=e, headers={"X-Forwarded-For": "127.0.0.1"})
+
+    with app.app_context():
+        user = app.security.datastore.find_user(email=e)
+        assert user.login_count is None
+
+    # Both logins are written as one update.
+    assert buffer.flush() == 1
+    assert buffer.flush() == 0
+    with app.app_context():
+        user = app.security.datastore.find_user(email=e)
+        assert user.last_login_at is not None
+        assert user.current_login_at > user.last_login_at
+        assert user.last_login_ip == _client_ip(client)
+        assert user.current_login_ip == "127.0.0.1"
+        assert user.login_count == 2
+
+    # After shutdown logins update the user again.
+    buffer.shutdown()
+    logout(client)
+    authenticate(client, email=e)
+    with app.app_context():
+        user = app.security.datastore.find_user(email=e)
+        assert user.login_count == 3
+        assert user.last_login_ip == "127.0.0.1"
+
+
+def test_trackable_buffer_restore(app):
+    from datetime import datetime, timedelta
+
+    from flask_security.trackable import TrackableBuffer
+
+    class User(object):
+        id = 1
+        current_login_at = None
+        current_login_ip = None
+
+    buffer = TrackableBuffer(app)
+    buffer._start = lambda: None
+    first = datetime(2019, 1, 1)
+    user = User()
+    buffer.record(user, first, "10.0.0.1")
+    buffer.record(user, first + timedelta(minutes=1), "10.0.0.2")
+    with buffer._lock:
+        failed, buffer._pending = buffer._pending, {}
+
+    # Recorded while the write failed - from the user it didn't update.
+    buffer.record(user, first + timedelta(minutes=2), "10.0.0.3")
+    buffer._restore(failed)
+    logins = buffer._pending[1]
+    assert logins["count"] == 3
+    assert logins["current_login_at"] == first + timedelta(minutes=2)
+    assert logins["current_login_ip"] == "10.0.0.3"
+    assert logins["last_login_at"] == first + timedelta(minutes=1)
+    assert logins["last_login_ip"] == "10.0.0.2"
+
+    # Newer logins in the restored entry win too.
+    buffer._pending = {}
+    buffer.record(user, first - timedelta(minutes=1), "10.0.0.4")
+    buffer._restore(failed)
+    logins = buffer._pending[1]
+    assert logins["count"] == 3
+    assert logins["current_login_ip"] == "10.0.0.2"
+    assert logins["last_login_ip"] == "10.0.0.1"